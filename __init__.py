@@ -10,6 +10,11 @@ from trytond.pool import Pool
 from sale import Sale, SaleShop, SaleLine
 from address import Address
 from shipment import ShipmentOut, ShipmentOutReturn
+from product import Template, Product, Category, PriceList, PriceListLine
+from tax import Tax, TaxRule, TaxRuleLine
+from currency import CurrencyRate
+from user import User
+from summary import POSSummary
 
 
 def register():
@@ -20,5 +25,16 @@ def register():
         ShipmentOut,
         ShipmentOutReturn,
         Address,
+        Template,
+        Product,
+        Category,
+        PriceList,
+        PriceListLine,
+        Tax,
+        TaxRule,
+        TaxRuleLine,
+        CurrencyRate,
+        User,
+        POSSummary,
         module='pos', type_='model'
     )
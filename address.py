@@ -6,6 +6,9 @@
     :license: BSD, see LICENSE for more details.
 """
 from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+
+from serializer import serialize_records
 
 __metaclass__ = PoolMeta
 __all__ = ["Address"]
@@ -14,14 +17,95 @@ __all__ = ["Address"]
 class Address:
     __name__ = "party.address"
 
-    def serialize(self, purpose=None):
+    @classmethod
+    def __setup__(cls):
+        super(Address, cls).__setup__()
+        cls._serializers = {
+            'pos': ['id', 'name'],
+        }
+
+    @classmethod
+    def _pos_default_address_cache(cls):
+        """
+        Return the cache of default addresses of parties for the current
+        transaction. The cursor clears it on commit and rollback.
+        """
+        return Transaction().cursor.cache.setdefault(
+            'pos.party.address.default', {}
+        )
+
+    @classmethod
+    def get_pos_default_address(cls, party, type_):
+        """
+        Return the default address of the given type of the party.
+
+        The lookups are cached per transaction and the cache is invalidated
+        when addresses are created, written or deleted.
+
+        :param party: Active record of the party
+        :param type_: 'invoice' or 'delivery'
+        """
+        cache = cls._pos_default_address_cache()
+        key = (party.id, type_)
+        if key not in cache:
+            addresses = cls.search([
+                ('party', '=', party.id),
+                (type_, '=', True)
+            ], limit=1)
+            cache[key] = addresses[0].id if addresses else None
+        return cache[key] and cls(cache[key])
+
+    @classmethod
+    def pos_prefetch_default_addresses(cls, parties, type_):
+        """
+        Fill the cache of `get_pos_default_address` for the parties with one
+        search.
+
+        :param parties: Active records of the parties
+        :param type_: 'invoice' or 'delivery'
+        """
+        cache = cls._pos_default_address_cache()
+        party_ids = set(
+            party.id for party in parties if (party.id, type_) not in cache
+        )
+        if not party_ids:
+            return
+        for party_id in party_ids:
+            cache[(party_id, type_)] = None
+        # The addresses are in the order of the model like for the search of
+        # a single party, so the first one of each party is kept
+        for address in reversed(cls.search([
+            ('party', 'in', list(party_ids)),
+            (type_, '=', True),
+        ])):
+            cache[(address.party.id, type_)] = address.id
+
+    @classmethod
+    def create(cls, vlist):
+        cls._pos_default_address_cache().clear()
+        return super(Address, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._pos_default_address_cache().clear()
+        return super(Address, cls).write(*args)
+
+    @classmethod
+    def delete(cls, addresses):
+        cls._pos_default_address_cache().clear()
+        return super(Address, cls).delete(addresses)
+
+    def serialize(self, purpose=None, fields=None):
         """
         Address serialization for the purpose of POS
+
+        :param purpose: Name of a serializer registered in `_serializers`
+        :param fields: Projection (list of dotted field paths) restricting
+                       the serialized fields
         """
-        if purpose == 'pos':
-            return {
-                'id': self.id,
-                'name': self.name,
-            }
+        if purpose in self._serializers:
+            return serialize_records(
+                self.__class__, [self], purpose, fields
+            )[0]
         elif hasattr(super(Address, self), 'serialize'):
             return super(Address, self).serialize(purpose)  # pragma: no cover
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+    cart.py
+
+    Cart sessions of the POS sales.
+
+    In the cart session mode the line edits of a draft sale are kept in the
+    memory of the server process instead of being written to the sale lines
+    at once. The totals of the cart are maintained incrementally from the
+    contribution of each line. The edits are written to the sale lines in
+    one go when the cart is flushed (see `Sale.pos_flush_cart`). The edits
+    are kept until the transaction of the flush is known to be committed, so
+    that they are not lost when it is rolled back.
+
+    The sessions live in the process, so they are only shared by the
+    requests served by the same server. With `multi_server` the edits are
+    flushed after each change.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+
+__all__ = [
+    'CartSession', 'get_session', 'pop_session', 'put_session',
+    'idle_sessions',
+]
+
+_ZERO = Decimal('0')
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+class CartSession(object):
+    """
+    Pending line edits of a sale with the contributions of its lines to the
+    totals.
+    """
+
+    def __init__(self, sale_id):
+        self.sale_id = sale_id
+        # Line edits by line key: ('line', id) for an existing line or
+        # ('new', product id, delivery mode) for a line to create
+        self.entries = OrderedDict()
+        # Amount and tax amounts (by tax id) of each line, by line key
+        self.contributions = {}
+        # Token of the flush whose commit is not confirmed yet and the edits
+        # it wrote
+        self.flush_token = None
+        self.flushed = {}
+        self.lock = threading.Lock()
+        self.touch()
+
+    def touch(self):
+        self.last_activity = time.time()
+
+    def set_line(self, key, entry, amount, taxes):
+        """
+        Record the edit of the line with its new contribution to the totals
+        """
+        with self.lock:
+            self.entries[key] = entry
+            self.contributions[key] = (amount, taxes)
+            self.touch()
+
+    def begin_flush(self):
+        """
+        Start a flush of the edits and return a new token to store with
+        them and the edits to write
+        """
+        with self.lock:
+            self.flush_token = uuid.uuid4().hex
+            self.flushed = dict(self.entries)
+            return self.flush_token, self.entries.values()
+
+    def end_flush(self, committed):
+        """
+        End the flush. When it was committed, return the edits made since it
+        started as (key, entry, contribution), the session is then replaced.
+        Otherwise the edits are kept for the next flush.
+        """
+        with self.lock:
+            pending = []
+            if committed:
+                pending = [
+                    (key, entry, self.contributions[key])
+                    for key, entry in self.entries.iteritems()
+                    if self.flushed.get(key) is not entry
+                ]
+            self.flush_token = None
+            self.flushed = {}
+            return pending
+
+    def totals(self):
+        """
+        Return the untaxed amount and the tax amounts by tax of the cart,
+        not rounded.
+        """
+        untaxed_amount, taxes = _ZERO, {}
+        with self.lock:
+            for amount, line_taxes in self.contributions.itervalues():
+                untaxed_amount += amount
+                for tax_id, tax_amount in line_taxes.iteritems():
+                    taxes[tax_id] = taxes.get(tax_id, _ZERO) + tax_amount
+        return untaxed_amount, taxes
+
+
+def get_session(database_name, sale_id):
+    """
+    Return the session of the sale or None
+    """
+    with _lock:
+        return _sessions.get((database_name, sale_id))
+
+
+def pop_session(database_name, sale_id):
+    """
+    Remove the session of the sale and return it or None
+    """
+    with _lock:
+        return _sessions.pop((database_name, sale_id), None)
+
+
+def put_session(database_name, session):
+    """
+    Store the session unless the sale has already one and return the
+    session stored
+    """
+    with _lock:
+        return _sessions.setdefault((database_name, session.sale_id), session)
+
+
+def idle_sessions(database_name, timeout):
+    """
+    Return the ids of the sales whose session had no activity for timeout
+    seconds
+    """
+    limit = time.time() - timeout
+    with _lock:
+        return [
+            sale_id for (name, sale_id), session in _sessions.iteritems()
+            if name == database_name and session.last_activity < limit
+        ]
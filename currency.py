@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+"""
+    currency.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.pool import PoolMeta
+
+from product import ClearPOSPriceCacheMixin
+
+__all__ = ['CurrencyRate']
+
+
+class CurrencyRate(ClearPOSPriceCacheMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'currency.currency.rate'
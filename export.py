@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+    export.py
+
+    Export of the POS sales of a shop for a date range as NDJSON (one sale
+    with its lines per line) or CSV (one sale line per row).
+
+    The sales are serialized with the `pos` serializers in chunks by
+    `Sale.pos_export_sales`, so the memory used does not depend on the size
+    of the range. From the command line::
+
+        python -m trytond.modules.pos.export -c trytond.conf -d database \\
+            --shop 1 --start 2014-01-01 --end 2014-01-31 --format csv
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import csv
+import json
+import argparse
+from datetime import date, datetime
+from decimal import Decimal
+from StringIO import StringIO
+
+__all__ = ['to_ndjson', 'to_csv', 'csv_header']
+
+FORMATS = ('ndjson', 'csv')
+
+
+def _default(value):
+    """
+    Encode the values which are not JSON serializable
+    """
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(repr(value) + ' is not JSON serializable')
+
+
+def _get_path(values, path):
+    """
+    Return the value at the dotted path of the serialized values
+    """
+    for name in path.split('.'):
+        if not isinstance(values, dict):
+            return None
+        values = values.get(name)
+    return values
+
+
+def _csv_cell(value):
+    """
+    Return the value as written in a CSV cell
+    """
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, default=_default, sort_keys=True)
+    elif isinstance(value, (Decimal, date, datetime)):
+        value = _default(value)
+    elif not isinstance(value, basestring):
+        value = unicode(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value
+
+
+def to_ndjson(sales):
+    """
+    Return the serialized sales as NDJSON
+    """
+    return ''.join(
+        json.dumps(sale, default=_default, sort_keys=True) + '\n'
+        for sale in sales
+    )
+
+
+def csv_header(sale_fields, line_fields):
+    """
+    Return the columns of the CSV export for the fields of the sale and of
+    the lines, the columns of the sale are prefixed by `sale.`
+    """
+    return ['sale.' + path for path in sale_fields] + list(line_fields)
+
+
+def to_csv(sales, sale_fields, line_fields, header=False):
+    """
+    Return the serialized sales as CSV, one row per line with the values of
+    the sale repeated. Relational values without projection are written as
+    JSON.
+
+    :param header: Start with the header row
+    """
+    output = StringIO()
+    writer = csv.writer(output)
+    if header:
+        writer.writerow(csv_header(sale_fields, line_fields))
+    for sale in sales:
+        sale_row = [_csv_cell(_get_path(sale, path)) for path in sale_fields]
+        for line in sale.get('lines') or [None]:
+            writer.writerow(sale_row + [
+                _csv_cell(_get_path(line, path)) for path in line_fields
+            ])
+    return output.getvalue()
+
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export the POS sales of a shop for a date range'
+    )
+    parser.add_argument('-c', '--config', dest='config', required=True)
+    parser.add_argument('-d', '--database', dest='database', required=True)
+    parser.add_argument('--shop', type=int, required=True)
+    parser.add_argument('--start', type=_parse_date, required=True)
+    parser.add_argument('--end', type=_parse_date, required=True)
+    parser.add_argument('--format', choices=FORMATS, default='ndjson')
+    parser.add_argument('--output', default='-')
+    args = parser.parse_args(argv)
+
+    from trytond.config import CONFIG
+    CONFIG.update_etc(args.config)
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(args.database)
+    pool.init()
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'wb')
+    try:
+        with Transaction().start(args.database, 0, readonly=True):
+            Sale = pool.get('sale.sale')
+            for data in Sale.pos_export_sales(
+                    args.shop, args.start, args.end, args.format):
+                output.write(data)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+    instrumentation.py
+
+    Opt-in measurement of the POS RPC methods.
+
+    When the `pos_instrumentation` option is set in the configuration file of
+    the server, every call of a method decorated with `instrumented` records
+    the wall time, the number of SQL statements, the time spent in SQL and
+    the number of records instantiated. Each call is logged on the
+    `pos.instrumentation` logger and the aggregates per method are kept in the
+    process (see `get_stats`).
+
+    Nested instrumented calls are accounted to the outermost call only.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+import logging
+import threading
+from functools import wraps
+
+from trytond.config import CONFIG
+from trytond.model import Model
+from trytond.transaction import Transaction
+
+__all__ = ['Measurement', 'instrumented', 'get_stats', 'reset_stats']
+
+logger = logging.getLogger('pos.instrumentation')
+
+_local = threading.local()
+_stats = {}
+_stats_lock = threading.Lock()
+
+# Number of measurements running in the process and the constructor of Model
+# they replaced
+_running = 0
+_model_init = None
+_init_lock = threading.Lock()
+
+
+def _count_instance(init):
+    """
+    Wrap the constructor of Model to count the records instantiated during
+    the measurements running in the thread.
+    """
+    @wraps(init)
+    def __init__(self, *args, **kwargs):
+        measurement = getattr(_local, 'measurement', None)
+        if measurement is not None:
+            measurement.records += 1
+        return init(self, *args, **kwargs)
+    return __init__
+
+
+def _start_counting():
+    """
+    Replace the constructor of Model for the first measurement running in
+    the process
+    """
+    global _running, _model_init
+    with _init_lock:
+        if not _running:
+            _model_init = Model.__dict__['__init__']
+            Model.__init__ = _count_instance(_model_init)
+        _running += 1
+
+
+def _stop_counting():
+    """
+    Restore the constructor of Model once no measurement runs in the process
+    """
+    global _running
+    with _init_lock:
+        _running -= 1
+        if not _running:
+            Model.__init__ = _model_init
+
+
+class Measurement(object):
+    """
+    Measure the wall time, SQL statements, SQL time and records instantiated
+    in the current transaction while the context manager is active.
+    """
+
+    def __init__(self):
+        self.wall_time = 0.0
+        self.queries = 0
+        self.sql_time = 0.0
+        self.records = 0
+
+    def __enter__(self):
+        _start_counting()
+        self.parent = getattr(_local, 'measurement', None)
+        _local.measurement = self
+
+        self.cursor = Transaction().cursor
+        self.execute = self.cursor.execute
+
+        def execute(*args, **kwargs):
+            start = time.time()
+            try:
+                return self.execute(*args, **kwargs)
+            finally:
+                self.queries += 1
+                self.sql_time += time.time() - start
+        self.cursor.execute = execute
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.wall_time = time.time() - self.start
+        self.cursor.execute = self.execute
+        _local.measurement = self.parent
+        _stop_counting()
+
+    def as_dict(self):
+        return {
+            'wall_time': self.wall_time,
+            'queries': self.queries,
+            'sql_time': self.sql_time,
+            'records': self.records,
+        }
+
+
+def instrumented(func):
+    """
+    Decorate a method to measure its calls when the `pos_instrumentation`
+    option is set.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not CONFIG.get('pos_instrumentation') or \
+                getattr(_local, 'measurement', None) is not None:
+            return func(*args, **kwargs)
+        with Measurement() as measurement:
+            result = func(*args, **kwargs)
+        _record(func.__name__, measurement)
+        return result
+    return wrapper
+
+
+def _record(name, measurement):
+    """
+    Log the measurement of a call and add it to the aggregates of the method
+    """
+    logger.info(
+        '%s: %.2f ms, %d queries, %.2f ms in SQL, %d records',
+        name, measurement.wall_time * 1000, measurement.queries,
+        measurement.sql_time * 1000, measurement.records
+    )
+    with _stats_lock:
+        stats = _stats.setdefault(name, {
+            'calls': 0,
+            'wall_time': 0.0,
+            'max_wall_time': 0.0,
+            'queries': 0,
+            'sql_time': 0.0,
+            'records': 0,
+        })
+        stats['calls'] += 1
+        stats['wall_time'] += measurement.wall_time
+        stats['max_wall_time'] = max(
+            stats['max_wall_time'], measurement.wall_time
+        )
+        stats['queries'] += measurement.queries
+        stats['sql_time'] += measurement.sql_time
+        stats['records'] += measurement.records
+
+
+def get_stats():
+    """
+    Return the aggregated measurements of the calls per method since the
+    start of the process or the last reset.
+    """
+    with _stats_lock:
+        return dict((name, stats.copy()) for name, stats in _stats.items())
+
+
+def reset_stats():
+    """
+    Forget the aggregated measurements
+    """
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+    product.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from datetime import datetime, timedelta
+
+from sql.conditionals import Coalesce
+
+from trytond.cache import Cache
+from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+__all__ = [
+    'Template', 'Product', 'Category', 'PriceList', 'PriceListLine',
+    'ClearPOSPriceCacheMixin', 'ClearPOSCodeCacheMixin',
+]
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def timestamp_to_version(timestamp):
+    """
+    Return the catalog version (microseconds since the epoch) of a timestamp
+    """
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def version_to_timestamp(version):
+    """
+    Return the timestamp of a catalog version
+    """
+    return EPOCH + timedelta(microseconds=version)
+
+
+class ClearPOSPriceCacheMixin(object):
+    """
+    Clear the cache of the prices and taxes of the POS sale lines when
+    records of the model are created, written or deleted.
+    """
+
+    @classmethod
+    def clear_pos_price_cache(cls):
+        Pool().get('sale.sale')._pos_price_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        cls.clear_pos_price_cache()
+        return super(ClearPOSPriceCacheMixin, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls.clear_pos_price_cache()
+        return super(ClearPOSPriceCacheMixin, cls).write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        cls.clear_pos_price_cache()
+        return super(ClearPOSPriceCacheMixin, cls).delete(records)
+
+
+class ClearPOSCodeCacheMixin(object):
+    """
+    Clear the cache of the products found by code when records of the model
+    are created, written or deleted.
+    """
+
+    @classmethod
+    def clear_pos_code_cache(cls):
+        Pool().get('product.product')._pos_code_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        cls.clear_pos_code_cache()
+        return super(ClearPOSCodeCacheMixin, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls.clear_pos_code_cache()
+        return super(ClearPOSCodeCacheMixin, cls).write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        cls.clear_pos_code_cache()
+        return super(ClearPOSCodeCacheMixin, cls).delete(records)
+
+
+class Template(ClearPOSCodeCacheMixin, ClearPOSPriceCacheMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'product.template'
+
+
+class Product(ClearPOSCodeCacheMixin, ClearPOSPriceCacheMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'product.product'
+
+    _pos_code_cache = Cache(
+        'product.product.pos_code', size_limit=10240, context=False
+    )
+
+    # The changes of the catalog are timestamped with the start of their
+    # transaction so a transaction committed after a terminal synchronised
+    # could be older than its version. The changes of this period before the
+    # version are sent again.
+    _pos_catalog_overlap = timedelta(minutes=1)
+
+    @classmethod
+    def __setup__(cls):
+        super(Product, cls).__setup__()
+        cls.__rpc__.update({
+            'pos_find_by_code': RPC(readonly=True),
+            'pos_get_catalog': RPC(readonly=True),
+        })
+
+    @classmethod
+    def pos_find_by_code(cls, code):
+        """
+        Return the id of the salable product with the code (as scanned from
+        a barcode) or None.
+
+        The codes found, or not, are cached per process and the cache is
+        cleared when products are created, written or deleted.
+        """
+        product_id = cls._pos_code_cache.get(code)
+        if product_id is None:
+            products = cls.search([
+                ('code', '=', code),
+                ('template.salable', '=', True),
+            ], limit=1)
+            product_id = products[0].id if products else False
+            cls._pos_code_cache.set(code, product_id)
+        return product_id or None
+
+    @classmethod
+    def get_pos_catalog_version(cls):
+        """
+        Return the version of the catalog: the time of the last change of
+        the products and templates in microseconds since the epoch.
+        """
+        Template = Pool().get('product.template')
+        cursor = Transaction().cursor
+
+        timestamps = []
+        for Model in (cls, Template):
+            table = Model.__table__()
+            cursor.execute(*table.select(
+                table.create_date, table.write_date,
+                order_by=Coalesce(table.write_date, table.create_date).desc,
+                limit=1
+            ))
+            row = cursor.fetchone()
+            if row:
+                timestamps.append(row[1] or row[0])
+        return timestamp_to_version(max(timestamps)) if timestamps else 0
+
+    @classmethod
+    def pos_get_catalog(cls, since=None, limit=None, offset=0):
+        """
+        Return a snapshot of the salable products for the POS terminals, or
+        only the changes since a version of the catalog.
+
+        The products are returned by pages ordered by id. The terminals keep
+        the version of the first page and ask the changes since it once they
+        have fetched all the pages. The changes could include products which
+        were already sent (see `_pos_catalog_overlap`).
+
+        :param since: Version returned by a previous call. If None the
+                      whole catalog is returned.
+        :param limit: Maximum number of changed products per page
+        :param offset: Number of changed products to skip
+        :return: A dictionary with the `version` of the catalog, the
+                 `products` (id, code, rec_name, default_image, sale_uom
+                 and list_price), the ids of the products `removed` from the
+                 catalog since the version and the `next_offset` or None on
+                 the last page.
+        """
+        Template = Pool().get('product.template')
+        cursor = Transaction().cursor
+
+        version = cls.get_pos_catalog_version()
+
+        product = cls.__table__()
+        template = Template.__table__()
+        salable = product.active & template.active & template.salable
+        if since is None:
+            where = salable
+        else:
+            timestamp = version_to_timestamp(since) - \
+                cls._pos_catalog_overlap
+            where = (
+                (Coalesce(product.write_date, product.create_date) > timestamp)
+                | (Coalesce(template.write_date, template.create_date)
+                    > timestamp)
+            )
+        cursor.execute(*product.join(
+            template, condition=product.template == template.id
+        ).select(
+            product.id, salable.as_('salable'),
+            where=where,
+            order_by=product.id.asc, limit=limit, offset=offset
+        ))
+        rows = cursor.fetchall()
+
+        ids = [id_ for id_, is_salable in rows if is_salable]
+        removed = [id_ for id_, is_salable in rows if not is_salable]
+        products = []
+        if ids:
+            for row in cls.read(ids, [
+                'code', 'rec_name', 'default_image', 'template.sale_uom',
+                'template.list_price',
+            ]):
+                products.append({
+                    'id': row['id'],
+                    'code': row['code'],
+                    'rec_name': row['rec_name'],
+                    'default_image': row['default_image'],
+                    'sale_uom': row['template.sale_uom'],
+                    'list_price': row['template.list_price'],
+                })
+
+        return {
+            'version': version,
+            'products': products,
+            'removed': removed,
+            'next_offset': (
+                offset + len(rows) if limit and len(rows) == limit else None
+            ),
+        }
+
+
+class Category(ClearPOSPriceCacheMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'product.category'
+
+
+class PriceList(ClearPOSPriceCacheMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'product.price_list'
+
+
+class PriceListLine(ClearPOSPriceCacheMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'product.price_list.line'
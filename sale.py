@@ -5,20 +5,43 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import json
+import logging
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from decimal import Decimal
+
+from sql.aggregate import Max
+from sql.conditionals import Coalesce
+
+from trytond import backend
+from trytond.config import CONFIG
 from trytond.model import fields
+from trytond.cache import Cache
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 from trytond.rpc import RPC
 from trytond.pyson import Eval
+from trytond.exceptions import UserError
+
+from serializer import serialize_records, sub_projection
+from export import FORMATS, to_ndjson, to_csv
+import cart
+from instrumentation import instrumented, get_stats, reset_stats
 
 __metaclass__ = PoolMeta
 __all__ = ["Sale", "SaleShop", "SaleLine"]
 
+logger = logging.getLogger('pos.sale')
+
 
 class SaleShop:
     __name__ = 'sale.shop'
 
+    _pos_settings_cache = Cache(
+        'sale.shop.pos_settings', size_limit=1024, context=False
+    )
+
     anonymous_customer = fields.Many2One(
         'party.party', "Anonymous Customer", required=True
     )
@@ -34,220 +57,1555 @@ class SaleShop:
         ('ship', 'Ship'),
     ], 'Delivery Mode', required=True)
 
+    # Shipments of goods picked up are either fulfilled at checkout or left
+    # pending for the fulfilment cron job
+    pick_up_fulfilment = fields.Selection([
+        ('immediate', 'Immediate'),
+        ('deferred', 'Deferred'),
+    ], 'Pick Up Fulfilment', required=True)
+
     @staticmethod
     def default_delivery_mode():
         return 'ship'
 
+    @staticmethod
+    def default_pick_up_fulfilment():
+        return 'immediate'
+
+    @classmethod
+    def get_pos_settings(cls, shop_id):
+        """
+        Return the settings of the shop used by the POS defaults as a
+        dictionary with the delivery_mode and the ids of the
+        anonymous_customer, warehouse and ship_from_warehouse.
+
+        The settings are cached per process and the cache is cleared when
+        shops or users are created, written or deleted.
+        """
+        key = ('shop', shop_id)
+        settings = cls._pos_settings_cache.get(key)
+        if settings is None:
+            settings, = cls.read([shop_id], [
+                'delivery_mode', 'anonymous_customer', 'warehouse',
+                'ship_from_warehouse',
+            ])
+            cls._pos_settings_cache.set(key, settings)
+        return settings.copy()
+
+    @classmethod
+    def get_pos_user_shop(cls, user_id):
+        """
+        Return the id of the shop of the user or None, cached like the
+        settings of the shops.
+        """
+        User = Pool().get('res.user')
+
+        key = ('user', user_id)
+        shop_id = cls._pos_settings_cache.get(key)
+        if shop_id is None:
+            user, = User.read([user_id], ['shop'])
+            shop_id = user['shop'] or False
+            cls._pos_settings_cache.set(key, shop_id)
+        return shop_id or None
+
+    @classmethod
+    def create(cls, vlist):
+        cls._pos_settings_cache.clear()
+        return super(SaleShop, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._pos_settings_cache.clear()
+        return super(SaleShop, cls).write(*args)
+
+    @classmethod
+    def delete(cls, shops):
+        cls._pos_settings_cache.clear()
+        return super(SaleShop, cls).delete(shops)
+
 
 class Sale:
     __name__ = "sale.sale"
 
+    _pos_price_cache = Cache(
+        'sale.sale.pos_price', size_limit=1024, context=False
+    )
+
+    # Lines of the sales per product and delivery mode, see get_pos_line_index
+    _pos_line_index_cache = Cache(
+        'sale.sale.pos_line_index', size_limit=1024, context=False
+    )
+
+    # Number of sales processed together by pos_process_sales
+    _pos_process_chunk_size = 100
+
+    # Number of sales serialized together by pos_export_sales
+    _pos_export_chunk_size = 200
+
+    # The revision of a sale is the timestamp of its changes, which is the
+    # start of their transaction, so a transaction committed after a terminal
+    # read a revision could be older than it. The lines changed in this
+    # period before the revision are sent again.
+    _pos_revision_overlap = timedelta(minutes=1)
+
+    # Seconds without edit after which a cart session is flushed by the cron
+    _pos_cart_idle_timeout = 300
+
+    # Columns of the indexes matching the search of the drafts of a shop by
+    # get_recent_sales
+    _pos_indexes = [
+        ['shop', 'state', 'write_date'],
+        ['shop', 'state', 'create_date'],
+    ]
+
+    # Key generated by the POS terminal for the sales captured offline
+    pos_client_key = fields.Char('POS Client Key', readonly=True, select=True)
+
+    # Set once the sale is added to the POS summaries of its shop
+    pos_summarized = fields.Boolean('POS Summarized', readonly=True)
+
+    # Untaxed amount and tax amounts (by tax key) of a draft, not rounded,
+    # maintained by the POS line edits. Empty when they are not maintained.
+    pos_totals = fields.Text('POS Totals', readonly=True)
+
+    # Token of the last flush of the cart session, see pos_flush_cart
+    pos_cart_token = fields.Char('POS Cart Token', readonly=True)
+
     @staticmethod
     def default_party():
-        User = Pool().get('res.user')
-        user = User(Transaction().user)
+        Shop = Pool().get('sale.shop')
         if (
             'use_anonymous_customer' not in Transaction().context
         ):  # pragma: no cover
             return
-        if user.shop and user.shop.anonymous_customer:
-            return user.shop.anonymous_customer.id
+        shop_id = Shop.get_pos_user_shop(Transaction().user)
+        if shop_id:
+            return Shop.get_pos_settings(shop_id)['anonymous_customer']
 
     @classmethod
     def __setup__(cls):
         super(Sale, cls).__setup__()
         cls.__rpc__.update({
             'pos_add_product': RPC(instantiate=0, readonly=False),
-            'pos_serialize': RPC(instantiate=0, readonly=True),
+            'pos_add_product_line': RPC(instantiate=0, readonly=False),
+            'pos_add_products': RPC(instantiate=0, readonly=False),
+            'pos_add_product_by_code': RPC(instantiate=0, readonly=False),
+            'pos_consolidate_lines': RPC(instantiate=0, readonly=False),
+            'pos_serialize': RPC(instantiate=0, readonly=False),
+            'pos_serialize_many': RPC(readonly=False),
+            'pos_cart_add_product': RPC(instantiate=0, readonly=False),
+            # Ending a flushed session can consolidate the lines
+            'pos_get_cart': RPC(instantiate=0, readonly=False),
+            'pos_flush_cart': RPC(instantiate=0, readonly=False),
             'get_recent_sales': RPC(readonly=True),
+            'get_pos_rpc_stats': RPC(readonly=True),
+            'pos_process_sales': RPC(instantiate=0, readonly=False),
+            'pos_commit_offline_sales': RPC(readonly=False),
+            'pos_checkout': RPC(instantiate=0, readonly=False),
         })
+        cls._sql_constraints += [
+            (
+                'pos_client_key_uniq', 'UNIQUE(pos_client_key)',
+                'The POS client key of the sale must be unique.'
+            ),
+        ]
         cls.lines.context = {
             'current_sale_shop': Eval('shop'),
         }
+        cls._error_messages.update({
+            'pos_product_code_not_found': (
+                'There is no salable product with the code "%s".'
+            ),
+            'pos_checkout_state': (
+                'The sale "%s" can not be checked out in the state "%s".'
+            ),
+            'pos_cart_not_draft': (
+                'The cart of the sale "%s" can not be edited as the sale is '
+                'not a draft.'
+            ),
+        })
+        cls._serializers = {
+            'pos': [
+                'id', 'revision', 'party', 'total_amount', 'untaxed_amount',
+                'tax_amount', 'comment', 'state', 'invoice_address',
+                'shipment_address', 'lines',
+            ],
+            'recent_sales': [
+                'id', 'party.id', 'party.name', 'total_amount', 'create_date',
+            ],
+            'receipt': [
+                'id', 'reference', 'sale_date', 'state', 'party.id',
+                'party.name', 'untaxed_amount', 'tax_amount', 'total_amount',
+                'lines',
+                'shipments.delivery_mode', 'shipments.state',
+                'invoices.number', 'invoices.state',
+            ],
+        }
+        cls._serializer_getters = {
+            'revision': 'get_pos_revision',
+            'invoice_address': 'get_pos_invoice_address',
+            'shipment_address': 'get_pos_shipment_address',
+        }
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(Sale, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        for columns in cls._pos_indexes:
+            table.index_action(columns, 'add')
+
+    @classmethod
+    def copy(cls, sales, default=None):
+        if default is None:
+            default = {}
+        default = default.copy()
+        default['pos_client_key'] = None
+        default['pos_summarized'] = False
+        default['pos_totals'] = None
+        default['pos_cart_token'] = None
+        return super(Sale, cls).copy(sales, default=default)
+
+    @staticmethod
+    def default_pos_summarized():
+        return False
 
     @classmethod
-    def get_recent_sales(cls):
+    def get_amount(cls, sales, names):
         """
-        Return sales of current shop, which were made within last 5 days
-        and are in draft state. Sort by write_date or create_date of Sale and
-        sale lines.
+        Return the totals of the drafts maintained by POS from the stored
+        totals instead of recomputing them from the lines
         """
+        stored = dict(
+            (sale.id, sale._pos_load_totals()) for sale in sales
+            if sale.state == 'draft' and sale.pos_totals
+        )
+        result = super(Sale, cls).get_amount(
+            [sale for sale in sales if sale.id not in stored], names
+        )
+        for sale in cls.browse(stored.keys()):
+            untaxed_amount, tax_amount = sale._pos_round_totals(
+                *stored[sale.id]
+            )
+            amounts = {
+                'untaxed_amount': untaxed_amount,
+                'tax_amount': tax_amount,
+                'total_amount': sale.currency.round(
+                    untaxed_amount + tax_amount
+                ),
+            }
+            for name in names:
+                result.setdefault(name, {})[sale.id] = amounts[name]
+        return result
+
+    def _pos_load_totals(self):
+        """
+        Return the stored untaxed amount and tax amounts by tax key
+        """
+        totals = json.loads(self.pos_totals)
+        return Decimal(totals['untaxed_amount']), dict(
+            (key, Decimal(amount))
+            for key, amount in totals['taxes'].iteritems()
+        )
+
+    def _pos_round_totals(self, untaxed_amount, taxes):
+        """
+        Return the rounded untaxed and tax amounts of the totals, rounded
+        like the sale does: the tax amounts once summed per tax key.
+        """
+        return self.currency.round(untaxed_amount), sum(
+            (self.currency.round(amount) for amount in taxes.itervalues()),
+            Decimal('0')
+        )
+
+    def _pos_compute_totals(self):
+        """
+        Return the untaxed amount and the tax amounts by tax key of the sale
+        computed from all its lines
+        """
+        untaxed_amount, taxes = Decimal('0'), {}
+        for line in self.lines:
+            if line.type != 'line':
+                continue
+            amount, line_taxes = self._pos_line_contribution(
+                line.taxes, line.unit_price, line.quantity, line.amount
+            )
+            untaxed_amount += amount
+            for key, tax_amount in line_taxes.iteritems():
+                taxes[key] = taxes.get(key, Decimal('0')) + tax_amount
+        return untaxed_amount, taxes
+
+    def _pos_update_totals(self, removed, added):
+        """
+        Update the stored totals of the draft with the contributions (see
+        `_pos_line_contribution`) of the lines removed and added, or compute
+        them from the lines if they are not stored yet.
+
+        The lines must be written with `pos_totals_delta` in the context, so
+        that their changes do not clear the stored totals.
+        """
+        # The record could have been read before the lines were written
+        sale = self.__class__(self.id)
+        if sale.state != 'draft':
+            return
+        if not sale.pos_totals:
+            untaxed_amount, taxes = sale._pos_compute_totals()
+        else:
+            untaxed_amount, taxes = sale._pos_load_totals()
+            for sign, contributions in ((-1, removed), (1, added)):
+                for amount, line_taxes in contributions:
+                    untaxed_amount += sign * amount
+                    for key, tax_amount in line_taxes.iteritems():
+                        taxes[key] = taxes.get(key, Decimal('0')) + \
+                            sign * tax_amount
+        self.write([sale], {
+            'pos_totals': json.dumps({
+                'untaxed_amount': str(untaxed_amount),
+                'taxes': dict(
+                    (key, str(amount)) for key, amount in taxes.iteritems()
+                ),
+            }, sort_keys=True),
+        })
+
+    @classmethod
+    def clear_pos_totals(cls, sale_ids):
+        """
+        Stop using the stored totals of the sales, which are recomputed from
+        the lines until POS maintains them again
+        """
+        sales = cls.search([
+            ('id', 'in', list(sale_ids)),
+            ('pos_totals', '!=', None),
+        ])
+        if sales:
+            cls.write(sales, {'pos_totals': None})
+
+    @classmethod
+    def check_pos_totals(cls, sales):
+        """
+        Check the stored totals of the drafts against a full recomputation
+        and clear them, as they are only used for drafts. A difference is
+        logged as an error.
+        """
+        names = ['untaxed_amount', 'tax_amount']
+        sales = [
+            sale for sale in sales
+            if sale.state == 'draft' and sale.pos_totals
+        ]
+        if not sales:
+            return
+        computed = super(Sale, cls).get_amount(sales, names)
+        for sale in sales:
+            stored = sale._pos_round_totals(*sale._pos_load_totals())
+            expected = tuple(computed[name][sale.id] for name in names)
+            if stored != expected:
+                logger.error(
+                    'Stored POS totals %s of sale %s differ from the '
+                    'computed totals %s', stored, sale.id, expected
+                )
+        cls.clear_pos_totals(map(int, sales))
+
+    @classmethod
+    def quote(cls, sales):
+        cls.check_pos_totals(sales)
+        super(Sale, cls).quote(sales)
+
+    @classmethod
+    def cancel(cls, sales):
+        cls.check_pos_totals(sales)
+        super(Sale, cls).cancel(sales)
+
+    @classmethod
+    def get_pos_rpc_stats(cls, reset=False):
+        """
+        Return the aggregated measurements of the POS RPC calls of the
+        process, per method. The measurements are only recorded when the
+        `pos_instrumentation` option is set in the configuration.
+
+        :param reset: Forget the measurements once returned
+        """
+        stats = get_stats()
+        if reset:
+            reset_stats()
+        return stats
+
+    @classmethod
+    @instrumented
+    def get_recent_sales(cls, limit=None, offset=0, days=5):
+        """
+        Return sales of current shop, which were made within last `days` days
+        and are in draft state. Sort by the latest write_date or create_date
+        of the sale lines and then of the sale itself.
+
+        The sales are fetched with a single grouped query (one row per sale,
+        with the name of the party) so that the cost of the call depends on
+        the size of the page and not on the number of lines in the drafts.
+
+        :param limit: Maximum number of sales to return (all if None)
+        :param offset: Number of sales to skip, for pagination
+        :param days: Lookback window in days
+        """
+        Party = Pool().get('party.party')
+        SaleLine = Pool().get('sale.line')
+
         context = Transaction().context
-        date = (
-            datetime.now() - timedelta(days=5)
-        ).strftime('%Y-%m-%d %H:%M:%S')
+        date = datetime.now() - timedelta(days=days)
         current_shop = context['shop']
 
-        cursor = Transaction().cursor
-        cursor.execute(
-            "SELECT sale_sale.id \
-            FROM sale_sale INNER JOIN sale_line \
-            ON (sale_sale.id = sale_line.sale) \
-            WHERE shop=%d AND state='draft' AND \
-            (sale_sale.write_date >= '%s' OR sale_sale.create_date >= '%s') \
-            ORDER BY sale_line.write_date DESC, sale_line.create_date DESC, \
-            sale_sale.write_date DESC, sale_sale.create_date DESC"
-            % (current_shop, date, date)
+        sale = cls.__table__()
+        sale_line = SaleLine.__table__()
+        party = Party.__table__()
+
+        last_line_activity = Max(
+            Coalesce(sale_line.write_date, sale_line.create_date)
         )
-        ids = [x[0] for x in cursor.fetchall()]
-        return [cls(id).serialize('recent_sales') for id in ids]
+        last_sale_activity = Coalesce(sale.write_date, sale.create_date)
+
+        cursor = Transaction().cursor
+        cursor.execute(*sale.join(
+            sale_line, condition=(sale.id == sale_line.sale)
+        ).join(
+            party, condition=(sale.party == party.id)
+        ).select(
+            sale.id, party.id, party.name, sale.create_date,
+            where=(
+                (sale.shop == current_shop) &
+                (sale.state == 'draft') &
+                ((sale.write_date >= date) | (sale.create_date >= date))
+            ),
+            group_by=(
+                sale.id, party.id, party.name, sale.create_date,
+                sale.write_date,
+            ),
+            order_by=(
+                last_line_activity.desc, last_sale_activity.desc,
+                sale.id.desc,
+            ),
+            limit=limit, offset=offset or None,
+        ))
+        rows = cursor.fetchall()
+
+        # Totals are function fields, compute them for the whole page at once
+        total_amounts = cls.get_amount(
+            cls.browse([row[0] for row in rows]), ['total_amount']
+        )['total_amount']
+
+        return [{
+            'id': sale_id,
+            'party': {
+                'id': party_id,
+                'name': party_name,
+            },
+            'total_amount': total_amounts[sale_id],
+            'create_date': create_date,
+        } for sale_id, party_id, party_name, create_date in rows]
 
     def pos_find_sale_line_domain(self):
         """
-        Return domain to find existing sale line for given product.
+        Return domain to find existing sale line for the product (or the
+        list of `products`) and the delivery mode (any if None) in the
+        context. It is used by `_pos_find_lines` when the line index has no
+        line.
+        """
+        context = Transaction().context
+        domain = self.pos_sale_line_domain(
+            context.get('product'), context.get('delivery_mode')
+        )
+        if context.get('products') is not None:
+            domain.append(('product', 'in', context['products']))
+        return domain
+
+    def pos_sale_line_domain(self, product_id=None, delivery_mode=None):
+        """
+        Return domain to find existing sale line for given product and
+        delivery mode (any if None).
         """
         domain = [
             ('sale', '=', self.id),
         ]
+        if product_id is not None:
+            domain.append(('product', '=', product_id))
+        if delivery_mode is not None:
+            domain.append(('delivery_mode', '=', delivery_mode))
+        return domain
 
-        context = Transaction().context
+    def get_pos_line_index(self):
+        """
+        Return the ids of the lines of the sale per product and delivery mode
+        as a dictionary with (product id, delivery mode) keys.
 
-        if 'product' in context:
-            domain.append(('product', '=', context['product']))
+        The index is built with a single search the first time the sale is
+        used from POS and then maintained by the create, write and delete of
+        the sale lines, so that adding a product does not search the lines.
+        It is kept in the process, so the lines found are checked and the
+        absence of line is checked with a search (see `_pos_find_lines`).
+        """
+        SaleLine = Pool().get('sale.line')
 
-        if 'delivery_mode' in context:
-            domain.append(('delivery_mode', '=', context['delivery_mode']))
+        index = self._pos_line_index_cache.get(self.id)
+        if index is None:
+            index = {}
+            for line in SaleLine.search([
+                ('sale', '=', self.id),
+                ('product', '!=', None),
+            ], order=[('id', 'ASC')]):
+                key = (line.product.id, line.delivery_mode)
+                index[key] = index.get(key, ()) + (line.id,)
+            self._pos_line_index_cache.set(self.id, index)
+        return index
 
-        return domain
+    @classmethod
+    def _pos_index_lines(cls, lines):
+        """
+        Add the lines to the line index of their sale if it is built
+        """
+        for line in lines:
+            if not line.product:
+                continue
+            index = cls._pos_line_index_cache.get(line.sale.id)
+            if index is None:
+                continue
+            # The index is shared by the threads of the process, so it is
+            # replaced instead of being updated in place
+            index = index.copy()
+            key = (line.product.id, line.delivery_mode)
+            index[key] = index.get(key, ()) + (line.id,)
+            cls._pos_line_index_cache.set(line.sale.id, index)
 
-    def pos_add_product(self, product_id, quantity):
+    @classmethod
+    def _pos_forget_line_index(cls, sale_ids):
         """
-        Add product to sale from POS
+        Drop the line index of the sales, it is rebuilt on the next use
+        """
+        for sale_id in sale_ids:
+            cls._pos_line_index_cache.set(sale_id, None)
+
+    def _pos_indexed_line_ids(self, index, product_id, delivery_mode):
+        """
+        Return the ids of the lines of the product with the delivery mode
+        from the line index.
+
+        Without delivery mode, all the lines of the product are returned if
+        they have the same delivery mode and the pick up lines otherwise,
+        like the mode a new line would get.
+        """
+        SaleLine = Pool().get('sale.line')
+
+        if delivery_mode is not None:
+            return index.get((product_id, delivery_mode), ())
+        line_ids_by_mode = dict(
+            (mode, index[(product_id, mode)])
+            for mode, _ in SaleLine.delivery_mode.selection
+            if index.get((product_id, mode))
+        )
+        if len(line_ids_by_mode) == 1:
+            return line_ids_by_mode.values()[0]
+        return line_ids_by_mode.get('pick_up', ())
+
+    def _pos_find_line(self, product_id, delivery_mode):
+        """
+        Return the line of the product (with the delivery mode if given) to
+        update from POS, or None if a line has to be created.
+        See `_pos_find_lines`.
+        """
+        key = (product_id, delivery_mode)
+        return self._pos_find_lines([key])[key]
+
+    def _pos_find_lines(self, keys):
+        """
+        Return the lines to update from POS for the (product id, delivery
+        mode) keys as a dictionary, with None for the keys which need a new
+        line. A key without delivery mode matches the lines of any mode.
+
+        The lines are taken from the line index and the keys for which the
+        index has none are checked with a single search with
+        `pos_find_sale_line_domain`. When a product has several lines they
+        are consolidated first, so that duplicates do not lead to yet
+        another line.
         """
-        AccountTax = Pool().get('account.tax')
         SaleLine = Pool().get('sale.line')
-        Transaction().set_context(product=product_id)
 
+        def get_lines(index):
+            return dict(
+                (key, SaleLine.browse(self._pos_indexed_line_ids(index, *key)))
+                for key in keys
+            )
+
+        lines_by_key = get_lines(self.get_pos_line_index())
         try:
-            if 'sale_line' in Transaction().context:
-                sale_line = SaleLine(Transaction().context.get('sale_line'))
-            else:
-                sale_line, = SaleLine.search(self.pos_find_sale_line_domain())
-        except ValueError:
-            sale_line = None
+            valid = all(
+                line.sale.id == self.id and line.product and
+                line.product.id == product_id and
+                delivery_mode in (None, line.delivery_mode)
+                for (product_id, delivery_mode), lines
+                in lines_by_key.iteritems()
+                for line in lines
+            )
+        except UserError:
+            # A line of the index does not exist anymore
+            valid = False
+        if not valid:
+            # The lines were changed by another process or the transaction
+            # which changed them was rolled back
+            self._pos_forget_line_index([self.id])
+            lines_by_key = get_lines(self.get_pos_line_index())
+
+        missing = [key for key, lines in lines_by_key.iteritems() if not lines]
+        if missing:
+            # The index misses the lines created by other servers since it
+            # was built, so its absence of line is checked with a search.
+            # The search is run out of the context of the domain, whose
+            # product ids would miss the caches keyed by the context.
+            with Transaction().set_context(
+                    product=None, delivery_mode=None,
+                    products=list(set(key[0] for key in missing))):
+                domain = self.pos_find_sale_line_domain()
+            lines = SaleLine.search(domain, order=[('id', 'ASC')])
+            if lines:
+                self._pos_forget_line_index([self.id])
+                index = {}
+                for line in lines:
+                    key = (line.product.id, line.delivery_mode)
+                    index[key] = index.get(key, ()) + (line.id,)
+                for key in missing:
+                    lines_by_key[key] = SaleLine.browse(
+                        self._pos_indexed_line_ids(index, *key)
+                    )
 
-        delivery_mode = Transaction().context.get('delivery_mode', 'pick_up')
+        result, consolidated = {}, {}
+        for key, lines in lines_by_key.iteritems():
+            line_ids = tuple(map(int, lines))
+            if len(lines) > 1 and line_ids not in consolidated:
+                # A key without delivery mode can match the lines of another
+                consolidated[line_ids] = self._pos_consolidate_lines(lines)
+            lines = consolidated.get(line_ids, lines)
+            result[key] = lines[0] if lines else None
+        return result
+
+    @instrumented
+    def pos_consolidate_lines(self):
+        """
+        Merge the lines of the sale with the same product, unit and delivery
+        mode into one line with the total quantity from POS.
+        """
+        lines = self._pos_consolidate_lines(self.lines)
+        return {
+            'sale': self.pos_serialize(),
+            'updated_line_ids': map(int, lines),
+        }
+
+    def _pos_consolidate_lines(self, lines):
+        """
+        Merge the lines with the same product, unit and delivery mode into
+        the first of them, which is priced for the total quantity, and
+        delete the others. Return the lines kept.
+        """
+        SaleLine = Pool().get('sale.line')
+
+        groups = OrderedDict()
+        for line in sorted(lines, key=lambda line: line.id):
+            if not line.product:
+                continue
+            key = (line.product.id, line.unit.id, line.delivery_mode)
+            groups.setdefault(key, []).append(line)
+
+        to_write, to_delete = [], []
+        for (product_id, _, delivery_mode), group in groups.iteritems():
+            if len(group) == 1:
+                continue
+            sale_line = group[0]
+            values = self._pos_sale_line_values(
+                product_id, sum(line.quantity for line in group),
+                delivery_mode, sale_line
+            )
+            to_write.extend((
+                [sale_line], self._pos_sale_line_vals_to_save(values)
+            ))
+            to_delete.extend(group[1:])
+
+        if to_write:
+            SaleLine.write(*to_write)
+        if to_delete:
+            SaleLine.delete(to_delete)
+        return SaleLine.browse([group[0].id for group in groups.itervalues()])
+
+    def _pos_sale_line_values(
+        self, product_id, quantity, delivery_mode, sale_line=None
+    ):
+        """
+        Return the values of a sale line for the given product and quantity
+        as computed by the on_change methods of the sale line.
+
+        If a sale_line is given, the values are those to update the line with,
+        otherwise they are the values to create a new line.
+        """
+        Product = Pool().get('product.product')
+
+        values = {
+            '_parent_sale.currency': self.currency.id,
+            '_parent_sale.party': self.party.id,
+            '_parent_sale.price_list': (
+                self.price_list.id if self.price_list else None
+            ),
+            'type': 'line',
+            'quantity': quantity,
+        }
+        if delivery_mode:
+            values['delivery_mode'] = delivery_mode
 
         if sale_line:
-            values = {
+            values.update({
                 'product': sale_line.product.id,
-                '_parent_sale.currency': self.currency.id,
-                '_parent_sale.party': self.party.id,
-                '_parent_sale.price_list': (
-                    self.price_list.id if self.price_list else None
-                ),
                 'unit': sale_line.unit.id,
-                'quantity': quantity,
-                'type': 'line',
-            }
-            if delivery_mode:
-                values['delivery_mode'] = delivery_mode
-
-            # Update the values by triggering an onchange which should
-            # fill missing vals
-            values.update(SaleLine(**values).on_change_quantity())
-
-            new_values = {}
-            for key, value in values.iteritems():
-                if '.' in key:
-                    continue
-                if key == 'taxes':
-                    # Difficult to reach here unless taxes change when
-                    # quantities change.
-                    continue    # pragma: no cover
-                new_values[key] = value
-            SaleLine.write([sale_line], new_values)
+            })
         else:
-            values = {
+            values.update({
                 'product': product_id,
-                '_parent_sale.currency': self.currency.id,
-                '_parent_sale.party': self.party.id,
-                '_parent_sale.price_list': (
-                    self.price_list.id if self.price_list else None
-                ),
                 'sale': self.id,
-                'type': 'line',
-                'quantity': quantity,
                 'unit': None,
                 'description': None,
-            }
-            if delivery_mode:
-                values['delivery_mode'] = delivery_mode
-            values.update(SaleLine(**values).on_change_product())
-            values.update(SaleLine(**values).on_change_quantity())
-            new_values = {}
-            for key, value in values.iteritems():
-                if '.' in key:
-                    continue
-                if key == 'taxes':
-                    continue
-                new_values[key] = value
-            sale_line = SaleLine.create([new_values])[0]
+            })
+
+        # The on_change values only depend on the quantity through the
+        # breakpoints of the price list, so they are cached to not run the
+        # pricing engine for repeated scans of the same product.
+        key = self._get_pos_price_cache_key(
+            Product(values['product']), sale_line and sale_line.unit, quantity
+        )
+        on_change_values = self._pos_price_cache.get(key)
+        if on_change_values is None:
+            on_change_values = self._pos_sale_line_on_change(
+                values, sale_line is None
+            )
+            self._pos_price_cache.set(key, on_change_values)
+        values.update(on_change_values)
+
+        if 'amount' in values:
+            values['amount'] = self.currency.round(
+                Decimal(str(quantity)) * (values['unit_price'] or Decimal('0'))
+            )
+        return values
+
+    def _pos_sale_line_on_change(self, values, new_line):
+        """
+        Return the values computed by the on_change methods of a sale line
+        with the given values.
+
+        :param new_line: True if the values are for a line to be created
+        """
+        SaleLine = Pool().get('sale.line')
+
+        res = {}
+        if new_line:
+            res.update(SaleLine(**values).on_change_product())
+        line_values = values.copy()
+        line_values.update(res)
+        # Update the values by triggering an onchange which should
+        # fill missing vals
+        res.update(SaleLine(**line_values).on_change_quantity())
+        return res
+
+    def _get_pos_price_cache_key(self, product, unit, quantity):
+        """
+        Return the key of the cache of the on_change values of a POS sale
+        line of the product.
+
+        :param product: Active record of the product
+        :param unit: Active record of the unit of the line or None for the
+                     sale unit of the product
+        :param quantity: The quantity of the line
+        """
+        Date = Pool().get('ir.date')
+
+        party = self.party
+        return (
+            product.id, unit and unit.id, party.id,
+            party.lang and party.lang.id,
+            party.customer_tax_rule and party.customer_tax_rule.id,
+            self.price_list and self.price_list.id, self.currency.id,
+            # The prices are converted with the currency rate of the day
+            self.sale_date or Date.today(),
+            Transaction().context.get('company'),
+            Transaction().language,
+            self._get_pos_price_quantity_key(
+                product, unit or product.sale_uom, quantity
+            ),
+        )
+
+    def _get_pos_price_quantity_key(self, product, unit, quantity):
+        """
+        Return the part of the price cache key which depends on the quantity.
+
+        Without price list the price does not depend on the quantity. With a
+        price list only the lines of the price list matched by the quantity
+        matter.
+        """
+        Uom = Pool().get('product.uom')
+
+        if not self.price_list:
+            return None
+
+        breakpoints_key = ('breakpoints', self.price_list.id)
+        breakpoints = self._pos_price_cache.get(breakpoints_key)
+        if breakpoints is None:
+            breakpoints = [
+                (line.product and line.product.id, line.quantity)
+                for line in self.price_list.lines
+            ]
+            self._pos_price_cache.set(breakpoints_key, breakpoints)
+
+        quantity_in_uom = Uom.compute_qty(
+            unit, quantity, product.default_uom, round=False
+        )
+        return tuple(
+            line_quantity is None or line_quantity <= quantity_in_uom
+            for line_product, line_quantity in breakpoints
+            if line_product in (None, product.id)
+        )
+
+    @staticmethod
+    def _pos_sale_line_vals_to_save(values):
+        """
+        Return the values which could be saved on the sale line leaving out
+        the related fields and the taxes (which are saved separately).
+        """
+        return dict(
+            (key, value) for key, value in values.iteritems()
+            if '.' not in key and key != 'taxes'
+        )
+
+    @instrumented
+    def pos_add_product(self, product_id, quantity):
+        """
+        Add product to sale from POS
+
+        The line to update (`sale_line`) and the `delivery_mode` are taken
+        from the context. See `pos_add_product_line` to pass them as
+        arguments.
+        """
+        context = Transaction().context
+        return self.pos_add_product_line(
+            product_id, quantity, context.get('delivery_mode'),
+            context.get('sale_line')
+        )
+
+    @instrumented
+    def pos_add_product_line(
+        self, product_id, quantity, delivery_mode=None, sale_line_id=None
+    ):
+        """
+        Set the quantity of the product on the sale from POS. The line is
+        created if there is no line of the product (with the delivery mode
+        if given) or updated.
+
+        :param product_id: ID of the product
+        :param quantity: The new quantity of the line
+        :param delivery_mode: The delivery mode of the line. Defaults to
+                              'pick_up' for new lines, existing lines keep
+                              theirs.
+        :param sale_line_id: ID of the line to update if known by the client,
+                             which saves looking it up
+        """
+        AccountTax = Pool().get('account.tax')
+        SaleLine = Pool().get('sale.line')
+
+        self.pos_flush_cart()
+
+        if sale_line_id is not None:
+            sale_line = SaleLine(sale_line_id)
+        else:
+            sale_line = self._pos_find_line(product_id, delivery_mode)
+
+        if delivery_mode is None and sale_line is None:
+            delivery_mode = 'pick_up'
+        values = self._pos_sale_line_values(
+            product_id, quantity, delivery_mode, sale_line
+        )
+        removed = []
+        with Transaction().set_context(pos_totals_delta=True):
+            if sale_line:
+                removed.append(self._pos_line_contribution(
+                    sale_line.taxes, sale_line.unit_price,
+                    sale_line.quantity, sale_line.amount
+                ))
+                # Taxes are difficult to reach here unless taxes change when
+                # quantities change.
+                SaleLine.write(
+                    [sale_line], self._pos_sale_line_vals_to_save(values)
+                )
+            else:
+                sale_line, = SaleLine.create([
+                    self._pos_sale_line_vals_to_save(values)
+                ])
 
-        if 'taxes' in values:
-            sale_line.taxes = AccountTax.browse(values['taxes'])
-            sale_line.save()
+            if 'taxes' in values:
+                sale_line.taxes = AccountTax.browse(values['taxes'])
+                sale_line.save()
+        sale_line = SaleLine(sale_line.id)
+        self._pos_update_totals(removed, [self._pos_line_contribution(
+            sale_line.taxes, sale_line.unit_price, sale_line.quantity,
+            sale_line.amount
+        )])
 
         # Now that the sale line is built, return a serializable response
         # which ensures that the client does not have to call again.
         res = {
-            'sale': self.serialize('pos'),
+            'sale': self.pos_serialize(),
             'updated_line_id': sale_line.id,
         }
         return res
 
+    @instrumented
+    def pos_add_product_by_code(self, code, quantity):
+        """
+        Add the product with the code (as scanned from a barcode) to the
+        sale from POS, with the same context and response as
+        `pos_add_product`.
+        """
+        Product = Pool().get('product.product')
+
+        product_id = Product.pos_find_by_code(code)
+        if product_id is None:
+            self.raise_user_error('pos_product_code_not_found', (code,))
+        return self.pos_add_product(product_id, quantity)
+
+    @instrumented
+    def pos_add_products(self, items):
+        """
+        Add many products to sale from POS in one call.
+
+        Each item is a dictionary with the `product` and the `quantity`
+        and optionally the `delivery_mode` and the `sale_line` to update.
+        Items are applied in order and like in :meth:`pos_add_product` the
+        quantity replaces the quantity of the matching line, so when several
+        items match the same line the last one wins.
+
+        The existing lines are looked up in the line index of the sale (see
+        `_pos_find_lines`) and the lines are then saved with one create and
+        one write.
+        """
+        self.pos_flush_cart()
+        updated_line_ids = self._pos_save_lines(items)
+        return {
+            'sale': self.pos_serialize(),
+            'updated_line_ids': updated_line_ids,
+        }
+
+    def _pos_save_lines(self, items):
+        """
+        Save the items of `pos_add_products` to the sale lines and return the
+        ids of the lines created or updated.
+        """
+        SaleLine = Pool().get('sale.line')
+
+        context_delivery_mode = Transaction().context.get('delivery_mode')
+
+        sale_lines = self._pos_find_lines([
+            (item['product'], item.get('delivery_mode', context_delivery_mode))
+            for item in items if not item.get('sale_line')
+        ])
+
+        # Collapse the items into one entry per line (existing or new)
+        entries = OrderedDict()
+        for item in items:
+            delivery_mode = item.get('delivery_mode', context_delivery_mode)
+            if item.get('sale_line'):
+                sale_line = SaleLine(item['sale_line'])
+            else:
+                sale_line = sale_lines[(item['product'], delivery_mode)]
+            if sale_line:
+                # Existing lines keep their delivery mode if none is given
+                key = ('line', sale_line.id)
+            else:
+                delivery_mode = delivery_mode or 'pick_up'
+                key = ('new', item['product'], delivery_mode)
+            entries.pop(key, None)
+            entries[key] = (
+                item['product'], item['quantity'], delivery_mode, sale_line
+            )
+
+        to_create, to_write = [], []
+        for entry in entries.itervalues():
+            product_id, quantity, delivery_mode, sale_line = entry
+            values = self._pos_sale_line_values(
+                product_id, quantity, delivery_mode, sale_line
+            )
+            vals_to_save = self._pos_sale_line_vals_to_save(values)
+            if sale_line:
+                to_write.extend(([sale_line], vals_to_save))
+            else:
+                if values.get('taxes'):
+                    vals_to_save['taxes'] = [('add', values['taxes'])]
+                to_create.append(vals_to_save)
+
+        removed = [
+            self._pos_line_contribution(
+                line.taxes, line.unit_price, line.quantity, line.amount
+            ) for line in SaleLine.browse(
+                [lines[0].id for lines in to_write[::2]]
+            )
+        ]
+        updated_line_ids = []
+        with Transaction().set_context(pos_totals_delta=True):
+            if to_write:
+                SaleLine.write(*to_write)
+                updated_line_ids.extend(
+                    lines[0].id for lines in to_write[::2]
+                )
+            if to_create:
+                updated_line_ids.extend(
+                    map(int, SaleLine.create(to_create))
+                )
+        self._pos_update_totals(removed, [
+            self._pos_line_contribution(
+                line.taxes, line.unit_price, line.quantity, line.amount
+            ) for line in SaleLine.browse(updated_line_ids)
+        ])
+        return updated_line_ids
+
+    def _pos_get_cart_session(self):
+        """
+        Return the cart session of the sale or None.
+
+        A session whose last flush is committed (the sale has the token of
+        the flush) is ended, the edits made since are kept in a new session.
+        A session whose last flush is not, because it was rolled back, keeps
+        its edits for the next flush.
+        """
+        database_name = Transaction().cursor.database_name
+        session = cart.get_session(database_name, self.id)
+        if session is None or session.flush_token is None:
+            return session
+
+        token = self.read([self.id], ['pos_cart_token'])[0]['pos_cart_token']
+        if token != session.flush_token:
+            session.end_flush(committed=False)
+            return session
+
+        cart.pop_session(database_name, self.id)
+        pending = session.end_flush(committed=True)
+        if not pending:
+            return None
+        session = self._pos_cart_session()
+        for key, entry, contribution in pending:
+            if key[0] == 'new':
+                # The line may have been created by the flush
+                sale_line = self._pos_find_line(key[1], key[2])
+                if sale_line:
+                    key = ('line', sale_line.id)
+                    entry = dict(entry, sale_line=sale_line.id)
+            session.set_line(key, entry, *contribution)
+        return session
+
+    def _pos_cart_session(self):
+        """
+        Return the cart session of the sale, started with the contributions
+        of the existing lines to the totals if there is none.
+        """
+        database_name = Transaction().cursor.database_name
+        session = self._pos_get_cart_session()
+        if session is None:
+            session = cart.CartSession(self.id)
+            # The lines of the instance may predate a flush
+            for line in self.__class__(self.id).lines:
+                if line.type != 'line':
+                    continue
+                key = ('line', line.id)
+                session.contributions[key] = self._pos_line_contribution(
+                    line.taxes, line.unit_price, line.quantity, line.amount
+                )
+            session = cart.put_session(database_name, session)
+        return session
+
+    def _pos_line_contribution(self, taxes, unit_price, quantity, amount):
+        """
+        Return the contribution of a line to the totals of the sale: its
+        amount and its tax amounts, not rounded, by tax key. The keys are
+        those of the tax amount of the sale (as strings) so that the amounts
+        are rounded the same way.
+        """
+        pool = Pool()
+        Tax = pool.get('account.tax')
+        Invoice = pool.get('account.invoice')
+
+        tax_amounts = {}
+        with Transaction().set_context(self.get_tax_context()):
+            for tax in Tax.compute(
+                    taxes, unit_price or Decimal('0'), quantity or 0):
+                key, values = Invoice._compute_tax(tax, 'out_invoice')
+                key = ','.join(map(unicode, key))
+                tax_amounts[key] = tax_amounts.get(
+                    key, Decimal('0')
+                ) + values['amount']
+        return amount or Decimal('0'), tax_amounts
+
+    def _pos_cart_line_key(self, session, product_id, delivery_mode):
+        """
+        Return the key in the cart session of the line of the product (with
+        the delivery mode if given): the pending edit of the product, else
+        the existing line, else a new line.
+        """
+        keys = [
+            key for key, entry in session.entries.items()
+            if entry['product'] == product_id and
+            delivery_mode in (None, entry['delivery_mode'])
+        ]
+        if len(keys) == 1:
+            return keys[0]
+        sale_line = self._pos_find_line(product_id, delivery_mode)
+        if sale_line:
+            return ('line', sale_line.id)
+        return ('new', product_id, delivery_mode or 'pick_up')
+
+    @instrumented
+    def pos_cart_add_product(
+        self, product_id, quantity, delivery_mode=None, sale_line_id=None
+    ):
+        """
+        Set the quantity of the product in the cart session of the sale.
+
+        Like `pos_add_product_line`, but the line is only written when the
+        cart is flushed: by `pos_flush_cart`, `pos_serialize`, the checkout
+        or the cron after `_pos_cart_idle_timeout` seconds without edit.
+        Only the cart of a draft can be edited. Return the cart with its
+        totals.
+        """
+        pool = Pool()
+        AccountTax = pool.get('account.tax')
+        SaleLine = pool.get('sale.line')
+
+        if self.state != 'draft':
+            self.raise_user_error('pos_cart_not_draft', (self.rec_name,))
+
+        session = self._pos_cart_session()
+        if sale_line_id is not None:
+            key = ('line', sale_line_id)
+        else:
+            key = self._pos_cart_line_key(session, product_id, delivery_mode)
+
+        if key[0] == 'line':
+            sale_line = SaleLine(key[1])
+            previous = session.entries.get(key, {})
+            delivery_mode = delivery_mode or \
+                previous.get('delivery_mode') or sale_line.delivery_mode
+        else:
+            sale_line, delivery_mode = None, key[2]
+        values = self._pos_sale_line_values(
+            product_id, quantity, delivery_mode, sale_line
+        )
+        if sale_line:
+            taxes = sale_line.taxes
+        else:
+            taxes = AccountTax.browse(values.get('taxes', []))
+        unit_price = values['unit_price'] or Decimal('0')
+        amount = self.currency.round(Decimal(str(quantity)) * unit_price)
+
+        session.set_line(key, {
+            'product': values['product'],
+            'quantity': quantity,
+            'delivery_mode': delivery_mode,
+            'sale_line': sale_line and sale_line.id,
+            'unit_price': unit_price,
+            'amount': amount,
+        }, *self._pos_line_contribution(taxes, unit_price, quantity, amount))
+        res = self.pos_get_cart()
+        if CONFIG['multi_server']:
+            # The other servers do not see the session
+            self.pos_flush_cart()
+        return res
+
+    def pos_get_cart(self):
+        """
+        Return the pending line edits of the cart session of the sale and
+        the totals of the sale with these edits.
+        """
+        session = self._pos_cart_session()
+        untaxed_amount, taxes = session.totals()
+        untaxed_amount = self.currency.round(untaxed_amount)
+        tax_amount = sum(
+            (self.currency.round(amount) for amount in taxes.itervalues()),
+            Decimal('0')
+        )
+        with session.lock:
+            lines = session.entries.values()
+        return {
+            'sale': self.id,
+            'lines': lines,
+            'untaxed_amount': untaxed_amount,
+            'tax_amount': tax_amount,
+            'total_amount': self.currency.round(untaxed_amount + tax_amount),
+        }
+
+    def pos_flush_cart(self):
+        """
+        Write the pending line edits of the cart session of the sale with one
+        create and one write and return the ids of the lines created or
+        updated.
+
+        The sale is stamped with the token of the flush in the same
+        transaction. The session ends once the token is seen committed, so
+        when the transaction is rolled back (and retried by the dispatcher)
+        the edits are still pending.
+        """
+        database_name = Transaction().cursor.database_name
+        session = self._pos_get_cart_session()
+        if session is None:
+            return []
+        if not session.entries or self.state != 'draft':
+            if session.entries:
+                logger.warning(
+                    'Cart of sale %s dropped as the sale is not a draft',
+                    self.id
+                )
+            cart.pop_session(database_name, self.id)
+            return []
+        token, items = session.begin_flush()
+        updated_line_ids = self._pos_save_lines(items)
+        self.write([self], {'pos_cart_token': token})
+        return updated_line_ids
+
+    @classmethod
+    def flush_pos_carts(cls):
+        """
+        Flush the cart sessions without edit for `_pos_cart_idle_timeout`
+        seconds, each in its own transaction. The edits of a sale which fails
+        to be flushed are kept for the next run, the sessions flushed are
+        ended by the next run.
+        """
+        database_name = Transaction().cursor.database_name
+        for sale_id in cart.idle_sessions(
+                database_name, cls._pos_cart_idle_timeout):
+            with Transaction().new_cursor() as txn:
+                try:
+                    with Transaction().set_user(0, set_context=True):
+                        sales = cls.search([('id', '=', sale_id)])
+                        for sale in sales:
+                            with Transaction().set_context(
+                                    company=sale.company.id):
+                                sale.pos_flush_cart()
+                        if not sales:
+                            cart.pop_session(database_name, sale_id)
+                except Exception:
+                    txn.cursor.rollback()
+                    logger.exception(
+                        'Flush of the cart of sale %s failed', sale_id
+                    )
+                else:
+                    txn.cursor.commit()
+
+    @classmethod
+    def pos_commit_offline_sales(cls, sales, confirm=False, process=False):
+        """
+        Create the sales captured offline by a POS terminal.
+
+        Each sale is a dictionary with the `client_key` generated by the
+        terminal, the `lines` and optionally the `party` (defaults to the
+        anonymous customer of the shop), the `invoice_address` and the
+        `shipment_address` (default to the addresses of the party), the
+        `sale_date` and the `comment`. Each line is a
+        dictionary with the `product`, the `quantity` and optionally the
+        `delivery_mode`, the `unit`, the `description`, the `unit_price`
+        and the `taxes` (list of ids). Lines with both a unit price and taxes
+        are saved as given, the others are priced like in `pos_add_product`.
+
+        Sales whose client key was already committed are not created again,
+        so a terminal can safely send a batch again.
+
+        :param sales: List of the sales captured offline
+        :param confirm: Quote and confirm the created sales
+        :param process: Quote, confirm and process the created sales
+        :return: A list of dictionaries with the `client_key`, the id of the
+                 `sale` and if it was `created`, in the order of the sales
+        """
+        pool = Pool()
+        SaleLine = pool.get('sale.line')
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+
+        keys = [data['client_key'] for data in sales]
+        existing = dict(
+            (sale.pos_client_key, sale.id) for sale in cls.search([
+                ('pos_client_key', 'in', keys),
+            ])
+        )
+
+        to_create = OrderedDict()
+        for data in sales:
+            key = data['client_key']
+            if key in existing or key in to_create:
+                continue
+            with Transaction().set_context(use_anonymous_customer=True):
+                party = Party(data.get('party') or cls.default_party())
+            invoice_address = data.get('invoice_address') or \
+                party.address_get(type='invoice')
+            shipment_address = data.get('shipment_address') or \
+                party.address_get(type='delivery')
+            values = {
+                'pos_client_key': key,
+                'party': party.id,
+                'invoice_address': int(invoice_address)
+                if invoice_address else None,
+                'shipment_address': int(shipment_address)
+                if shipment_address else None,
+                'comment': data.get('comment'),
+            }
+            if data.get('sale_date'):
+                values['sale_date'] = data['sale_date']
+            to_create[key] = (values, data['lines'])
+
+        new_sales = cls.create([
+            sale_values for sale_values, _ in to_create.values()
+        ])
+
+        lines_to_create = []
+        for sale, (_, lines) in zip(new_sales, to_create.values()):
+            for line in lines:
+                delivery_mode = line.get('delivery_mode') or 'pick_up'
+                if 'unit_price' in line and 'taxes' in line:
+                    # Priced on the terminal, skip the on_change methods
+                    product = Product(line['product'])
+                    vals_to_save = {
+                        'sale': sale.id,
+                        'type': 'line',
+                        'product': product.id,
+                        'quantity': line['quantity'],
+                        'unit': line.get('unit') or product.sale_uom.id,
+                        'unit_price': Decimal(str(line['unit_price'])),
+                        'description': (
+                            line.get('description') or product.rec_name
+                        ),
+                        'delivery_mode': delivery_mode,
+                    }
+                    taxes = line['taxes']
+                else:
+                    values = sale._pos_sale_line_values(
+                        line['product'], line['quantity'], delivery_mode
+                    )
+                    vals_to_save = cls._pos_sale_line_vals_to_save(values)
+                    taxes = values.get('taxes')
+                if taxes:
+                    vals_to_save['taxes'] = [('add', taxes)]
+                lines_to_create.append(vals_to_save)
+        if lines_to_create:
+            SaleLine.create(lines_to_create)
+
+        if new_sales and (confirm or process):
+            cls.quote(new_sales)
+            cls.confirm(new_sales)
+        if new_sales and process:
+            cls.pos_process_sales_chunk(new_sales)
+
+        created = dict((sale.pos_client_key, sale.id) for sale in new_sales)
+        result = []
+        for key in keys:
+            result.append({
+                'client_key': key,
+                'sale': existing.get(key) or created[key],
+                'created': created.pop(key, None) is not None,
+            })
+            existing.setdefault(key, result[-1]['sale'])
+        return result
+
+    @instrumented
+    def pos_checkout(self):
+        """
+        Quote, confirm and process the sale from POS in one call and return
+        the serialization of the sale for the receipt. The steps already
+        done are skipped, a cancelled sale can not be checked out.
+        """
+        self.pos_flush_cart()
+        sale = self.__class__(self.id)
+        if sale.state == 'draft':
+            self.quote([sale])
+            sale = self.__class__(self.id)
+        if sale.state == 'quotation':
+            self.confirm([sale])
+            sale = self.__class__(self.id)
+        if sale.state not in ('confirmed', 'processing', 'done'):
+            self.raise_user_error(
+                'pos_checkout_state', (sale.rec_name, sale.state)
+            )
+        self.pos_process_sales_chunk([sale])
+        return self.__class__(self.id).serialize('receipt')
+
+    @instrumented
     def pos_serialize(self):
         """
         Serialize sale for pos
+
+        If the client sends the revision of the sale it last saw as
+        `pos_revision` in the context, only the changes since that revision
+        are serialized. Otherwise the full sale is serialized.
+
+        The client could restrict the serialized fields by sending a
+        projection (list of dotted field paths like `lines.product.rec_name`)
+        as `pos_fields` in the context.
+
+        The cart session of the sale, if any, is flushed first.
         """
-        return self.serialize('pos')
+        self.pos_flush_cart()
+
+        context = Transaction().context
+        fields = context.get('pos_fields')
+        if context.get('pos_revision'):
+            return self.serialize_pos_changes(context['pos_revision'], fields)
+        return self.serialize('pos', fields)
 
-    def serialize(self, purpose=None):
+    @classmethod
+    @instrumented
+    def pos_serialize_many(cls, sale_ids):
         """
-        Serialize with information needed for POS
+        Serialize many sales for POS in one call, like `pos_serialize`
+        without revision, for a terminal resyncing its parked sales.
+
+        The fields of the sales and of their lines, products, units, parties
+        and addresses are read once for all the sales, so the number of
+        queries does not depend on the number of sales.
         """
         Address = Pool().get('party.address')
 
-        invoice_address = Address.search([
-            ('party', '=', self.party.id),
-            ('invoice', '=', True)
-        ], limit=1)
-
-        shipment_address = Address.search([
-            ('party', '=', self.party.id),
-            ('delivery', '=', True)
-        ], limit=1)
-
-        if purpose == 'pos':
-            invoice_address = self.invoice_address or \
-                invoice_address[0] if invoice_address else None
-            shipment_address = self.shipment_address or \
-                shipment_address[0] if shipment_address else None
-            return {
-                'party': self.party.id,
-                'total_amount': self.total_amount,
-                'untaxed_amount': self.untaxed_amount,
-                'tax_amount': self.tax_amount,
-                'comment': self.comment,
-                'state': self.state,
-                'invoice_address': invoice_address and
-                    invoice_address.serialize(purpose),
-                'shipment_address': shipment_address and
-                    shipment_address.serialize(purpose),
-                'lines': [line.serialize(purpose) for line in self.lines],
-            }
-        elif purpose == 'recent_sales':
-            return {
-                'id': self.id,
-                'party': {
-                    'id': self.party.id,
-                    'name': self.party.name,
-                },
-                'total_amount': self.total_amount,
-                'create_date': self.create_date,
-            }
+        sales = cls.browse(sale_ids)
+        for sale in sales:
+            sale.pos_flush_cart()
+
+        Address.pos_prefetch_default_addresses(
+            [sale.party for sale in sales if not sale.invoice_address],
+            'invoice'
+        )
+        Address.pos_prefetch_default_addresses(
+            [sale.party for sale in sales if not sale.shipment_address],
+            'delivery'
+        )
+        return serialize_records(
+            cls, sales, 'pos', Transaction().context.get('pos_fields')
+        )
+
+    @classmethod
+    def pos_export_sales(cls, shop_id, start_date, end_date, format='ndjson'):
+        """
+        Generate the export of the sales of the shop with a sale date between
+        the dates (included) in the format (ndjson or csv), serialized with
+        the `pos` serializers.
+
+        The sales are read in fixed size chunks following their ids and the
+        cache is emptied after each chunk, so that the memory used does not
+        depend on the number of sales. Each chunk is generated as a string.
+        """
+        SaleLine = Pool().get('sale.line')
+
+        if format not in FORMATS:
+            raise ValueError('Unknown export format "%s"' % format)
+
+        sale_fields = [
+            name for name in cls._serializers['pos'] if name != 'lines'
+        ]
+        line_fields = SaleLine._serializers['pos']
+        domain = [
+            ('shop', '=', shop_id),
+            ('sale_date', '>=', start_date),
+            ('sale_date', '<=', end_date),
+        ]
+        last_id = 0
+        header = True
+        while True:
+            sales = cls.search(
+                domain + [('id', '>', last_id)],
+                order=[('id', 'ASC')], limit=cls._pos_export_chunk_size
+            )
+            if not sales and not header:
+                break
+            records = serialize_records(cls, sales, 'pos')
+            if format == 'ndjson':
+                data = to_ndjson(records)
+            else:
+                data = to_csv(records, sale_fields, line_fields, header)
+            header = False
+            if data:
+                yield data
+            if len(sales) < cls._pos_export_chunk_size:
+                break
+            last_id = sales[-1].id
+            Transaction().cursor.cache.clear()
+
+    def get_pos_revision(self):
+        """
+        Return the revision of the sale as seen by the POS, which is the
+        latest write or create date of the sale and its lines.
+        """
+        return max(
+            record.write_date or record.create_date
+            for record in [self] + list(self.lines)
+        )
+
+    def get_pos_invoice_address(self):
+        """
+        Return the invoice address of the sale or else the default invoice
+        address of the party.
+        """
+        Address = Pool().get('party.address')
+
+        return self.invoice_address or \
+            Address.get_pos_default_address(self.party, 'invoice')
+
+    def get_pos_shipment_address(self):
+        """
+        Return the shipment address of the sale or else the default delivery
+        address of the party.
+        """
+        Address = Pool().get('party.address')
+
+        return self.shipment_address or \
+            Address.get_pos_default_address(self.party, 'delivery')
+
+    def serialize_pos_changes(self, revision, fields=None):
+        """
+        Serialize for pos only the lines which were created or updated since
+        the given revision along with the new totals.
+
+        The ids of all the lines are sent so that the client can drop the
+        lines which were removed since the revision. The changes could
+        include lines which were already sent (see `_pos_revision_overlap`).
+
+        :param revision: The revision returned by an earlier serialization
+        :param fields: Projection of the pos serialization
+        """
+        SaleLine = Pool().get('sale.line')
+
+        if fields is None:
+            fields = self._serializers['pos']
+        header_fields = [
+            path for path in fields if path.split('.', 1)[0] not in (
+                'lines', 'invoice_address', 'shipment_address'
+            )
+        ]
+        res = serialize_records(self.__class__, [self], 'pos', header_fields)[0]
+        res['revision'] = self.get_pos_revision()
+        res['line_ids'] = [line.id for line in self.lines]
+        if any(path.split('.', 1)[0] == 'lines' for path in fields):
+            since = revision - self._pos_revision_overlap
+            res['lines'] = serialize_records(SaleLine, [
+                line for line in self.lines
+                if (line.write_date or line.create_date) >= since
+            ], 'pos', sub_projection(fields, 'lines'))
+        return res
+
+    def serialize(self, purpose=None, fields=None):
+        """
+        Serialize with information needed for POS
+
+        :param purpose: Name of a serializer registered in `_serializers`
+        :param fields: Projection (list of dotted field paths) restricting
+                       the serialized fields
+        """
+        if purpose in self._serializers:
+            return serialize_records(
+                self.__class__, [self], purpose, fields
+            )[0]
         elif hasattr(super(Sale, self), 'serialize'):
-            return super(SaleLine, self).serialize(purpose)  # pragma: no cover
+            return super(Sale, self).serialize(purpose)  # pragma: no cover
 
     def _group_shipment_key(self, moves, move):
         """
@@ -264,9 +1622,23 @@ class Sale:
         """
         SaleLine = Pool().get('sale.line')
 
-        line = SaleLine(move[0])
+        delivery_modes = self._pos_delivery_modes_cache().get(self.id, {})
+        if move[0] in delivery_modes:
+            delivery_mode = delivery_modes[move[0]]
+        else:
+            delivery_mode = SaleLine(move[0]).delivery_mode
         rv = super(Sale, self)._group_shipment_key(moves, move)
-        return rv + (('delivery_mode', line.delivery_mode),)
+        return rv + (('delivery_mode', delivery_mode),)
+
+    @classmethod
+    def _pos_delivery_modes_cache(cls):
+        """
+        Return the cache of the delivery modes of the lines per sale, filled
+        by `create_shipment` for the current transaction.
+        """
+        return Transaction().cursor.cache.setdefault(
+            'pos.sale.delivery_modes', {}
+        )
 
     def create_shipment(self, shipment_type):
         """
@@ -274,11 +1646,25 @@ class Sale:
 
         This implementation inspects the order lines to look for lines which
         are expected to be picked up instantly and the shipment created for
-        pick_up is automatically processed all the way through.
+        pick_up is automatically processed all the way through, or left
+        pending for the fulfilment cron job if the shop defers it.
         """
         pool = Pool()
+        SaleLine = pool.get('sale.line')
 
-        shipments = super(Sale, self).create_shipment(shipment_type)
+        # Read the delivery modes of all the lines once for the grouping of
+        # the moves in shipments
+        cache = self._pos_delivery_modes_cache()
+        cache[self.id] = dict(
+            (line['id'], line['delivery_mode'])
+            for line in SaleLine.read(
+                map(int, self.lines), ['delivery_mode']
+            )
+        )
+        try:
+            shipments = super(Sale, self).create_shipment(shipment_type)
+        finally:
+            cache.pop(self.id, None)
 
         if self.shipment_method == 'manual':
             # shipments will be None but for future return the value
@@ -294,17 +1680,17 @@ class Sale:
 
         if shipment_type == 'out':
             Shipment = pool.get('stock.shipment.out')
-
-            with Transaction().set_user(0, set_context=True):
-                # Force assign and complete the shipments
-                Shipment.assign_force(picked_up_shipments)
-                Shipment.pack(picked_up_shipments)
-                Shipment.done(picked_up_shipments)
         elif shipment_type == 'return':
             Shipment = pool.get('stock.shipment.out.return')
+
+        if self.shop.pick_up_fulfilment == 'deferred':
+            # Leave the shipments to the fulfilment cron job
             with Transaction().set_user(0, set_context=True):
-                Shipment.receive(picked_up_shipments)
-                Shipment.done(picked_up_shipments)
+                Shipment.write(picked_up_shipments, {
+                    'pos_fulfilment_state': 'pending',
+                })
+        else:
+            Shipment.fulfil_pos_pick_up(picked_up_shipments)
 
         # Finally return the value the super function returned, but after
         # reloading the active records.
@@ -313,7 +1699,9 @@ class Sale:
     def create_invoice(self, invoice_type):
         """
         Sale creates draft invoices. But if the invoices are created from
-        shipments, then they should be automatically opened
+        shipments, then they should be automatically opened, unless
+        `pos_defer_invoice_post` is set in the context by a caller posting
+        them later (see `pos_process_sales_chunk`).
         """
         Invoice = Pool().get('account.invoice')
 
@@ -322,13 +1710,79 @@ class Sale:
         if not invoice:
             return invoice
 
-        if self.invoice_method == 'shipment' and invoice_type == 'out_invoice':
+        if self.invoice_method == 'shipment' and invoice_type == 'out_invoice' \
+                and not Transaction().context.get('pos_defer_invoice_post'):
             # Invoices created from shipment can be automatically opened
             # for payment.
             Invoice.post([invoice])
 
         return invoice
 
+    @classmethod
+    def pos_process_sales(cls, sales):
+        """
+        Process the sales in chunks, each chunk in its own transaction, and
+        post the invoices created from shipments with a single call per
+        chunk. The sales of a failing chunk are processed one by one so that
+        a failing sale does not hold back the others.
+
+        :param sales: List of active records of confirmed sales
+        :return: A list of dictionaries with the id of each sale which could
+                 not be processed and the error
+        """
+        failures = []
+        ids = map(int, sales)
+        size = cls._pos_process_chunk_size
+        for index in xrange(0, len(ids), size):
+            chunk = ids[index:index + size]
+            if cls._pos_process_sales_in_transaction(chunk) is None:
+                continue
+            for id_ in chunk:
+                error = cls._pos_process_sales_in_transaction([id_])
+                if error is not None:
+                    failures.append({'sale': id_, 'error': error})
+        return failures
+
+    @classmethod
+    def _pos_process_sales_in_transaction(cls, ids):
+        """
+        Process the sales in a new transaction and return the error message
+        if it failed
+        """
+        with Transaction().new_cursor() as txn:
+            try:
+                cls.pos_process_sales_chunk(cls.browse(ids))
+            except Exception, exception:
+                txn.cursor.rollback()
+                logger.exception('Processing of sales %s failed', ids)
+                if isinstance(exception, UserError):
+                    return exception.message
+                return unicode(exception)
+            else:
+                txn.cursor.commit()
+
+    @classmethod
+    def pos_process_sales_chunk(cls, sales):
+        """
+        Process the sales and post the draft invoices created from their
+        shipments with a single call to post.
+        """
+        Invoice = Pool().get('account.invoice')
+
+        with Transaction().set_context(pos_defer_invoice_post=True):
+            cls.process(sales)
+
+        invoices = [
+            invoice
+            for sale in cls.browse(map(int, sales))
+            if sale.invoice_method == 'shipment'
+            for invoice in sale.invoices
+            if invoice.type == 'out_invoice' and invoice.state == 'draft'
+        ]
+        if invoices:
+            Invoice.post(invoices)
+        return invoices
+
 
 class SaleLine:
     __name__ = 'sale.line'
@@ -340,49 +1794,134 @@ class SaleLine:
         'invisible': Eval('type') != 'line',
     }, depends=['type'], required=True)
 
+    # Columns of the indexes matching the search of the lines of a product
+    # in a sale from POS (see Sale.pos_sale_line_domain)
+    _pos_indexes = [
+        ['sale', 'product', 'delivery_mode'],
+    ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(SaleLine, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        for columns in cls._pos_indexes:
+            table.index_action(columns, 'add')
+
+    @classmethod
+    def __setup__(cls):
+        super(SaleLine, cls).__setup__()
+        cls._serializers = {
+            'pos': [
+                'id', 'description', 'product.id', 'product.code',
+                'product.rec_name', 'product.default_image', 'unit.id',
+                'unit.rec_name', 'unit_price', 'quantity', 'amount',
+                'delivery_mode',
+            ],
+            'receipt': [
+                'id', 'description', 'product.code', 'unit.symbol',
+                'unit_price', 'quantity', 'amount',
+            ],
+        }
+
     @staticmethod
     def default_delivery_mode():
         Shop = Pool().get('sale.shop')
-        User = Pool().get('res.user')
 
-        user = User(Transaction().user)
-        sale_shop = user.shop
-        if Transaction().context.get('current_sale_shop'):
-            sale_shop = Shop(Transaction().context.get('current_sale_shop'))
-        return sale_shop and sale_shop.delivery_mode
+        shop_id = Transaction().context.get('current_sale_shop') or \
+            Shop.get_pos_user_shop(Transaction().user)
+        if shop_id:
+            return Shop.get_pos_settings(shop_id)['delivery_mode']
+
+    @classmethod
+    def create(cls, vlist):
+        Sale = Pool().get('sale.sale')
+
+        lines = super(SaleLine, cls).create(vlist)
+        if any(
+            Sale._pos_line_index_cache.get(values.get('sale')) is not None
+            for values in vlist
+        ):
+            Sale._pos_index_lines(lines)
+        if not Transaction().context.get('pos_totals_delta'):
+            Sale.clear_pos_totals(
+                set(values['sale'] for values in vlist if values.get('sale'))
+            )
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        Sale = Pool().get('sale.sale')
+
+        # Only the changes of these fields move the lines in the line index
+        # of the sales
+        sale_ids, changed_sale_ids = set(), set()
+        actions = iter(args)
+        for lines, values in zip(actions, actions):
+            ids = set(line.sale.id for line in lines)
+            if values.get('sale'):
+                ids.add(values['sale'])
+            if any(cls._pos_index_key_changed(line, values) for line in lines):
+                sale_ids.update(ids)
+            changed_sale_ids.update(ids)
+        super(SaleLine, cls).write(*args)
+        Sale._pos_forget_line_index(sale_ids)
+        if not Transaction().context.get('pos_totals_delta'):
+            Sale.clear_pos_totals(changed_sale_ids)
+
+    @staticmethod
+    def _pos_index_key_changed(line, values):
+        """
+        Return True if the values change the sale, the product or the
+        delivery mode of the line, which move it in the line index
+        """
+        current = {
+            'sale': line.sale.id,
+            'product': line.product and line.product.id,
+            'delivery_mode': line.delivery_mode,
+        }
+        return any(
+            values[name] != value for name, value in current.iteritems()
+            if name in values
+        )
+
+    @classmethod
+    def delete(cls, lines):
+        Sale = Pool().get('sale.sale')
+
+        sale_ids = set(line.sale.id for line in lines)
+        super(SaleLine, cls).delete(lines)
+        Sale._pos_forget_line_index(sale_ids)
+        if not Transaction().context.get('pos_totals_delta'):
+            Sale.clear_pos_totals(sale_ids)
 
     def get_warehouse(self, name):
         """
         Return the warehouse from the shop for orders being picked up and the
         backorder warehouse for orders with ship.
         """
+        Shop = Pool().get('sale.shop')
+
         if self.delivery_mode == 'ship':
-            return self.sale.shop.ship_from_warehouse.id
+            return Shop.get_pos_settings(
+                self.sale.shop.id
+            )['ship_from_warehouse']
         return super(SaleLine, self).get_warehouse(name)
 
-    def serialize(self, purpose=None):
+    def serialize(self, purpose=None, fields=None):
         """
         Serialize for the purpose of POS
+
+        :param purpose: Name of a serializer registered in `_serializers`
+        :param fields: Projection (list of dotted field paths) restricting
+                       the serialized fields
         """
-        if purpose == 'pos':
-            return {
-                'id': self.id,
-                'description': self.description,
-                'product': {
-                    'id': self.product.id,
-                    'code': self.product.code,
-                    'rec_name': self.product.rec_name,
-                    'default_image': self.product.default_image and
-                                    self.product.default_image.id,
-                },
-                'unit': {
-                    'id': self.unit.id,
-                    'rec_name': self.unit.rec_name,
-                },
-                'unit_price': self.unit_price,
-                'quantity': self.quantity,
-                'amount': self.amount,
-                'delivery_mode': self.delivery_mode
-            }
+        if purpose in self._serializers:
+            return serialize_records(
+                self.__class__, [self], purpose, fields
+            )[0]
         elif hasattr(super(SaleLine, self), 'serialize'):
             return super(SaleLine, self).serialize(purpose)  # pragma: no cover
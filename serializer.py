@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+    serializer.py
+
+    Serialization of records from the named serializers registered on the
+    models and restricted by a field projection.
+
+    Models which could be serialized declare in the `_serializers` class
+    attribute (filled in `__setup__` so that other modules could extend it)
+    the list of field paths serialized for each purpose, for example::
+
+        cls._serializers['pos'] = ['id', 'party.name', 'lines']
+
+    Relational fields are serialized as dictionaries holding the id and the
+    fields of the sub paths. If no sub path is given, the serializer of the
+    same purpose of the target model is used if there is one, otherwise only
+    the id is returned.
+
+    Values which are not fields can be computed by the instance methods named
+    in the `_serializer_getters` class attribute.
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from collections import OrderedDict
+
+from trytond.model import Model
+from trytond.pool import Pool
+
+__all__ = ['projection_tree', 'sub_projection', 'serialize_records']
+
+RELATIONAL_TYPES = ('many2one', 'one2one', 'one2many', 'many2many')
+
+
+def projection_tree(fields):
+    """
+    Return a tree of nested dictionaries from a list of dotted field paths
+    """
+    tree = OrderedDict()
+    for path in fields:
+        node = tree
+        for name in path.split('.'):
+            node = node.setdefault(name, OrderedDict())
+    return tree
+
+
+def sub_projection(fields, name):
+    """
+    Return the paths of the projection under the field name, or None if the
+    field is projected without sub paths.
+    """
+    prefix = name + '.'
+    return [
+        path[len(prefix):] for path in fields if path.startswith(prefix)
+    ] or None
+
+
+def serialize_records(model, records, purpose, fields=None):
+    """
+    Serialize the records with the serializer registered for the purpose.
+
+    :param model: The model (class) of the records
+    :param records: List of active records
+    :param purpose: Name of the serializer
+    :param fields: A projection as a list of dotted field paths restricting
+                   what is serialized. Defaults to the fields of the
+                   serializer.
+    :return: A list of dictionaries in the order of the records
+    """
+    if fields is None:
+        fields = model._serializers[purpose]
+    return _serialize(model, records, purpose, projection_tree(fields))
+
+
+def _serializer_tree(model, purpose):
+    """
+    Return the projection tree of the serializer of the model for the purpose
+    or None if the model does not have such serializer.
+    """
+    fields = getattr(model, '_serializers', {}).get(purpose)
+    if fields is None:
+        return None
+    return projection_tree(fields)
+
+
+def _serialize(model, records, purpose, tree):
+    """
+    Serialize the records for the projection tree. The fields of all the
+    records are read together and the related records are serialized in a
+    single pass per relational field.
+    """
+    pool = Pool()
+    getters = getattr(model, '_serializer_getters', {})
+    ids = [record.id for record in records]
+
+    for name in tree:
+        if name not in getters and name not in model._fields:
+            raise ValueError(
+                'Unknown field "%s" for "%s"' % (name, model.__name__)
+            )
+
+    read_fields = [
+        name for name in tree if name not in getters and name != 'id'
+    ]
+    rows = {}
+    if read_fields and ids:
+        rows = dict((row['id'], row) for row in model.read(ids, read_fields))
+    result = [{'id': id_} for id_ in ids]
+
+    for name, subtree in tree.iteritems():
+        if name == 'id':
+            continue
+        target = None
+        if name in getters:
+            values = []
+            for record in records:
+                value = getattr(record, getters[name])()
+                if isinstance(value, Model):
+                    target = pool.get(value.__name__)
+                    value = value.id
+                elif isinstance(value, (list, tuple)) and value and \
+                        isinstance(value[0], Model):
+                    target = pool.get(value[0].__name__)
+                    value = [v.id for v in value]
+                values.append(value)
+        else:
+            values = [rows[id_][name] for id_ in ids]
+            field = model._fields[name]
+            if field._type in RELATIONAL_TYPES:
+                target = field.get_target()
+
+        if target is not None:
+            values = _serialize_related(target, values, purpose, subtree)
+        for data, value in zip(result, values):
+            data[name] = value
+    return result
+
+
+def _serialize_related(target, values, purpose, subtree):
+    """
+    Replace the ids in values by the serialization of the target records
+    """
+    tree = subtree or _serializer_tree(target, purpose)
+    if not tree:
+        return values
+
+    target_ids = set()
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            target_ids.update(value)
+        elif value is not None:
+            target_ids.add(value)
+    target_ids = list(target_ids)
+    serialized = dict(zip(
+        target_ids,
+        _serialize(target, target.browse(target_ids), purpose, tree)
+    ))
+
+    def convert(value):
+        if isinstance(value, (list, tuple)):
+            return [serialized[id_] for id_ in value]
+        elif value is not None:
+            return serialized[value]
+    return map(convert, values)
@@ -70,6 +70,67 @@ class PostgresTest(Command):
         sys.exit(-1)
 
 
+class SQLiteBenchmark(Command):
+    """
+    Run the benchmarks of the POS entry points on SQLite
+    """
+    description = "Run benchmarks on SQLite"
+
+    user_options = [
+        ('sales=', None, 'Number of sales to create'),
+        ('lines=', None, 'Number of lines per sale'),
+        ('products=', None, 'Number of products to create'),
+        ('repeat=', None, 'Number of calls per entry point'),
+        ('json', None, 'Print the results as JSON'),
+        ('plans', None, 'Print the query plans with and without the indexes'),
+    ]
+    boolean_options = ['json', 'plans']
+
+    def initialize_options(self):
+        self.sales = 20
+        self.lines = 20
+        self.products = 10
+        self.repeat = 10
+        self.json = False
+        self.plans = False
+
+    def finalize_options(self):
+        self.sales = int(self.sales)
+        self.lines = int(self.lines)
+        self.products = int(self.products)
+        self.repeat = int(self.repeat)
+
+    def setup_database(self):
+        from trytond.config import CONFIG
+        CONFIG['db_type'] = 'sqlite'
+        os.environ['DB_NAME'] = ':memory:'
+
+    def run(self):
+        self.setup_database()
+
+        from tests.benchmark import run
+        run(
+            self.sales, self.lines, self.products, self.repeat,
+            as_json=self.json, plans=self.plans
+        )
+
+
+class PostgresBenchmark(SQLiteBenchmark):
+    """
+    Run the benchmarks of the POS entry points on Postgres
+    """
+    description = "Run benchmarks on Postgresql"
+
+    def setup_database(self):
+        from trytond.config import CONFIG
+        CONFIG['db_type'] = 'postgresql'
+        CONFIG['db_host'] = 'localhost'
+        CONFIG['db_port'] = 5432
+        CONFIG['db_user'] = 'postgres'
+
+        os.environ['DB_NAME'] = 'benchmark_' + str(int(time.time()))
+
+
 config = ConfigParser.ConfigParser()
 config.readfp(open('tryton.cfg'))
 info = dict(config.items('tryton'))
@@ -144,5 +205,7 @@ setup(
     cmdclass={
         'test': SQLiteTest,
         'test_on_postgres': PostgresTest,
+        'benchmark': SQLiteBenchmark,
+        'benchmark_on_postgres': PostgresBenchmark,
     }
 )
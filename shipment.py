@@ -5,14 +5,118 @@
     :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import logging
+import traceback
+from itertools import groupby
+
 from trytond.model import fields
 from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
 
 __metaclass__ = PoolMeta
 __all__ = ['ShipmentOut', 'ShipmentOutReturn']
 
+logger = logging.getLogger('pos.fulfilment')
+
+
+class POSFulfilmentMixin(object):
+    """
+    Fulfilment of the shipments of goods picked up at the POS.
+
+    Shops with a deferred pick up fulfilment leave the shipments pending at
+    checkout and a cron job fulfils them later in batches with the
+    `fulfil_pos_pick_up` method of the shipment model.
+    """
+    _pos_fulfilment_batch_size = 50
+    _pos_fulfilment_max_attempts = 3
+
+    pos_fulfilment_state = fields.Selection([
+        (None, ''),
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'POS Fulfilment State', readonly=True)
+    pos_fulfilment_attempts = fields.Integer(
+        'POS Fulfilment Attempts', readonly=True
+    )
+    pos_fulfilment_error = fields.Text('POS Fulfilment Error', readonly=True)
+
+    @staticmethod
+    def default_pos_fulfilment_attempts():
+        return 0
+
+    @classmethod
+    def process_pos_fulfilment(cls):
+        """
+        Fulfil the pending pick up shipments in batches per company, each
+        batch in its own transaction. The shipments of a failing batch of
+        several shipments are retried one by one so that a failing shipment
+        does not hold back the others.
+        """
+        with Transaction().set_user(0, set_context=True):
+            shipments = cls.search([
+                ('pos_fulfilment_state', '=', 'pending'),
+            ], order=[('company', 'ASC'), ('id', 'ASC')])
+
+            size = cls._pos_fulfilment_batch_size
+            for company, shipments in groupby(shipments, lambda s: s.company):
+                ids = map(int, shipments)
+                with Transaction().set_context(company=company.id):
+                    for index in xrange(0, len(ids), size):
+                        batch = ids[index:index + size]
+                        if not cls._process_pos_fulfilment_batch(batch) \
+                                and len(batch) > 1:
+                            for id_ in batch:
+                                cls._process_pos_fulfilment_batch([id_])
+
+    @classmethod
+    def _process_pos_fulfilment_batch(cls, ids):
+        """
+        Fulfil the shipments in a new transaction and return if it succeeded.
+        A failure of a single shipment is recorded on it and the shipment is
+        marked as failed after `_pos_fulfilment_max_attempts` attempts.
+        """
+        with Transaction().new_cursor() as txn:
+            try:
+                shipments = cls.browse(ids)
+                cls.fulfil_pos_pick_up(shipments)
+                cls.write(shipments, {'pos_fulfilment_state': 'done'})
+            except Exception:
+                txn.cursor.rollback()
+                logger.exception(
+                    'Fulfilment of %s %s failed', cls.__name__, ids
+                )
+                if len(ids) == 1:
+                    cls._record_pos_fulfilment_failure(
+                        ids[0], traceback.format_exc()
+                    )
+                return False
+            else:
+                txn.cursor.commit()
+                return True
+
+    @classmethod
+    def _record_pos_fulfilment_failure(cls, id_, error):
+        """
+        Record the failed attempt to fulfil the shipment
+        """
+        with Transaction().new_cursor() as txn:
+            shipment = cls(id_)
+            values = {
+                'pos_fulfilment_attempts': (
+                    shipment.pos_fulfilment_attempts or 0
+                ) + 1,
+                'pos_fulfilment_error': error,
+            }
+            if values['pos_fulfilment_attempts'] >= \
+                    cls._pos_fulfilment_max_attempts:
+                values['pos_fulfilment_state'] = 'failed'
+            cls.write([shipment], values)
+            txn.cursor.commit()
 
-class ShipmentOut:
+
+class ShipmentOut(POSFulfilmentMixin):
+    __metaclass__ = PoolMeta
     __name__ = 'stock.shipment.out'
 
     delivery_mode = fields.Selection([
@@ -24,8 +128,19 @@ class ShipmentOut:
     def default_delivery_mode():
         return 'ship'
 
+    @classmethod
+    def fulfil_pos_pick_up(cls, shipments):
+        """
+        Force assign and complete the shipments
+        """
+        with Transaction().set_user(0, set_context=True):
+            cls.assign_force(shipments)
+            cls.pack(shipments)
+            cls.done(shipments)
+
 
-class ShipmentOutReturn:
+class ShipmentOutReturn(POSFulfilmentMixin):
+    __metaclass__ = PoolMeta
     __name__ = 'stock.shipment.out.return'
 
     # XXX: Not sure if pick_up is the right word here ?
@@ -42,3 +157,12 @@ class ShipmentOutReturn:
     @staticmethod
     def default_delivery_mode():
         return 'ship'
+
+    @classmethod
+    def fulfil_pos_pick_up(cls, shipments):
+        """
+        Receive and complete the returned shipments
+        """
+        with Transaction().set_user(0, set_context=True):
+            cls.receive(shipments)
+            cls.done(shipments)
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+    summary.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from decimal import Decimal
+
+from trytond.model import ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.rpc import RPC
+
+__all__ = ['POSSummary']
+
+_ZERO = Decimal('0')
+
+
+class POSSummary(ModelSQL):
+    """
+    Totals of the POS sales of a shop per day.
+
+    For each shop, day and currency there is a row with the totals of all
+    the sales (dimension `total`) and rows with the totals per delivery mode,
+    tax and payment term. The processed sales are added to the rows by a
+    cron (see `add_pending_sales`), not by the processing, so that the
+    concurrent checkouts of a shop do not update the same rows. The Z-report
+    reads the rows and only the sales processed since the last run.
+    """
+    __name__ = 'sale.shop.pos_summary'
+
+    # Number of sales read at once by rebuild
+    _rebuild_chunk_size = 500
+
+    shop = fields.Many2One(
+        'sale.shop', 'Shop', required=True, select=True, ondelete='CASCADE'
+    )
+    date = fields.Date('Date', required=True, select=True)
+    currency = fields.Many2One('currency.currency', 'Currency', required=True)
+    dimension = fields.Selection([
+        ('total', 'Total'),
+        ('delivery_mode', 'Delivery Mode'),
+        ('tax', 'Tax'),
+        ('payment_term', 'Payment Term'),
+    ], 'Dimension', required=True)
+    # Value of the dimension as a string, part of the unique key of the row
+    key = fields.Char('Key', required=True)
+    delivery_mode = fields.Selection([
+        (None, ''),
+        ('pick_up', 'Pick Up'),
+        ('ship', 'Ship'),
+    ], 'Delivery Mode')
+    tax = fields.Many2One('account.tax', 'Tax')
+    payment_term = fields.Many2One(
+        'account.invoice.payment_term', 'Payment Term'
+    )
+    sale_count = fields.Integer('Sales', required=True)
+    # For the taxes, the untaxed amount is the base of the tax
+    untaxed_amount = fields.Numeric('Untaxed Amount', required=True)
+    tax_amount = fields.Numeric('Tax Amount', required=True)
+    total_amount = fields.Numeric('Total Amount', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(POSSummary, cls).__setup__()
+        cls.__rpc__.update({
+            'get_z_report': RPC(readonly=True),
+            'rebuild': RPC(readonly=False),
+        })
+        cls._error_messages.update({
+            'rebuild_access_denied': (
+                'Only the administrators can rebuild the POS summaries.'
+            ),
+        })
+        cls._sql_constraints += [
+            (
+                'key_uniq', 'UNIQUE(shop, date, currency, dimension, key)',
+                'There can be only one POS summary per shop, day, currency '
+                'and dimension.'
+            ),
+        ]
+
+    @classmethod
+    def _get_sale_summaries(cls, sales):
+        """
+        Return the totals of the sales per row, as a dictionary with the
+        (shop, date, currency, dimension, key) of the rows as keys.
+        """
+        Tax = Pool().get('account.tax')
+
+        summaries = {}
+
+        def add(sale, dimension, key, values, untaxed_amount, tax_amount):
+            row_key = (
+                sale.shop.id, sale.sale_date, sale.currency.id, dimension,
+                key,
+            )
+            summary = summaries.get(row_key)
+            if summary is None:
+                summary = summaries[row_key] = dict(
+                    values, sale_count=0, untaxed_amount=_ZERO,
+                    tax_amount=_ZERO, total_amount=_ZERO,
+                )
+            summary['sale_count'] += 1
+            summary['untaxed_amount'] += untaxed_amount
+            summary['tax_amount'] += tax_amount
+            summary['total_amount'] += untaxed_amount + tax_amount
+
+        for sale in sales:
+            currency = sale.currency
+            add(
+                sale, 'total', 'total', {}, sale.untaxed_amount,
+                sale.tax_amount
+            )
+            if sale.payment_term:
+                add(
+                    sale, 'payment_term', str(sale.payment_term.id),
+                    {'payment_term': sale.payment_term.id},
+                    sale.untaxed_amount, sale.tax_amount
+                )
+
+            # Like the tax amount of the sale, the amounts are only rounded
+            # once summed
+            by_delivery_mode, by_tax = {}, {}
+            with Transaction().set_context(sale.get_tax_context()):
+                for line in sale.lines:
+                    if line.type != 'line':
+                        continue
+                    amounts = by_delivery_mode.setdefault(
+                        line.delivery_mode, [_ZERO, _ZERO]
+                    )
+                    amounts[0] += line.amount
+                    for tax in Tax.compute(
+                            line.taxes, line.unit_price, line.quantity):
+                        amounts[1] += tax['amount']
+                        tax_amounts = by_tax.setdefault(
+                            tax['tax'].id, [_ZERO, _ZERO]
+                        )
+                        tax_amounts[0] += tax['base']
+                        tax_amounts[1] += tax['amount']
+            for delivery_mode, amounts in by_delivery_mode.iteritems():
+                add(
+                    sale, 'delivery_mode', delivery_mode,
+                    {'delivery_mode': delivery_mode},
+                    currency.round(amounts[0]), currency.round(amounts[1])
+                )
+            for tax_id, amounts in by_tax.iteritems():
+                add(
+                    sale, 'tax', str(tax_id), {'tax': tax_id},
+                    currency.round(amounts[0]), currency.round(amounts[1])
+                )
+        return summaries
+
+    @staticmethod
+    def _pending_sales_domain():
+        """
+        Return the domain of the processed sales which are not summarized
+        yet
+        """
+        return [
+            ('state', 'in', ['processing', 'done']),
+            ('shop', '!=', None),
+            ('pos_summarized', '=', False),
+        ]
+
+    @classmethod
+    def add_pending_sales(cls):
+        """
+        Add the processed sales which are not summarized yet to the totals
+        of their shop and day, for the cron.
+        """
+        Sale = Pool().get('sale.sale')
+
+        with Transaction().set_user(0, set_context=True):
+            sale_ids = map(int, Sale.search(
+                cls._pending_sales_domain(), order=[('id', 'ASC')]
+            ))
+            size = cls._rebuild_chunk_size
+            for index in xrange(0, len(sale_ids), size):
+                cls.add_sales(Sale.browse(sale_ids[index:index + size]))
+                # Do not keep the records of all the sales in the cache
+                Transaction().cursor.cache.clear()
+
+    @classmethod
+    def add_sales(cls, sales):
+        """
+        Add the processed sales which are not summarized yet to the totals
+        of their shop and day.
+        """
+        Sale = Pool().get('sale.sale')
+
+        sales = [
+            sale for sale in sales
+            if sale.state in ('processing', 'done') and sale.shop and
+            not sale.pos_summarized
+        ]
+        if not sales:
+            return
+
+        with Transaction().set_user(0, set_context=True):
+            # The rows are looked up then created, so the cron and the
+            # rebuild must not run concurrently
+            Transaction().cursor.lock(cls._table)
+            summaries = cls._get_sale_summaries(sales)
+            existing = dict(
+                (cls._row_key(summary), summary)
+                for summary in cls.search([
+                    ('shop', 'in', list(set(k[0] for k in summaries))),
+                    ('date', 'in', list(set(k[1] for k in summaries))),
+                ])
+            )
+
+            table = cls.__table__()
+            cursor = Transaction().cursor
+            to_create = []
+            for row_key, values in summaries.iteritems():
+                summary = existing.get(row_key)
+                if summary is None:
+                    to_create.append(cls._row_values(row_key, values))
+                    continue
+                cursor.execute(*table.update(
+                    columns=[
+                        table.sale_count, table.untaxed_amount,
+                        table.tax_amount, table.total_amount,
+                    ],
+                    values=[
+                        table.sale_count + values['sale_count'],
+                        table.untaxed_amount + values['untaxed_amount'],
+                        table.tax_amount + values['tax_amount'],
+                        table.total_amount + values['total_amount'],
+                    ],
+                    where=table.id == summary.id
+                ))
+            if to_create:
+                cls.create(to_create)
+            Sale.write(sales, {'pos_summarized': True})
+
+    @staticmethod
+    def _row_key(summary):
+        """
+        Return the key of the summary row as used by _get_sale_summaries
+        """
+        return (
+            summary.shop.id, summary.date, summary.currency.id,
+            summary.dimension, summary.key,
+        )
+
+    @staticmethod
+    def _row_values(row_key, values):
+        """
+        Return the values to create the row of the key with the totals
+        """
+        shop, date, currency, dimension, key = row_key
+        values = values.copy()
+        values.update({
+            'shop': shop,
+            'date': date,
+            'currency': currency,
+            'dimension': dimension,
+            'key': key,
+        })
+        return values
+
+    @classmethod
+    def rebuild(cls, shop_ids=None, start_date=None, end_date=None):
+        """
+        Recompute the totals of the shops (all if None) between the dates
+        (included, unbounded if None) from the processed sales, for the
+        backfill of existing sales or after the sales have been corrected.
+        Only the administrators can rebuild the summaries.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        ModelData = pool.get('ir.model.data')
+        User = pool.get('res.user')
+
+        if Transaction().user != 0 and (
+                ModelData.get_id('res', 'group_admin')
+                not in User.get_groups()):
+            cls.raise_user_error('rebuild_access_denied')
+
+        domain = [('state', 'in', ['processing', 'done'])]
+        summary_domain = []
+        if shop_ids is not None:
+            domain.append(('shop', 'in', shop_ids))
+            summary_domain.append(('shop', 'in', shop_ids))
+        if start_date is not None:
+            domain.append(('sale_date', '>=', start_date))
+            summary_domain.append(('date', '>=', start_date))
+        if end_date is not None:
+            domain.append(('sale_date', '<=', end_date))
+            summary_domain.append(('date', '<=', end_date))
+
+        with Transaction().set_user(0, set_context=True):
+            Transaction().cursor.lock(cls._table)
+            cls.delete(cls.search(summary_domain))
+            sale_ids = map(int, Sale.search(domain, order=[('id', 'ASC')]))
+
+            summaries = {}
+            size = cls._rebuild_chunk_size
+            for index in xrange(0, len(sale_ids), size):
+                sales = Sale.browse(sale_ids[index:index + size])
+                for row_key, values in cls._get_sale_summaries(
+                        sales).iteritems():
+                    summary = summaries.setdefault(row_key, dict(
+                        values, sale_count=0, untaxed_amount=_ZERO,
+                        tax_amount=_ZERO, total_amount=_ZERO,
+                    ))
+                    for name in (
+                            'sale_count', 'untaxed_amount', 'tax_amount',
+                            'total_amount'):
+                        summary[name] += values[name]
+                Sale.write(sales, {'pos_summarized': True})
+                # Do not keep the records of all the sales in the cache
+                Transaction().cursor.cache.clear()
+
+            cls.create([
+                cls._row_values(row_key, values)
+                for row_key, values in summaries.iteritems()
+            ])
+
+    @classmethod
+    def get_z_report(cls, shop_id, start_date, end_date):
+        """
+        Return the Z-report of the shop between the dates (included): the
+        totals of the sales, per day, per delivery mode, per tax and per
+        payment term, computed from the summaries and the sales processed
+        since the last run of the cron.
+
+        Each total has the currency, the number of sales and the untaxed, tax
+        and total amounts. For the taxes, the untaxed amount is the base.
+        """
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Currency = pool.get('currency.currency')
+        Tax = pool.get('account.tax')
+        PaymentTerm = pool.get('account.invoice.payment_term')
+
+        def add(rows, row_key, values):
+            row = rows.setdefault(row_key, [0, _ZERO, _ZERO, _ZERO])
+            for index, value in enumerate(values):
+                row[index] += value
+
+        # Sale count and amounts by (date, currency, dimension, key)
+        rows = {}
+
+        table = cls.__table__()
+        cursor = Transaction().cursor
+        cursor.execute(*table.select(
+            table.date, table.currency, table.dimension, table.key,
+            table.sale_count, table.untaxed_amount, table.tax_amount,
+            table.total_amount,
+            where=(
+                (table.shop == shop_id) &
+                (table.date >= start_date) & (table.date <= end_date)
+            )
+        ))
+        for row in cursor.fetchall():
+            # SQLite may return the numerics as floats
+            add(rows, tuple(row[:4]), [int(row[4])] + [
+                Decimal(str(amount)) for amount in row[5:]
+            ])
+
+        with Transaction().set_user(0, set_context=True):
+            pending = Sale.search(cls._pending_sales_domain() + [
+                ('shop', '=', shop_id),
+                ('sale_date', '>=', start_date),
+                ('sale_date', '<=', end_date),
+            ])
+            for row_key, values in cls._get_sale_summaries(
+                    pending).iteritems():
+                _, date, currency, dimension, key = row_key
+                add(rows, (date, currency, dimension, key), [
+                    values['sale_count'], values['untaxed_amount'],
+                    values['tax_amount'], values['total_amount'],
+                ])
+
+        def totals(currency_id, row):
+            currency = Currency(currency_id)
+            return {
+                'currency': currency.id,
+                'sale_count': row[0],
+                'untaxed_amount': currency.round(row[1]),
+                'tax_amount': currency.round(row[2]),
+                'total_amount': currency.round(row[3]),
+            }
+
+        by_dimension, by_day = {}, {}
+        for (date, currency, dimension, key), row in rows.iteritems():
+            add(by_dimension, (dimension, key, currency), row)
+            if dimension == 'total':
+                add(by_day, (date, currency), row)
+
+        report = {
+            'shop': shop_id,
+            'start_date': start_date,
+            'end_date': end_date,
+            'totals': [],
+            'delivery_modes': [],
+            'taxes': [],
+            'payment_terms': [],
+            'days': [],
+        }
+        for (dimension, key, currency), row in sorted(
+                by_dimension.iteritems()):
+            values = totals(currency, row)
+            if dimension == 'total':
+                report['totals'].append(values)
+            elif dimension == 'delivery_mode':
+                values['delivery_mode'] = key
+                report['delivery_modes'].append(values)
+            elif dimension == 'tax':
+                tax = Tax(int(key))
+                values['tax'] = {
+                    'id': tax.id,
+                    'name': tax.rec_name,
+                }
+                report['taxes'].append(values)
+            elif dimension == 'payment_term':
+                payment_term = PaymentTerm(int(key))
+                values['payment_term'] = {
+                    'id': payment_term.id,
+                    'name': payment_term.rec_name,
+                }
+                report['payment_terms'].append(values)
+        for (date, currency), row in sorted(by_day.iteritems()):
+            values = totals(currency, row)
+            values['date'] = date
+            report['days'].append(values)
+        return report
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+    tax.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.pool import Pool, PoolMeta
+from trytond.transaction import Transaction
+
+from product import ClearPOSPriceCacheMixin
+
+__all__ = ['Tax', 'TaxRule', 'TaxRuleLine']
+
+
+class Tax(ClearPOSPriceCacheMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'account.tax'
+
+    @classmethod
+    def clear_pos_totals(cls):
+        """
+        Stop using the stored totals of the drafts, whose tax amounts were
+        computed with the previous definition of the taxes
+        """
+        Sale = Pool().get('sale.sale')
+
+        with Transaction().set_user(0, set_context=True):
+            sales = Sale.search([
+                ('state', '=', 'draft'),
+                ('pos_totals', '!=', None),
+            ])
+            if sales:
+                Sale.write(sales, {'pos_totals': None})
+
+    @classmethod
+    def create(cls, vlist):
+        cls.clear_pos_totals()
+        return super(Tax, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls.clear_pos_totals()
+        return super(Tax, cls).write(*args)
+
+    @classmethod
+    def delete(cls, taxes):
+        cls.clear_pos_totals()
+        return super(Tax, cls).delete(taxes)
+
+
+class TaxRule(ClearPOSPriceCacheMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'account.tax.rule'
+
+
+class TaxRuleLine(ClearPOSPriceCacheMixin):
+    __metaclass__ = PoolMeta
+    __name__ = 'account.tax.rule.line'
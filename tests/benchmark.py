@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+    tests/benchmark.py
+
+    Benchmarks of the POS RPC entry points.
+
+    The shop is seeded with the fixtures of the sale tests and each entry
+    point is called repeatedly, each call starting with an empty record cache
+    like a new RPC would. The latency percentiles, the number of SQL queries
+    and of records instantiated are reported per entry point.
+
+    With the plans option, the plans of the queries of the POS access paths
+    are reported with and without the indexes created by the module.
+
+    Run with `python setup.py benchmark` (SQLite) or
+    `python setup.py benchmark_on_postgres`.
+
+    :copyright: (C) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(
+    __file__, '..', '..', '..', '..', '..', 'trytond'
+)))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+import json
+from decimal import Decimal
+
+from trytond import backend
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond.config import CONFIG
+from trytond.modules.pos.instrumentation import Measurement
+
+from tests.test_sale import TestSale
+
+
+def percentile(values, percent):
+    """
+    Return the percentile of the sorted values (nearest rank)
+    """
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+class Benchmark(TestSale):
+    '''
+    Benchmark of the POS entry points using the fixtures of the sale tests
+    '''
+
+    def runTest(self):
+        pass  # pragma: no cover
+
+    def seed(self, sales, lines, products):
+        """
+        Create draft POS sales with lines of products in the shop
+        """
+        templates = self._create_product_template('benchmark', [{
+            'category': self.category.id,
+            'type': 'goods',
+            'salable': True,
+            'list_price': Decimal('10'),
+            'cost_price': Decimal('5'),
+            'account_expense': self._get_account_by_kind('expense').id,
+            'account_revenue': self._get_account_by_kind('revenue').id,
+        } for index in range(products)])
+        self.products = [template.products[0] for template in templates]
+
+        with Transaction().set_context(use_anonymous_customer=True):
+            self.sales = self.Sale.create([{
+                'currency': self.usd.id,
+                'shop': self.shop.id,
+                'invoice_address': self.address.id,
+                'shipment_address': self.address.id,
+            } for index in range(sales)])
+        for sale in self.sales:
+            sale.pos_add_products([{
+                'product': self.products[index % products].id,
+                'quantity': 1,
+                'delivery_mode': ('pick_up', 'ship')[index // products % 2],
+            } for index in range(lines)])
+
+    def measure(self, func, repeat):
+        """
+        Call func repeat times and return the statistics of the calls
+        """
+        timings, queries, sql_timings, records = [], [], [], []
+        for index in range(repeat):
+            # Each RPC starts a new transaction with an empty record cache
+            Transaction().cursor.cache.clear()
+            with Measurement() as measurement:
+                func(index)
+            timings.append(measurement.wall_time)
+            queries.append(measurement.queries)
+            sql_timings.append(measurement.sql_time)
+            records.append(measurement.records)
+
+        timings.sort()
+        return {
+            'calls': repeat,
+            'mean': sum(timings) / repeat,
+            'p50': percentile(timings, 50),
+            'p90': percentile(timings, 90),
+            'p99': percentile(timings, 99),
+            'max': timings[-1],
+            'queries': float(sum(queries)) / repeat,
+            'sql_time': sum(sql_timings) / repeat,
+            'records': float(sum(records)) / repeat,
+        }
+
+    def run_benchmarks(self, sales, lines, products, repeat):
+        """
+        Seed the shop and benchmark the POS entry points
+        """
+        results = {}
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                self.seed(sales, lines, products)
+                sale = self.sales[0]
+
+                results['pos_add_product'] = self.measure(
+                    lambda index: sale.pos_add_product(
+                        self.products[index % products].id, index + 2
+                    ), repeat
+                )
+                results['pos_serialize'] = self.measure(
+                    lambda index: self.Sale(sale.id).pos_serialize(), repeat
+                )
+                results['get_recent_sales'] = self.measure(
+                    lambda index: self.Sale.get_recent_sales(), repeat
+                )
+
+                # Every call needs its own confirmed sale
+                confirmed = self.sales[1:repeat + 1]
+                if confirmed:
+                    self.Sale.quote(confirmed)
+                    self.Sale.confirm(confirmed)
+                    results['create_shipment'] = self.measure(
+                        lambda index: self.Sale(
+                            confirmed[index]
+                        ).create_shipment('out'), len(confirmed)
+                    )
+            Transaction().cursor.rollback()
+        return results
+
+    def capture_statement(self, func, table):
+        """
+        Call func and return the first SELECT statement on the table it
+        executed with its parameters
+        """
+        cursor = Transaction().cursor
+        execute = cursor.execute
+        statements = []
+
+        def capture(sql, params=None):
+            statements.append((sql, params))
+            if params is None:
+                return execute(sql)
+            return execute(sql, params)
+        cursor.execute = capture
+        try:
+            func()
+        finally:
+            cursor.execute = execute
+        return next(
+            (sql, params) for sql, params in statements
+            if sql.lstrip().startswith('SELECT') and
+            'FROM "%s"' % table in sql
+        )
+
+    def explain(self, sql, params):
+        """
+        Return the lines of the plan of the statement
+        """
+        cursor = Transaction().cursor
+        if CONFIG['db_type'] == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return [row[-1] for row in cursor.fetchall()]
+        cursor.execute('EXPLAIN ' + sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+    def query_plans(self, sales, lines, products):
+        """
+        Seed the shop and return the plans of the queries of the POS access
+        paths with and without the indexes of the module
+        """
+        TableHandler = backend.get('TableHandler')
+        SaleLine = POOL.get('sale.line')
+
+        plans = {}
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                self.seed(sales, lines, products)
+                cursor = Transaction().cursor
+                if CONFIG['db_type'] != 'sqlite':
+                    # The planner needs the statistics of the seeded tables
+                    cursor.execute('ANALYZE')
+                sale = self.sales[0]
+
+                statements = {
+                    'get_recent_sales': self.capture_statement(
+                        self.Sale.get_recent_sales, 'sale_sale'
+                    ),
+                    'pos_sale_line_domain': self.capture_statement(
+                        lambda: SaleLine.search(sale.pos_sale_line_domain(
+                            self.products[0].id, 'pick_up'
+                        )), 'sale_line'
+                    ),
+                }
+                for name, (sql, params) in statements.iteritems():
+                    plans[name] = {'indexed': self.explain(sql, params)}
+
+                for Model in (self.Sale, SaleLine):
+                    table = TableHandler(cursor, Model, 'pos')
+                    for columns in Model._pos_indexes:
+                        table.index_action(columns, 'remove')
+                for name, (sql, params) in statements.iteritems():
+                    plans[name]['not_indexed'] = self.explain(sql, params)
+            # Also restores the indexes
+            Transaction().cursor.rollback()
+        return plans
+
+
+def format_results(results):
+    """
+    Return the results as a human readable table
+    """
+    lines = ['%-18s %6s %9s %9s %9s %9s %9s %9s %9s' % (
+        'entry point', 'calls', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms',
+        'queries', 'sql ms', 'records',
+    )]
+    for name in sorted(results):
+        result = results[name]
+        lines.append(
+            '%-18s %6d %9.2f %9.2f %9.2f %9.2f %9.1f %9.2f %9.1f' % (
+                name, result['calls'], result['mean'] * 1000,
+                result['p50'] * 1000, result['p90'] * 1000,
+                result['p99'] * 1000, result['queries'],
+                result['sql_time'] * 1000, result['records'],
+            )
+        )
+    return '\n'.join(lines)
+
+
+def format_plans(plans):
+    """
+    Return the query plans as human readable text
+    """
+    lines = []
+    for name in sorted(plans):
+        for key in ('not_indexed', 'indexed'):
+            lines.append('%s (%s):' % (name, key.replace('_', ' ')))
+            lines.extend('    ' + line for line in plans[name][key])
+    return '\n'.join(lines)
+
+
+def run(
+    sales=20, lines=20, products=10, repeat=10, as_json=False, plans=False
+):
+    """
+    Run the benchmarks and print the results
+    """
+    benchmark = Benchmark()
+    benchmark.setUp()
+    results = benchmark.run_benchmarks(sales, lines, products, repeat)
+    if plans:
+        plans = benchmark.query_plans(sales, lines, products)
+    if as_json:
+        print json.dumps({
+            'db_type': CONFIG['db_type'],
+            'sales': sales,
+            'lines': lines,
+            'products': products,
+            'repeat': repeat,
+            'results': results,
+            'plans': plans or None,
+        }, sort_keys=True)
+    else:
+        print format_results(results)
+        if plans:
+            print
+            print format_plans(plans)
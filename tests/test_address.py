@@ -49,6 +49,46 @@ class TestAddress(unittest.TestCase):
             self.address.serialize('pos')
             self.address.serialize()
 
+    def test_0020_test_default_address_cache(self):
+        """
+        Test that default addresses are cached and invalidated on writes
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            self.assertIsNone(
+                self.Address.get_pos_default_address(self.party1, 'invoice')
+            )
+            self.assertEqual(
+                self.Address._pos_default_address_cache(),
+                {(self.party1.id, 'invoice'): None}
+            )
+
+            self.Address.write([self.address], {'invoice': True})
+            self.assertEqual(self.Address._pos_default_address_cache(), {})
+            self.assertEqual(
+                self.Address.get_pos_default_address(self.party1, 'invoice'),
+                self.address
+            )
+            self.assertIsNone(
+                self.Address.get_pos_default_address(self.party1, 'delivery')
+            )
+
+            address2, = self.Address.create([{
+                'party': self.party1,
+                'name': 'Second Address',
+                'delivery': True,
+            }])
+            self.assertEqual(
+                self.Address.get_pos_default_address(self.party1, 'delivery'),
+                address2
+            )
+
+            self.Address.delete([address2])
+            self.assertIsNone(
+                self.Address.get_pos_default_address(self.party1, 'delivery')
+            )
+
 
 def suite():
     """
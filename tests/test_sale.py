@@ -12,8 +12,13 @@ DIR = os.path.abspath(os.path.normpath(os.path.join(
 )))
 if os.path.isdir(DIR):
     sys.path.insert(0, os.path.dirname(DIR))
+import csv
+import json
+import logging
 import unittest
 import datetime
+from StringIO import StringIO
+from contextlib import contextmanager
 from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 
@@ -209,6 +214,44 @@ class TestSale(unittest.TestCase):
         }])
         return guest_price_list.id, user_price_list.id
 
+    @contextmanager
+    def run_new_cursors_in_test(self):
+        """
+        Run the transactions started with new_cursor in the transaction of
+        the test without commit nor rollback, as the test database is in
+        memory and is shared by the cursors.
+        """
+        transaction = Transaction()
+        cursor = transaction.cursor
+
+        @contextmanager
+        def new_cursor(autocommit=False, readonly=False):
+            yield transaction
+
+        transaction.new_cursor = new_cursor
+        cursor.commit = cursor.rollback = cursor.cache.clear
+        try:
+            yield
+        finally:
+            del transaction.new_cursor
+            del cursor.commit, cursor.rollback
+
+    @contextmanager
+    def capture_logs(self, name):
+        """
+        Return the list of the records logged by the logger while in the
+        block.
+        """
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger(name)
+        logger.addHandler(handler)
+        try:
+            yield records
+        finally:
+            logger.removeHandler(handler)
+
     def setup_defaults(self):
         """
         Setup Defaults
@@ -594,6 +637,156 @@ class TestSale(unittest.TestCase):
             self.assertEqual(rv['tax_amount'], sale.tax_amount)
             self.assertEqual(len(rv['lines']), 1)
 
+    def test_0036_sale_pos_serialization_addresses(self):
+        """
+        Addresses of the sale are serialized and the default addresses of
+        the party are used only when the sale does not have them
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.Address.write([self.address], {
+                'invoice': True,
+                'delivery': True,
+            })
+            address2, = self.Address.create([{
+                'party': self.anonymous_customer,
+                'name': 'Second Address',
+            }])
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                    'invoice_address': address2,
+                    'shipment_address': None,
+                }])
+
+            rv = sale.pos_serialize()
+            self.assertEqual(rv['invoice_address']['id'], address2.id)
+            self.assertEqual(rv['shipment_address']['id'], self.address.id)
+
+    def test_0037_sale_pos_serialization_projection(self):
+        """
+        Serialize only the fields of the projection sent by the client
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                sale.pos_add_product(self.product1.id, 1)
+
+                with Transaction().set_context(pos_fields=[
+                    'total_amount', 'lines.product.rec_name',
+                ]):
+                    rv = sale.pos_add_product(self.product2.id, 1)
+
+            self.assertEqual(
+                set(rv['sale'].keys()), set(['id', 'total_amount', 'lines'])
+            )
+            self.assertEqual(len(rv['sale']['lines']), 2)
+            for line in rv['sale']['lines']:
+                self.assertEqual(set(line.keys()), set(['id', 'product']))
+                self.assertEqual(
+                    set(line['product'].keys()), set(['id', 'rec_name'])
+                )
+
+            # The full serialization is used without a projection
+            rv = sale.pos_serialize()
+            self.assertIn('invoice_address', rv)
+            self.assertIn('unit', rv['lines'][0])
+            self.assertIn('code', rv['lines'][0]['product'])
+
+            # Relational fields without sub paths use the serializer of the
+            # target model or else are serialized as the id
+            rv = sale.serialize('pos', ['party', 'invoice_address'])
+            self.assertEqual(rv['party'], self.anonymous_customer.id)
+            self.assertIsNone(rv['invoice_address'])
+            rv = sale.serialize('recent_sales')
+            self.assertEqual(rv['party']['name'], self.anonymous_customer.name)
+
+            self.assertRaises(
+                ValueError, sale.serialize, 'pos', ['lines.unknown']
+            )
+
+            # A line is serialized on its own with the same serializer
+            line = sale.lines[0]
+            self.assertEqual(line.serialize('pos', ['quantity']), {
+                'id': line.id,
+                'quantity': line.quantity,
+            })
+
+            # The getters may return many records, which are serialized with
+            # the serializer of their model
+            getters = self.Sale._serializer_getters
+            self.Sale._serializer_getters = dict(getters, lines='get_lines')
+            self.Sale.get_lines = lambda sale: list(sale.lines)
+            try:
+                rv = sale.serialize('pos', ['lines.quantity'])
+            finally:
+                self.Sale._serializer_getters = getters
+                del self.Sale.get_lines
+            self.assertEqual(
+                [values['quantity'] for values in rv['lines']], [1, 1]
+            )
+
+    def test_0038_sale_pos_serialization_query_count(self):
+        """
+        The number of queries to serialize a sale for pos must not grow with
+        the number of lines
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            templates = self._create_product_template('product-bulk', [{
+                'category': self.category.id,
+                'type': 'goods',
+                'salable': True,
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('5'),
+                'account_expense': self._get_account_by_kind('expense').id,
+                'account_revenue': self._get_account_by_kind('revenue').id,
+            } for index in range(10)])
+
+            def count_queries():
+                cursor = Transaction().cursor
+                execute = cursor.execute
+                queries = []
+
+                def counting_execute(*args, **kwargs):
+                    queries.append(args[0])
+                    return execute(*args, **kwargs)
+
+                # Start from an empty record cache
+                cursor.cache.clear()
+                cursor.execute = counting_execute
+                try:
+                    self.Sale(sale.id).serialize('pos')
+                finally:
+                    cursor.execute = execute
+                return len(queries)
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                sale.pos_add_products([{
+                    'product': template.products[0].id, 'quantity': 1,
+                } for template in templates[:2]])
+                queries_for_2_lines = count_queries()
+
+                sale.pos_add_products([{
+                    'product': template.products[0].id, 'quantity': 1,
+                } for template in templates[2:]])
+                queries_for_10_lines = count_queries()
+
+            self.assertEqual(len(sale.lines), 10)
+            self.assertEqual(queries_for_2_lines, queries_for_10_lines)
+
     def test_0040_default_delivery_mode(self):
         """
         Test default delivery_mode for saleLine
@@ -624,187 +817,1642 @@ class TestSale(unittest.TestCase):
                     sale_line.delivery_mode, self.shop.delivery_mode
                 )
 
-    def test_0120_ship_pick_diff_warehouse(self):
+    def test_0045_pos_settings_cache(self):
         """
-        Ensure that ship_from_warehouse is used for back orders while orders
-        are picked from the shop's warehouse
+        Test that the defaults use the cached settings of the shop and that
+        the cache is cleared when shops and users are written or deleted
         """
-        Location = POOL.get('stock.location')
+        from trytond.modules.pos.instrumentation import Measurement
+
         Shop = POOL.get('sale.shop')
-        Date = POOL.get('ir.date')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
 
-            ship_from_wh, = Location.copy([self.shop.warehouse])
-
-            # Set that as the new ship_from warehouse
-            Shop.write([self.shop], {'ship_from_warehouse': ship_from_wh.id})
+            with Transaction().set_context(use_anonymous_customer=True):
+                self.assertEqual(
+                    self.Sale.default_party(), self.anonymous_customer.id
+                )
+                self.assertEqual(self.SaleLine.default_delivery_mode(), 'ship')
 
-            with Transaction().set_context({
-                    'company': self.company.id,
-                    'shop': self.shop.id,
-                    'shops': [self.shop.id], }):
-                # Now create an order
-                sale, = self.Sale.create([{
-                    'reference': 'Test Sale',
-                    'payment_term': self.payment_term,
-                    'currency': self.company.currency.id,
-                    'party': self.party.id,
-                    'invoice_address': self.party.addresses[0].id,
-                    'shipment_address': self.party.addresses[0].id,
-                    'sale_date': Date.today(),
-                    'company': self.company.id,
+                with Measurement() as measurement:
+                    self.Sale.default_party()
+                    self.SaleLine.default_delivery_mode()
+                self.assertEqual(measurement.queries, 0)
 
-                    # keep invoicing out of the way for this test's sake
-                    'invoice_method': 'manual',
-                    'shipment_method': 'order',
+                Shop.write([self.shop], {'delivery_mode': 'pick_up'})
+                self.assertEqual(
+                    self.SaleLine.default_delivery_mode(), 'pick_up'
+                )
 
-                    # Explicitly specify the shop
-                    'shop': Shop(self.shop).id,
-                }])
-                self.SaleLine.create([{
-                    'sale': sale,
-                    'type': 'line',
-                    'quantity': 2,
-                    'delivery_mode': 'pick_up',
-                    'unit': self.uom,
-                    'unit_price': 20000,
-                    'description': 'Picked Item',
-                    'product': self.product1.id
-                }, {
-                    'sale': sale,
-                    'type': 'line',
-                    'quantity': 2,
-                    'delivery_mode': 'ship',
-                    'unit': self.uom,
-                    'unit_price': 20000,
-                    'description': 'Shipped Item',
-                    'product': self.product1.id
-                }])
+                self.User.write([self.User(USER)], {'shop': self.shop1.id})
+                self.assertEqual(self.SaleLine.default_delivery_mode(), 'ship')
+                self.assertEqual(
+                    Shop.get_pos_user_shop(USER), self.shop1.id
+                )
 
-                # Quote, Confirm and Process the order
-                self.Sale.quote([sale])
-                self.Sale.confirm([sale])
-                self.Sale.process([sale])
+                key = ('user', USER)
+                shop, = Shop.copy([self.shop1])
+                Shop.get_pos_user_shop(USER)
+                with Transaction().set_user(0):
+                    Shop.delete([shop])
+                self.assertIsNone(Shop._pos_settings_cache.get(key))
 
-                self.assertEqual(len(sale.shipments), 2)
-                for shipment in sale.shipments:
-                    if shipment.delivery_mode == 'pick_up':
-                        self.assertEqual(shipment.state, 'done')
-                        self.assertEqual(
-                            shipment.warehouse, self.shop.warehouse
-                        )
-                    elif shipment.delivery_mode == 'ship':
-                        self.assertEqual(shipment.state, 'waiting')
-                        self.assertEqual(
-                            shipment.warehouse, self.shop.ship_from_warehouse
-                        )
-                    else:
-                        self.fail('Invalid delivery mode')
+                user, = self.User.create([{
+                    'name': 'Cashier',
+                    'login': 'cashier',
+                }])
+                Shop.get_pos_user_shop(USER)
+                self.User.delete([user])
+                self.assertIsNone(Shop._pos_settings_cache.get(key))
 
-    def test_1010_delivery_method_2shipping_case_1(self):
+    def test_0050_pos_add_products(self):
         """
-        Ensure shipment method is respected by sale order processing
-
-        Case 1: Ship only order
+        Add many products to a sale in a single call
         """
-        Date = POOL.get('ir.date')
+        from trytond.modules.pos.instrumentation import Measurement
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
 
-            sale, = self.Sale.create([{
-                'reference': 'Test Sale',
-                'payment_term': self.payment_term,
-                'currency': self.company.currency.id,
-                'party': self.party.id,
-                'invoice_address': self.party.addresses[0].id,
-                'shipment_address': self.party.addresses[0].id,
-                'sale_date': Date.today(),
-                'company': self.company.id,
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id
+            ):
+                rv = sale.pos_add_product(self.product1.id, 1)
+                line_id = rv['updated_line_id']
+
+                rv = sale.pos_add_products([
+                    # Update the existing line
+                    {'product': self.product1.id, 'quantity': 3},
+                    # New lines, the last item for a line wins
+                    {'product': self.product2.id, 'quantity': 1},
+                    {'product': self.product2.id, 'quantity': 2},
+                    {
+                        'product': self.product3.id, 'quantity': 1,
+                        'delivery_mode': 'ship',
+                    },
+                ])
+
+            self.assertEqual(len(rv['updated_line_ids']), 3)
+            self.assertIn(line_id, rv['updated_line_ids'])
+            self.assertEqual(len(rv['sale']['lines']), 3)
+
+            lines = dict(
+                (line['product']['id'], line) for line in rv['sale']['lines']
+            )
+            self.assertEqual(lines[self.product1.id]['id'], line_id)
+            self.assertEqual(lines[self.product1.id]['quantity'], 3)
+            self.assertEqual(lines[self.product2.id]['quantity'], 2)
+            self.assertEqual(
+                lines[self.product2.id]['delivery_mode'], 'pick_up'
+            )
+            self.assertEqual(lines[self.product3.id]['delivery_mode'], 'ship')
 
-                # keep invoicing out of the way for this test's sake
-                'invoice_method': 'manual',
-                'shipment_method': 'order',
-            }])
-            sale_line, = self.SaleLine.create([{
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'ship',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Test description',
-                'product': self.product1.id
-            }])
+            # Taxes are saved on the created lines
+            self.assertEqual(rv['sale']['tax_amount'], Decimal('1.5'))
 
-            # Quote, Confirm and Process the order
-            self.Sale.quote([sale])
-            self.Sale.confirm([sale])
-            self.Sale.process([sale])
+            # Change the delivery mode of an explicit sale line
+            rv = sale.pos_add_products([{
+                'product': self.product1.id, 'quantity': 1,
+                'delivery_mode': 'ship', 'sale_line': line_id,
+            }])
+            self.assertEqual(rv['updated_line_ids'], [line_id])
+            self.assertEqual(len(rv['sale']['lines']), 3)
+            self.assertEqual(self.SaleLine(line_id).delivery_mode, 'ship')
 
-            self.assertEqual(len(sale.shipments), 1)
-            self.assertEqual(sale.shipments[0].delivery_mode, 'ship')
-            self.assertEqual(sale.shipments[0].state, 'waiting')
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id
+            ):
+                # An existing line keeps its delivery mode
+                rv = sale.pos_add_products([{
+                    'product': self.product1.id, 'quantity': 2,
+                }])
+                self.assertEqual(rv['updated_line_ids'], [line_id])
+                self.assertEqual(self.SaleLine(line_id).delivery_mode, 'ship')
 
-    def test_1020_delivery_method_2shipping_case_2(self):
+                # Duplicate lines are consolidated instead of adding a line
+                self.SaleLine.copy([self.SaleLine(line_id)])
+                rv = sale.pos_add_products([{
+                    'product': self.product1.id, 'quantity': 5,
+                }])
+                self.assertEqual(rv['updated_line_ids'], [line_id])
+                lines = [
+                    line for line in rv['sale']['lines']
+                    if line['product']['id'] == self.product1.id
+                ]
+                self.assertEqual(len(lines), 1)
+                self.assertEqual(lines[0]['quantity'], 5)
+
+                # The lines missing from the index are searched at once
+                with Transaction().set_context(use_anonymous_customer=True):
+                    new_sale, = self.Sale.create([{
+                        'currency': self.usd.id,
+                    }])
+                keys = [
+                    (product.id, delivery_mode)
+                    for product in (
+                        self.product1, self.product2, self.product3
+                    )
+                    for delivery_mode in (None, 'ship')
+                ]
+                queries = []
+                for count in (1, len(keys)):
+                    self.Sale._pos_forget_line_index([new_sale.id])
+                    Transaction().cursor.cache.clear()
+                    with Measurement() as measurement:
+                        self.assertEqual(
+                            new_sale._pos_find_lines(keys[:count]),
+                            dict.fromkeys(keys[:count])
+                        )
+                    queries.append(measurement.queries)
+                self.assertEqual(queries[0], queries[1])
+
+                with Transaction().set_context(
+                        product=self.product1.id, delivery_mode='ship',
+                        products=[self.product2.id]):
+                    self.assertEqual(new_sale.pos_find_sale_line_domain(), [
+                        ('sale', '=', new_sale.id),
+                        ('product', '=', self.product1.id),
+                        ('delivery_mode', '=', 'ship'),
+                        ('product', 'in', [self.product2.id]),
+                    ])
+
+    def test_0055_pos_serialize_changes(self):
         """
-        Ensure shipment method is respected by sale order processing
-
-        Case 2: Pick up only order
+        Only the lines changed since the revision seen by the client are
+        serialized when the client sends the revision
         """
-        Date = POOL.get('ir.date')
+        from datetime import timedelta
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
 
-            sale, = self.Sale.create([{
-                'reference': 'Test Sale',
-                'payment_term': self.payment_term,
-                'currency': self.company.currency.id,
-                'party': self.party.id,
-                'invoice_address': self.party.addresses[0].id,
-                'shipment_address': self.party.addresses[0].id,
-                'sale_date': Date.today(),
-                'company': self.company.id,
-
-                # keep invoicing out of the way for this test's sake
-                'invoice_method': 'manual',
-                'shipment_method': 'order',
-            }])
-            sale_line, = self.SaleLine.create([{
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'pick_up',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Test description',
-                'product': self.product1.id
-            }])
-
-            # Quote, Confirm and Process the order
-            self.Sale.quote([sale])
-            self.Sale.confirm([sale])
-            self.Sale.process([sale])
-
-            self.assertEqual(len(sale.shipments), 1)
-            self.assertEqual(sale.shipments[0].delivery_mode, 'pick_up')
-            self.assertEqual(sale.shipments[0].state, 'done')
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id
+            ):
+                sale.pos_add_product(self.product1.id, 1)
+                rv = sale.pos_add_product(self.product2.id, 1)
+                self.assertEqual(len(rv['sale']['lines']), 2)
+                revision = rv['sale']['revision']
+                self.assertTrue(revision)
+
+                line2, = self.SaleLine.search([
+                    ('sale', '=', sale.id),
+                    ('product', '=', self.product2.id),
+                ])
+                line3_id = sale.pos_add_product(
+                    self.product3.id, 1
+                )['updated_line_id']
+
+                # Remove the second line after the revision
+                line1, = self.SaleLine.search([
+                    ('sale', '=', sale.id),
+                    ('product', '=', self.product1.id),
+                ])
+                self.SaleLine.delete([line2])
+
+                with Transaction().set_context(pos_revision=revision):
+                    rv = sale.pos_add_product(self.product3.id, 2)
+
+            self.assertEqual(rv['updated_line_id'], line3_id)
+            self.assertEqual(
+                sorted(rv['sale']['line_ids']), sorted([line1.id, line3_id])
+            )
+            changed_ids = [line['id'] for line in rv['sale']['lines']]
+            self.assertIn(line3_id, changed_ids)
+            self.assertNotIn(line2.id, changed_ids)
+            self.assertEqual(rv['sale']['total_amount'], sale.total_amount)
+            self.assertTrue(rv['sale']['revision'] >= revision)
+
+            # The lines changed shortly before the revision are sent again,
+            # as their transaction could have been committed after it
+            with Transaction().set_context(pos_revision=revision):
+                rv = sale.pos_serialize()
+            self.assertIn(line1.id, [line['id'] for line in rv['lines']])
+            overlap = self.Sale._pos_revision_overlap
+            self.Sale._pos_revision_overlap = timedelta(0)
+            try:
+                with Transaction().set_context(pos_revision=revision):
+                    rv = sale.pos_serialize()
+            finally:
+                self.Sale._pos_revision_overlap = overlap
+            self.assertNotIn(line1.id, [line['id'] for line in rv['lines']])
+
+            # Without the revision the full sale is serialized
+            rv = sale.pos_serialize()
+            self.assertEqual(len(rv['lines']), 2)
 
-    def test_1030_delivery_method_2shipping_case_3(self):
+    def test_0060_pos_price_cache(self):
         """
-        Ensure shipment method is respected by sale order processing
-
-        Case 2: Pick up + Ship order for same item
+        Prices of the lines added from POS are cached per price list bracket
+        and the cache is cleared when prices change
         """
         Date = POOL.get('ir.date')
+        CurrencyRate = POOL.get('currency.currency.rate')
+        PriceListLine = POOL.get('product.price_list.line')
+        ProductTemplate = POOL.get('product.template')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
-
-            sale, = self.Sale.create([{
+            price_list, = self.PriceList.create([{
+                'name': 'Bulk PL',
+                'company': self.company.id,
+                'lines': [
+                    ('create', [{
+                        'quantity': 5,
+                        'formula': 'unit_price * 0.5',
+                    }, {
+                        'formula': 'unit_price',
+                    }])
+                ],
+            }])
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                    'price_list': price_list.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                rv = sale.pos_add_product(self.product1.id, 1)
+                self.assertEqual(
+                    rv['sale']['lines'][0]['unit_price'], Decimal('10')
+                )
+                line = self.SaleLine(rv['updated_line_id'])
+                key = sale._get_pos_price_cache_key(
+                    self.product1, line.unit, 2
+                )
+                # Drafts without sale date are priced at the rate of the day
+                self.assertIn(Date.today(), key)
+                # Quantities 1 and 2 are in the same bracket of the price list
+                self.assertEqual(
+                    sale._get_pos_price_cache_key(self.product1, line.unit, 1),
+                    key
+                )
+                rv = sale.pos_add_product(self.product1.id, 2)
+                self.assertEqual(
+                    self.Sale._pos_price_cache.get(key)['unit_price'],
+                    Decimal('10')
+                )
+                self.assertEqual(rv['sale']['total_amount'], Decimal('20'))
+
+                rv = sale.pos_add_product(self.product1.id, 5)
+                self.assertEqual(
+                    rv['sale']['lines'][0]['unit_price'], Decimal('5')
+                )
+
+                # Changing the price clears the cache
+                ProductTemplate.write([self.template1], {
+                    'list_price': Decimal('20'),
+                })
+                self.assertIsNone(self.Sale._pos_price_cache.get(key))
+                rv = sale.pos_add_product(self.product1.id, 2)
+                self.assertEqual(
+                    rv['sale']['lines'][0]['unit_price'], Decimal('20')
+                )
+
+                # Changing the currency rates clears the cache
+                self.assertIsNotNone(self.Sale._pos_price_cache.get(key))
+                CurrencyRate.create([{
+                    'currency': self.usd.id,
+                    'rate': Decimal('1'),
+                    'date': Date.today(),
+                }])
+                self.assertIsNone(self.Sale._pos_price_cache.get(key))
+
+                # Deleting a price list line clears the cache
+                sale.pos_add_product(self.product1.id, 2)
+                self.assertIsNotNone(self.Sale._pos_price_cache.get(key))
+                PriceListLine.delete([price_list.lines[0]])
+                self.assertIsNone(self.Sale._pos_price_cache.get(key))
+
+                # Without price list the price does not depend on the
+                # quantity
+                self.Sale.write([sale], {'price_list': None})
+                sale = self.Sale(sale.id)
+                self.assertIsNone(sale._get_pos_price_quantity_key(
+                    self.product1, line.unit, 5
+                ))
+
+    def test_0065_pos_rpc_instrumentation(self):
+        """
+        POS RPC calls are measured only when the instrumentation is enabled
+        and nested calls are accounted to the outermost call
+        """
+        from trytond.config import CONFIG
+        from trytond.model import Model
+        from trytond.modules.pos.instrumentation import Measurement
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                self.Sale.get_pos_rpc_stats(reset=True)
+                sale.pos_add_product(self.product1.id, 1)
+                self.assertEqual(self.Sale.get_pos_rpc_stats(), {})
+
+                init = Model.__dict__['__init__']
+                CONFIG['pos_instrumentation'] = True
+                try:
+                    sale.pos_add_product(self.product1.id, 2)
+                    self.Sale(sale.id).pos_serialize()
+                finally:
+                    del CONFIG.options['pos_instrumentation']
+                # The constructor of the records is restored
+                self.assertIs(Model.__dict__['__init__'], init)
+
+                with Measurement() as measurement:
+                    self.Sale(sale.id).pos_serialize()
+                values = measurement.as_dict()
+                self.assertEqual(set(values), set([
+                    'wall_time', 'queries', 'sql_time', 'records',
+                ]))
+                self.assertTrue(values['records'] > 0)
+
+                stats = self.Sale.get_pos_rpc_stats(reset=True)
+                self.assertEqual(
+                    set(stats.keys()), set(['pos_add_product', 'pos_serialize'])
+                )
+                self.assertEqual(stats['pos_add_product']['calls'], 1)
+                self.assertEqual(stats['pos_serialize']['calls'], 1)
+                self.assertTrue(stats['pos_add_product']['queries'] > 0)
+                self.assertTrue(stats['pos_add_product']['records'] > 0)
+                self.assertTrue(
+                    stats['pos_add_product']['wall_time'] >=
+                    stats['pos_add_product']['sql_time']
+                )
+                self.assertEqual(self.Sale.get_pos_rpc_stats(), {})
+
+    def test_0070_pos_add_product_by_code(self):
+        """
+        Test adding products to the sale by their code
+        """
+        from trytond.exceptions import UserError
+        from trytond.modules.pos.instrumentation import Measurement
+
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            Product.write([self.product1], {'code': '4006381333931'})
+
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                self.assertEqual(
+                    Product.pos_find_by_code('4006381333931'),
+                    self.product1.id
+                )
+                with Measurement() as measurement:
+                    Product.pos_find_by_code('4006381333931')
+                self.assertEqual(measurement.queries, 0)
+                self.assertIsNone(Product.pos_find_by_code('unknown'))
+
+                rv = sale.pos_add_product_by_code('4006381333931', 2)
+                line, = rv['sale']['lines']
+                self.assertEqual(line['id'], rv['updated_line_id'])
+                self.assertEqual(line['product']['id'], self.product1.id)
+                self.assertEqual(line['quantity'], 2)
+
+                with self.assertRaises(UserError):
+                    sale.pos_add_product_by_code('unknown', 1)
+
+                # Changing the code clears the cache
+                Product.write([self.product1], {'code': '5901234123457'})
+                self.assertIsNone(Product.pos_find_by_code('4006381333931'))
+                self.assertEqual(
+                    Product.pos_find_by_code('5901234123457'),
+                    self.product1.id
+                )
+
+                # Deleting a product clears the cache
+                product, = Product.copy([self.product1], {
+                    'code': '4006381333931',
+                })
+                self.assertEqual(
+                    Product.pos_find_by_code('4006381333931'), product.id
+                )
+                Product.delete([product])
+                self.assertIsNone(Product.pos_find_by_code('4006381333931'))
+
+    def test_0075_pos_catalog(self):
+        """
+        Test the snapshot of the catalog and the changes since a version
+        """
+        from datetime import timedelta
+
+        Product = POOL.get('product.product')
+        ProductTemplate = POOL.get('product.template')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            overlap = Product._pos_catalog_overlap
+            Product._pos_catalog_overlap = timedelta(0)
+            try:
+                catalog = Product.pos_get_catalog()
+                version = catalog['version']
+                self.assertTrue(version > 0)
+                self.assertIsNone(catalog['next_offset'])
+                self.assertEqual(catalog['removed'], [])
+                products = dict((p['id'], p) for p in catalog['products'])
+                self.assertEqual(
+                    products[self.product1.id]['list_price'], Decimal('10')
+                )
+                self.assertEqual(
+                    products[self.product1.id]['sale_uom'], self.uom.id
+                )
+
+                page = Product.pos_get_catalog(limit=1)
+                self.assertEqual(len(page['products']), 1)
+                self.assertEqual(page['next_offset'], 1)
+
+                changes = Product.pos_get_catalog(since=version)
+                self.assertEqual(changes['products'], [])
+                self.assertEqual(changes['removed'], [])
+
+                ProductTemplate.write([self.template1], {
+                    'list_price': Decimal('12'),
+                })
+                Product.write([self.product2], {'active': False})
+
+                changes = Product.pos_get_catalog(since=version)
+                self.assertTrue(changes['version'] > version)
+                product, = changes['products']
+                self.assertEqual(product['id'], self.product1.id)
+                self.assertEqual(product['list_price'], Decimal('12'))
+                self.assertEqual(changes['removed'], [self.product2.id])
+            finally:
+                Product._pos_catalog_overlap = overlap
+
+    def test_0080_pos_commit_offline_sales(self):
+        """
+        Test committing sales captured offline, idempotent by client key
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            tax, = self.product3.template.customer_taxes
+
+            offline_sales = [{
+                'client_key': 'till-1-0001',
+                'lines': [{
+                    'product': self.product3.id,
+                    'quantity': 2,
+                    'unit_price': Decimal('14'),
+                    'taxes': [tax.id],
+                }, {
+                    'product': self.product1.id,
+                    'quantity': 1,
+                    'delivery_mode': 'ship',
+                }],
+            }, {
+                'client_key': 'till-1-0002',
+                'party': self.party.id,
+                'comment': 'Offline',
+                'lines': [{
+                    'product': self.product2.id,
+                    'quantity': 3,
+                }],
+            }]
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                result = self.Sale.pos_commit_offline_sales(
+                    offline_sales, confirm=True
+                )
+                self.assertEqual(
+                    [r['client_key'] for r in result],
+                    ['till-1-0001', 'till-1-0002']
+                )
+                self.assertTrue(all(r['created'] for r in result))
+
+                sale1, sale2 = self.Sale.browse([r['sale'] for r in result])
+                self.assertEqual(sale1.state, 'confirmed')
+                self.assertEqual(sale1.party, self.anonymous_customer)
+                self.assertEqual(sale1.invoice_address, self.address)
+                self.assertEqual(sale2.party, self.party)
+                self.assertEqual(sale2.comment, 'Offline')
+
+                line1, line2 = sorted(sale1.lines, key=lambda l: l.quantity)
+                self.assertEqual(line1.unit_price, Decimal('10'))
+                self.assertEqual(line1.delivery_mode, 'ship')
+                self.assertEqual(line2.unit_price, Decimal('14'))
+                self.assertEqual(line2.taxes, (tax,))
+                self.assertEqual(line2.delivery_mode, 'pick_up')
+                self.assertEqual(sale2.lines[0].unit_price, Decimal('15'))
+
+                # Sending the batch again does not create the sales again
+                offline_sales.append(offline_sales[0])
+                result = self.Sale.pos_commit_offline_sales(offline_sales)
+                self.assertEqual(
+                    [r['sale'] for r in result],
+                    [sale1.id, sale2.id, sale1.id]
+                )
+                self.assertFalse(any(r['created'] for r in result))
+                self.assertEqual(
+                    self.Sale.search([], count=True), 2
+                )
+
+                # A key sent twice in a batch creates a single sale
+                sale_date = datetime.date.today() - relativedelta(days=1)
+                offline_sale = {
+                    'client_key': 'till-1-0003',
+                    'sale_date': sale_date,
+                    'lines': [{
+                        'product': self.product2.id,
+                        'quantity': 1,
+                    }],
+                }
+                result = self.Sale.pos_commit_offline_sales(
+                    [offline_sale, offline_sale], process=True
+                )
+                self.assertEqual(result[0]['sale'], result[1]['sale'])
+                self.assertEqual(
+                    [r['created'] for r in result], [True, False]
+                )
+                sale3 = self.Sale(result[0]['sale'])
+                self.assertEqual(sale3.sale_date, sale_date)
+                self.assertEqual(sale3.state, 'processing')
+
+                # The client key is not copied
+                sale4, = self.Sale.copy([sale3])
+                self.assertIsNone(sale4.pos_client_key)
+
+    def test_0085_pos_checkout(self):
+        """
+        Test the checkout of a POS sale in one call
+        """
+        from trytond.exceptions import UserError
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                    'invoice_address': self.address.id,
+                    'shipment_address': self.address.id,
+                    'invoice_method': 'shipment',
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                sale.pos_add_products([{
+                    'product': self.product1.id,
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                }, {
+                    'product': self.product3.id,
+                    'quantity': 1,
+                    'delivery_mode': 'ship',
+                }])
+
+                receipt = sale.pos_checkout()
+
+                sale = self.Sale(sale.id)
+                self.assertEqual(sale.state, 'processing')
+                self.assertEqual(receipt['id'], sale.id)
+                self.assertEqual(receipt['reference'], sale.reference)
+                self.assertEqual(receipt['state'], 'processing')
+                self.assertEqual(receipt['total_amount'], sale.total_amount)
+                self.assertEqual(
+                    receipt['party']['name'], self.anonymous_customer.name
+                )
+                self.assertEqual(len(receipt['lines']), 2)
+                self.assertEqual(
+                    set(line['amount'] for line in receipt['lines']),
+                    set([Decimal('20'), Decimal('15')])
+                )
+                self.assertEqual(
+                    sorted(
+                        (s['delivery_mode'], s['state'])
+                        for s in receipt['shipments']
+                    ),
+                    [('pick_up', 'done'), ('ship', 'waiting')]
+                )
+                invoice, = receipt['invoices']
+                self.assertEqual(invoice['state'], 'posted')
+
+                # The checkout goes on from a quotation
+                with Transaction().set_context(use_anonymous_customer=True):
+                    quotation, cancelled = self.Sale.create([{
+                        'currency': self.usd.id,
+                        'invoice_address': self.address.id,
+                        'shipment_address': self.address.id,
+                    } for _ in range(2)])
+                quotation.pos_add_product_line(self.product1.id, 1)
+                self.Sale.quote([quotation])
+                receipt = quotation.pos_checkout()
+                self.assertEqual(receipt['state'], 'processing')
+                self.assertEqual(
+                    self.Sale(quotation.id).state, 'processing'
+                )
+
+                # A cancelled sale can not be checked out
+                self.Sale.cancel([cancelled])
+                with self.assertRaises(UserError):
+                    cancelled.pos_checkout()
+
+    def test_0090_pos_add_product_line(self):
+        """
+        Test adding products with the explicit arguments
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                rv = sale.pos_add_product_line(self.product1.id, 1, 'ship')
+                ship_line_id = rv['updated_line_id']
+                rv = sale.pos_add_product_line(self.product1.id, 2)
+                # The only line of the product is updated
+                self.assertEqual(rv['updated_line_id'], ship_line_id)
+
+                rv = sale.pos_add_product_line(
+                    self.product1.id, 3, 'pick_up'
+                )
+                pick_up_line_id = rv['updated_line_id']
+                self.assertNotEqual(pick_up_line_id, ship_line_id)
+
+                rv = sale.pos_add_product_line(
+                    self.product1.id, 5, sale_line_id=ship_line_id
+                )
+                self.assertEqual(rv['updated_line_id'], ship_line_id)
+                lines = dict((line['id'], line) for line in rv['sale']['lines'])
+                self.assertEqual(lines[ship_line_id]['quantity'], 5)
+                self.assertEqual(lines[pick_up_line_id]['quantity'], 3)
+
+                # The context protocol is kept and does not leak the product
+                with Transaction().set_context(delivery_mode='pick_up'):
+                    rv = sale.pos_add_product(self.product1.id, 4)
+                self.assertEqual(rv['updated_line_id'], pick_up_line_id)
+                self.assertNotIn('product', Transaction().context)
+
+    def test_0095_pos_line_index(self):
+        """
+        Test the line index of the sale and the consolidation of lines
+        """
+        from trytond.modules.pos.instrumentation import Measurement
+
+        SaleLine = POOL.get('sale.line')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                rv = sale.pos_add_product_line(self.product1.id, 1)
+                line_id = rv['updated_line_id']
+                self.assertEqual(sale.get_pos_line_index(), {
+                    (self.product1.id, 'pick_up'): (line_id,),
+                })
+
+                # Lines created outside of POS are indexed too
+                duplicate, = SaleLine.create([{
+                    'sale': sale.id,
+                    'type': 'line',
+                    'product': self.product1.id,
+                    'description': 'Duplicate',
+                    'quantity': 2,
+                    'unit': self.product1.default_uom.id,
+                    'unit_price': Decimal('10'),
+                    'delivery_mode': 'pick_up',
+                }])
+                self.assertEqual(
+                    sale.get_pos_line_index()[
+                        (self.product1.id, 'pick_up')
+                    ], (line_id, duplicate.id)
+                )
+
+                # Duplicates are consolidated instead of adding a line
+                rv = sale.pos_add_product_line(self.product1.id, 4)
+                self.assertEqual(rv['updated_line_id'], line_id)
+                self.assertEqual(len(rv['sale']['lines']), 1)
+                self.assertEqual(rv['sale']['lines'][0]['quantity'], 4)
+                self.assertEqual(sale.get_pos_line_index(), {
+                    (self.product1.id, 'pick_up'): (line_id,),
+                })
+
+                # Changes of the delivery mode move the line in the index
+                SaleLine.write([SaleLine(line_id)], {'delivery_mode': 'ship'})
+                self.assertEqual(sale.get_pos_line_index(), {
+                    (self.product1.id, 'ship'): (line_id,),
+                })
+
+                # Updates of the quantity keep the index, so repeated updates
+                # do not search the lines again
+                queries = []
+                for quantity in (5, 6, 7, 8):
+                    with Measurement() as measurement:
+                        rv = sale.pos_add_product_line(
+                            self.product1.id, quantity, 'ship'
+                        )
+                    queries.append(measurement.queries)
+                    self.assertEqual(rv['updated_line_id'], line_id)
+                    self.assertIsNotNone(
+                        self.Sale._pos_line_index_cache.get(sale.id)
+                    )
+                self.assertEqual(len(set(queries[1:])), 1)
+
+                # A stale index is rebuilt
+                self.Sale._pos_line_index_cache.set(sale.id, {
+                    (self.product1.id, 'ship'): (line_id, line_id + 1000),
+                })
+                rv = sale.pos_add_product_line(self.product1.id, 3, 'ship')
+                self.assertEqual(rv['updated_line_id'], line_id)
+
+                # An index without the line, like one built before another
+                # server added it, does not lead to a duplicate
+                self.Sale._pos_line_index_cache.set(sale.id, {})
+                rv = sale.pos_add_product_line(self.product1.id, 3)
+                self.assertEqual(rv['updated_line_id'], line_id)
+                self.assertEqual(len(rv['sale']['lines']), 1)
+
+                # Lines without product and single lines are left alone
+                SaleLine.copy([SaleLine(line_id)])
+                SaleLine.create([{
+                    'sale': sale.id,
+                    'type': 'comment',
+                    'description': 'Gift wrap',
+                }])
+                other_line_id = sale.pos_add_product_line(
+                    self.product2.id, 1
+                )['updated_line_id']
+                rv = sale.pos_consolidate_lines()
+                self.assertEqual(
+                    rv['updated_line_ids'], [line_id, other_line_id]
+                )
+                self.assertEqual(len(rv['sale']['lines']), 3)
+                lines = dict(
+                    (line['id'], line) for line in rv['sale']['lines']
+                )
+                self.assertEqual(lines[line_id]['quantity'], 6)
+                self.assertEqual(lines[other_line_id]['quantity'], 1)
+
+    def test_0100_pos_cart_session(self):
+        """
+        Test that the line edits of a cart session are only written when the
+        cart is flushed and that the totals of the cart match the sale
+        """
+        from trytond.config import CONFIG
+        from trytond.exceptions import UserError
+        from trytond.modules.pos import cart
+
+        SaleLine = POOL.get('sale.line')
+
+        def quantity(line_id):
+            return SaleLine.read([line_id], ['quantity'])[0]['quantity']
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                rv = sale.pos_add_product_line(self.product1.id, 1)
+                line_id = rv['updated_line_id']
+
+                sale.pos_cart_add_product(self.product1.id, 2)
+                rv = sale.pos_cart_add_product(self.product1.id, 3)
+                self.assertEqual(len(rv['lines']), 1)
+                self.assertEqual(rv['lines'][0]['sale_line'], line_id)
+                self.assertEqual(rv['lines'][0]['quantity'], 3)
+                rv = sale.pos_cart_add_product(self.product3.id, 2, 'ship')
+                self.assertEqual(len(rv['lines']), 2)
+                self.assertTrue(rv['tax_amount'] > 0)
+
+                # Nothing is written before the flush
+                self.assertEqual(
+                    SaleLine.read([line_id], ['quantity'])[0]['quantity'], 1
+                )
+                self.assertEqual(len(SaleLine.search([
+                    ('sale', '=', sale.id),
+                ])), 1)
+
+                totals = sale.pos_get_cart()
+                serialized = sale.pos_serialize()
+                self.assertEqual(len(serialized['lines']), 2)
+                for name in ('untaxed_amount', 'tax_amount', 'total_amount'):
+                    self.assertEqual(serialized[name], totals[name])
+                lines = dict(
+                    (line['product']['id'], line)
+                    for line in serialized['lines']
+                )
+                self.assertEqual(lines[self.product1.id]['id'], line_id)
+                self.assertEqual(lines[self.product1.id]['quantity'], 3)
+                self.assertEqual(lines[self.product3.id]['quantity'], 2)
+                self.assertEqual(
+                    lines[self.product3.id]['delivery_mode'], 'ship'
+                )
+
+                # The flush ended the session, which can write the lines
+                self.assertFalse(self.Sale.__rpc__['pos_get_cart'].readonly)
+                self.assertEqual(sale.pos_get_cart()['lines'], [])
+                self.assertEqual(sale.pos_flush_cart(), [])
+
+                # The edits are kept when the transaction of the flush is
+                # rolled back, and flushing them again does not duplicate
+                # the lines
+                sale.pos_cart_add_product(self.product2.id, 2)
+                line_ids = sale.pos_flush_cart()
+                self.Sale.write([sale], {'pos_cart_token': None})
+                rv = sale.pos_get_cart()
+                self.assertEqual(len(rv['lines']), 1)
+                self.assertEqual(rv['lines'][0]['quantity'], 2)
+                self.assertEqual(sale.pos_flush_cart(), line_ids)
+                self.assertEqual(sale.pos_get_cart()['lines'], [])
+                self.assertEqual(len(SaleLine.search([
+                    ('sale', '=', sale.id),
+                ])), 3)
+
+                # The edits made while the cart is flushed are kept for the
+                # next flush, on the line created by the flush
+                database_name = Transaction().cursor.database_name
+                save_lines = self.Sale._pos_save_lines
+
+                def save_lines_and_edit(sale, items):
+                    updated_line_ids = save_lines(sale, items)
+                    session = cart.get_session(database_name, sale.id)
+                    key, = session.entries
+                    session.set_line(
+                        key, dict(session.entries[key], quantity=4),
+                        *session.contributions[key]
+                    )
+                    return updated_line_ids
+
+                sale.pos_cart_add_product(self.product1.id, 1, 'ship')
+                self.Sale._pos_save_lines = save_lines_and_edit
+                try:
+                    ship_line_id, = sale.pos_flush_cart()
+                finally:
+                    del self.Sale._pos_save_lines
+                self.assertEqual(quantity(ship_line_id), 1)
+                line, = sale.pos_get_cart()['lines']
+                self.assertEqual(line['sale_line'], ship_line_id)
+                self.assertEqual(line['quantity'], 4)
+                self.assertEqual(sale.pos_flush_cart(), [ship_line_id])
+                self.assertEqual(quantity(ship_line_id), 4)
+
+                # The line to edit can be given, the lines without product
+                # are not in the cart and with multi_server the edits are
+                # flushed at once
+                SaleLine.create([{
+                    'sale': sale.id,
+                    'type': 'comment',
+                    'description': 'Gift wrap',
+                }])
+                multi_server = CONFIG['multi_server']
+                CONFIG['multi_server'] = True
+                try:
+                    rv = sale.pos_cart_add_product(
+                        self.product1.id, 5, sale_line_id=ship_line_id
+                    )
+                finally:
+                    CONFIG['multi_server'] = multi_server
+                self.assertEqual(rv['lines'][0]['sale_line'], ship_line_id)
+                self.assertEqual(quantity(ship_line_id), 5)
+
+                # The edits of a sale which is not a draft anymore are
+                # dropped
+                sale.pos_cart_add_product(self.product1.id, 6, 'ship')
+                self.Sale.cancel([sale])
+                with self.capture_logs('pos.sale') as records:
+                    self.assertEqual(sale.pos_flush_cart(), [])
+                self.assertEqual(len(records), 1)
+                self.assertIsNone(cart.get_session(database_name, sale.id))
+                self.assertEqual(quantity(ship_line_id), 5)
+
+                # And they are refused from then on
+                with self.assertRaises(UserError):
+                    self.Sale(sale.id).pos_cart_add_product(
+                        self.product1.id, 7, 'ship'
+                    )
+                self.assertIsNone(cart.get_session(database_name, sale.id))
+
+    def test_0101_flush_pos_carts(self):
+        """
+        Test that the cron flushes the idle cart sessions and keeps the
+        edits of the sessions which fail to be flushed
+        """
+        from trytond.modules.pos import cart
+
+        SaleLine = POOL.get('sale.line')
+
+        def quantities(sale):
+            return dict(
+                (line.product.id, line.quantity)
+                for line in SaleLine.search([('sale', '=', sale.id)])
+            )
+
+        def fail(sale, items):
+            raise Exception('Flush failed')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                sale.pos_cart_add_product(self.product1.id, 2)
+
+            database_name = Transaction().cursor.database_name
+            idle_timeout = self.Sale._pos_cart_idle_timeout
+            try:
+                with self.run_new_cursors_in_test():
+                    # The session is not idle yet
+                    self.Sale.flush_pos_carts()
+                    self.assertEqual(quantities(sale), {})
+
+                    self.Sale._pos_cart_idle_timeout = -1
+                    self.Sale._pos_save_lines = fail
+                    try:
+                        with self.capture_logs('pos.sale') as records:
+                            self.Sale.flush_pos_carts()
+                    finally:
+                        del self.Sale._pos_save_lines
+                    self.assertEqual(len(records), 1)
+                    self.assertEqual(quantities(sale), {})
+                    self.assertEqual(
+                        len(self.Sale(sale.id).pos_get_cart()['lines']), 1
+                    )
+
+                    self.Sale.flush_pos_carts()
+                    self.assertEqual(quantities(sale), {self.product1.id: 2})
+                    self.assertIsNotNone(
+                        cart.get_session(database_name, sale.id)
+                    )
+
+                    # The next run ends the flushed session and the session
+                    # of a deleted sale
+                    cart.put_session(
+                        database_name, cart.CartSession(sale.id + 1000)
+                    )
+                    self.Sale.flush_pos_carts()
+                    self.assertIsNone(
+                        cart.get_session(database_name, sale.id)
+                    )
+                    self.assertIsNone(
+                        cart.get_session(database_name, sale.id + 1000)
+                    )
+            finally:
+                self.Sale._pos_cart_idle_timeout = idle_timeout
+
+    def test_0105_pos_stored_totals(self):
+        """
+        Test that the totals of a draft are maintained by the POS line edits
+        and checked when the sale is quoted
+        """
+        AccountTax = POOL.get('account.tax')
+        SaleLine = POOL.get('sale.line')
+
+        def computed_totals(sale):
+            sale = self.Sale(sale.id)
+            untaxed_amount = sum(line.amount for line in sale.lines)
+            return untaxed_amount, sale.get_tax_amount()
+
+        def totals(sale):
+            sale = self.Sale(sale.id)
+            return sale.untaxed_amount, sale.tax_amount
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(use_anonymous_customer=True):
+                sale, = self.Sale.create([{
+                    'currency': self.usd.id,
+                    'invoice_address': self.address.id,
+                    'shipment_address': self.address.id,
+                }])
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                sale.pos_add_product_line(self.product1.id, 2)
+                rv = sale.pos_add_product_line(self.product3.id, 3)
+                line_id = rv['updated_line_id']
+                rv = sale.pos_add_product_line(self.product3.id, 1)
+                self.assertTrue(self.Sale(sale.id).pos_totals)
+                self.assertTrue(rv['sale']['tax_amount'] > 0)
+                self.assertEqual(totals(sale), computed_totals(sale))
+                self.assertEqual(
+                    (rv['sale']['untaxed_amount'], rv['sale']['tax_amount']),
+                    computed_totals(sale)
+                )
+
+                sale.pos_add_products([
+                    {'product': self.product2.id, 'quantity': 1},
+                    {'product': self.product3.id, 'quantity': 4},
+                ])
+                self.assertTrue(self.Sale(sale.id).pos_totals)
+                self.assertEqual(totals(sale), computed_totals(sale))
+
+                # Changes of the lines outside of POS stop the use of the
+                # stored totals
+                SaleLine.write([SaleLine(line_id)], {'quantity': 7})
+                self.assertFalse(self.Sale(sale.id).pos_totals)
+                self.assertEqual(totals(sale), computed_totals(sale))
+
+                # And so does moving a line, for both sales
+                sale.pos_add_product_line(self.product1.id, 4)
+                with Transaction().set_context(use_anonymous_customer=True):
+                    other_sale, = self.Sale.create([{
+                        'currency': self.usd.id,
+                    }])
+                other_sale.pos_add_product_line(self.product2.id, 1)
+                SaleLine.write([SaleLine(line_id)], {'sale': other_sale.id})
+                for record in (sale, other_sale):
+                    self.assertFalse(self.Sale(record.id).pos_totals)
+                    self.assertEqual(totals(record), computed_totals(record))
+
+                # The lines without product are skipped when the totals are
+                # computed again
+                SaleLine.create([{
+                    'sale': sale.id,
+                    'type': 'comment',
+                    'description': 'Gift wrap',
+                }])
+                sale.pos_add_product_line(self.product1.id, 5)
+                self.assertTrue(self.Sale(sale.id).pos_totals)
+                self.assertEqual(totals(sale), computed_totals(sale))
+
+                # And so do the changes of the taxes
+                sale.pos_add_product_line(self.product3.id, 2)
+                self.assertTrue(self.Sale(sale.id).pos_totals)
+                tax_amount = totals(sale)[1]
+                tax, = self.product3.template.customer_taxes
+                AccountTax.write([tax], {'rate': Decimal('0.20')})
+                self.assertFalse(self.Sale(sale.id).pos_totals)
+                self.assertEqual(totals(sale), computed_totals(sale))
+                self.assertEqual(totals(sale)[1], 2 * tax_amount)
+
+                new_tax, = AccountTax.copy([tax])
+                sale.pos_add_product_line(self.product1.id, 5)
+                self.assertTrue(self.Sale(sale.id).pos_totals)
+                AccountTax.delete([new_tax])
+                self.assertFalse(self.Sale(sale.id).pos_totals)
+
+                sale.pos_add_product_line(self.product1.id, 5)
+                self.assertTrue(self.Sale(sale.id).pos_totals)
+
+                # The stored totals are checked and cleared on quotation
+                self.Sale.write([sale], {'pos_totals': json.dumps({
+                    'untaxed_amount': '1',
+                    'taxes': {},
+                })})
+                self.assertEqual(totals(sale), (Decimal('1'), Decimal('0')))
+                errors = []
+                handler = logging.Handler()
+                handler.emit = errors.append
+                logger = logging.getLogger('pos.sale')
+                logger.addHandler(handler)
+                try:
+                    self.Sale.quote([sale])
+                finally:
+                    logger.removeHandler(handler)
+                self.assertEqual(len(errors), 1)
+                sale = self.Sale(sale.id)
+                self.assertEqual(sale.state, 'quotation')
+                self.assertFalse(sale.pos_totals)
+                self.assertEqual(totals(sale), computed_totals(sale))
+
+                # The totals are only stored for drafts
+                sale._pos_update_totals([], [])
+                self.assertFalse(self.Sale(sale.id).pos_totals)
+
+    def test_0110_pos_serialize_many(self):
+        """
+        Test serializing many sales at once for the resync of a terminal
+        """
+        from trytond.modules.pos.instrumentation import Measurement
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            self.Address.write([self.address], {
+                'invoice': True,
+                'delivery': True,
+            })
+
+            with Transaction().set_context(use_anonymous_customer=True):
+                sales = self.Sale.create([{
+                    'currency': self.usd.id,
+                } for _ in xrange(4)])
+
+            with Transaction().set_context(
+                    company=self.company.id, shop=self.shop.id):
+                for sale in sales:
+                    sale.pos_add_product_line(self.product1.id, 2)
+                    sale.pos_add_product_line(self.product2.id, 1)
+
+                expected = [
+                    self.Sale(sale.id).pos_serialize() for sale in sales
+                ]
+                self.assertEqual(
+                    self.Sale.pos_serialize_many(map(int, sales)), expected
+                )
+                # The default addresses of the party are prefetched
+                self.assertEqual(
+                    set(
+                        values['shipment_address']['id']
+                        for values in expected
+                    ), set([self.address.id])
+                )
+
+                # The number of queries does not depend on the number of
+                # sales
+                queries = []
+                for count in (1, 4):
+                    Transaction().cursor.cache.clear()
+                    with Measurement() as measurement:
+                        self.Sale.pos_serialize_many(map(int, sales[:count]))
+                    queries.append(measurement.queries)
+                self.assertEqual(queries[0], queries[1])
+
+    def test_0120_ship_pick_diff_warehouse(self):
+        """
+        Ensure that ship_from_warehouse is used for back orders while orders
+        are picked from the shop's warehouse
+        """
+        Location = POOL.get('stock.location')
+        Shop = POOL.get('sale.shop')
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            ship_from_wh, = Location.copy([self.shop.warehouse])
+
+            # Set that as the new ship_from warehouse
+            Shop.write([self.shop], {'ship_from_warehouse': ship_from_wh.id})
+
+            with Transaction().set_context({
+                    'company': self.company.id,
+                    'shop': self.shop.id,
+                    'shops': [self.shop.id], }):
+                # Now create an order
+                sale, = self.Sale.create([{
+                    'reference': 'Test Sale',
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'sale_date': Date.today(),
+                    'company': self.company.id,
+
+                    # keep invoicing out of the way for this test's sake
+                    'invoice_method': 'manual',
+                    'shipment_method': 'order',
+
+                    # Explicitly specify the shop
+                    'shop': Shop(self.shop).id,
+                }])
+                self.SaleLine.create([{
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': 20000,
+                    'description': 'Picked Item',
+                    'product': self.product1.id
+                }, {
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'ship',
+                    'unit': self.uom,
+                    'unit_price': 20000,
+                    'description': 'Shipped Item',
+                    'product': self.product1.id
+                }])
+
+                # Quote, Confirm and Process the order
+                self.Sale.quote([sale])
+                self.Sale.confirm([sale])
+                self.Sale.process([sale])
+
+                self.assertEqual(len(sale.shipments), 2)
+                for shipment in sale.shipments:
+                    if shipment.delivery_mode == 'pick_up':
+                        self.assertEqual(shipment.state, 'done')
+                        self.assertEqual(
+                            shipment.warehouse, self.shop.warehouse
+                        )
+                    elif shipment.delivery_mode == 'ship':
+                        self.assertEqual(shipment.state, 'waiting')
+                        self.assertEqual(
+                            shipment.warehouse, self.shop.ship_from_warehouse
+                        )
+                    else:
+                        self.fail('Invalid delivery mode')
+
+    def test_1010_delivery_method_2shipping_case_1(self):
+        """
+        Ensure shipment method is respected by sale order processing
+
+        Case 1: Ship only order
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale, = self.Sale.create([{
+                'reference': 'Test Sale',
+                'payment_term': self.payment_term,
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': Date.today(),
+                'company': self.company.id,
+
+                # keep invoicing out of the way for this test's sake
+                'invoice_method': 'manual',
+                'shipment_method': 'order',
+            }])
+            sale_line, = self.SaleLine.create([{
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'ship',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Test description',
+                'product': self.product1.id
+            }])
+
+            # Quote, Confirm and Process the order
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+
+            self.assertEqual(len(sale.shipments), 1)
+            self.assertEqual(sale.shipments[0].delivery_mode, 'ship')
+            self.assertEqual(sale.shipments[0].state, 'waiting')
+
+    def test_1020_delivery_method_2shipping_case_2(self):
+        """
+        Ensure shipment method is respected by sale order processing
+
+        Case 2: Pick up only order
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale, = self.Sale.create([{
+                'reference': 'Test Sale',
+                'payment_term': self.payment_term,
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': Date.today(),
+                'company': self.company.id,
+
+                # keep invoicing out of the way for this test's sake
+                'invoice_method': 'manual',
+                'shipment_method': 'order',
+            }])
+            sale_line, = self.SaleLine.create([{
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'pick_up',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Test description',
+                'product': self.product1.id
+            }])
+
+            # Quote, Confirm and Process the order
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+
+            self.assertEqual(len(sale.shipments), 1)
+            self.assertEqual(sale.shipments[0].delivery_mode, 'pick_up')
+            self.assertEqual(sale.shipments[0].state, 'done')
+
+    def test_1030_delivery_method_2shipping_case_3(self):
+        """
+        Ensure shipment method is respected by sale order processing
+
+        Case 2: Pick up + Ship order for same item
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale, = self.Sale.create([{
+                'reference': 'Test Sale',
+                'payment_term': self.payment_term,
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': Date.today(),
+                'company': self.company.id,
+
+                # keep invoicing out of the way for this test's sake
+                'invoice_method': 'manual',
+                'shipment_method': 'order',
+            }])
+            self.SaleLine.create([{
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'pick_up',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Picked Item',
+                'product': self.product1.id
+            }, {
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'ship',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Shipped Item',
+                'product': self.product1.id
+            }])
+
+            # Quote, Confirm and Process the order
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+
+            self.assertEqual(len(sale.shipments), 2)
+            for shipment in sale.shipments:
+                if shipment.delivery_mode == 'pick_up':
+                    self.assertEqual(shipment.state, 'done')
+                elif shipment.delivery_mode == 'ship':
+                    self.assertEqual(shipment.state, 'waiting')
+                else:
+                    self.fail('Invalid delivery mode')
+
+    def test_1040_delivery_method_2shipping_case_4(self):
+        """
+        Manual shipping should just go ahead without messing with new
+        workflow
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale, = self.Sale.create([{
+                'reference': 'Test Sale',
+                'payment_term': self.payment_term,
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': Date.today(),
+                'company': self.company.id,
+
+                # keep invoicing out of the way for this test's sake
+                'invoice_method': 'manual',
+                'shipment_method': 'manual',
+            }])
+            self.SaleLine.create([{
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'pick_up',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Picked Item',
+                'product': self.product1.id
+            }, {
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'ship',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Shipped Item',
+                'product': self.product1.id
+            }])
+
+            # Quote, Confirm and Process the order
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+            self.assertEqual(len(sale.shipments), 0)
+
+    def test_1050_delivery_method_2shipping_case_5(self):
+        """
+        Return Shipment
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale, = self.Sale.create([{
+                'reference': 'Test Sale',
+                'payment_term': self.payment_term,
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': Date.today(),
+                'company': self.company.id,
+
+                # keep invoicing out of the way for this test's sake
+                'invoice_method': 'manual',
+                'shipment_method': 'order',
+            }])
+            self.SaleLine.create([{
+                'sale': sale,
+                'type': 'line',
+                'quantity': -2,
+                'delivery_mode': 'pick_up',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Picked Item',
+                'product': self.product1.id
+            }])
+
+            # Quote, Confirm and Process the order
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+            self.assertEqual(len(sale.shipments), 0)
+            self.assertEqual(len(sale.shipment_returns), 1)
+
+    def test_1090_default_delivery_methods(self):
+        """
+        Defaults should be to ship products
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            ShipmentOut = POOL.get('stock.shipment.out')
+            ShipmentOutReturn = POOL.get('stock.shipment.out.return')
+
+            with Transaction().set_context({'company': self.company.id}):
+                shipment, = ShipmentOut.create([{
+                    'customer': self.party.id,
+                    'delivery_address': self.party.addresses[0].id,
+                }])
+                self.assertEqual(shipment.delivery_mode, 'ship')
+
+                shipment_return, = ShipmentOutReturn.create([{
+                    'customer': self.party.id,
+                    'delivery_address': self.party.addresses[0].id,
+                }])
+                self.assertEqual(shipment_return.delivery_mode, 'ship')
+
+    def test_1110_shipment_invoice_case_1(self):
+        """
+        Ensure that a posted invoice is created when a picked up order is
+        processed.
+
+        For the ship order, since nothing has been shipped, there should be
+        no invoices
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale, = self.Sale.create([{
+                'reference': 'Test Sale',
+                'payment_term': self.payment_term,
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': Date.today(),
+                'company': self.company.id,
+
+                # keep invoicing out of the way for this test's sake
+                'invoice_method': 'shipment',
+                'shipment_method': 'order',
+            }])
+            sale_line, = self.SaleLine.create([{
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'ship',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Test description',
+                'product': self.product1.id
+            }])
+
+            # Quote, Confirm and Process the order
+            self.Sale.quote([sale])
+            self.Sale.confirm([sale])
+            self.Sale.process([sale])
+
+            self.assertEqual(len(sale.shipments), 1)
+            self.assertEqual(sale.shipments[0].delivery_mode, 'ship')
+            self.assertEqual(sale.shipments[0].state, 'waiting')
+
+            self.assertEqual(len(sale.invoices), 0)
+
+    def test_1120_shipment_invoice_case_2(self):
+        """
+        Ensure that a posted invoice is created when a picked up order is
+        processed
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale, = self.Sale.create([{
+                'reference': 'Test Sale',
+                'payment_term': self.payment_term,
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': Date.today(),
+                'company': self.company.id,
+
+                # keep invoicing out of the way for this test's sake
+                'invoice_method': 'shipment',
+                'shipment_method': 'order',
+            }])
+            sale_line, = self.SaleLine.create([{
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'pick_up',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Test description',
+                'product': self.product1.id
+            }])
+
+            with Transaction().set_context({'company': self.company.id}):
+                # Quote, Confirm and Process the order
+                self.Sale.quote([sale])
+                self.Sale.confirm([sale])
+                self.Sale.process([sale])
+
+                self.assertEqual(len(sale.shipments), 1)
+                self.assertEqual(sale.shipments[0].delivery_mode, 'pick_up')
+                self.assertEqual(sale.shipments[0].state, 'done')
+
+                self.assertEqual(len(sale.invoices), 1)
+                self.assertEqual(sale.invoices[0].state, 'posted')
+
+    def test_1130_delivery_method_2shipping_case_3(self):
+        """
+        Ensure shipment method is respected by sale order processing.
+        Ensures that there is only one invoice created and that it is posted.
+
+        Case 3: Pick up + Ship order for same item
+        """
+        Date = POOL.get('ir.date')
+        Shipment = POOL.get('stock.shipment.out')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            sale, = self.Sale.create([{
                 'reference': 'Test Sale',
                 'payment_term': self.payment_term,
                 'currency': self.company.currency.id,
@@ -814,53 +2462,232 @@ class TestSale(unittest.TestCase):
                 'sale_date': Date.today(),
                 'company': self.company.id,
 
-                # keep invoicing out of the way for this test's sake
-                'invoice_method': 'manual',
-                'shipment_method': 'order',
-            }])
-            self.SaleLine.create([{
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'pick_up',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Picked Item',
-                'product': self.product1.id
-            }, {
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'ship',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Shipped Item',
-                'product': self.product1.id
-            }])
+                # keep invoicing out of the way for this test's sake
+                'invoice_method': 'shipment',
+                'shipment_method': 'order',
+            }])
+            self.SaleLine.create([{
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'pick_up',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Picked Item',
+                'product': self.product1.id
+            }, {
+                'sale': sale,
+                'type': 'line',
+                'quantity': 2,
+                'delivery_mode': 'ship',
+                'unit': self.uom,
+                'unit_price': 20000,
+                'description': 'Shipped Item',
+                'product': self.product1.id
+            }])
+
+            with Transaction().set_context({'company': self.company.id}):
+                # Quote, Confirm and Process the order
+                self.Sale.quote([sale])
+                self.Sale.confirm([sale])
+                self.Sale.process([sale])
+
+            self.assertEqual(len(sale.shipments), 2)
+            for shipment in sale.shipments:
+                if shipment.delivery_mode == 'pick_up':
+                    self.assertEqual(shipment.state, 'done')
+                elif shipment.delivery_mode == 'ship':
+                    self.assertEqual(shipment.state, 'waiting')
+                    delivery_shipment = shipment        # used later in test
+                else:
+                    self.fail('Invalid delivery mode')
+
+            self.assertEqual(len(sale.invoices), 1)
+            self.assertEqual(sale.invoices[0].state, 'posted')
+
+            with Transaction().set_context({'company': self.company.id}):
+                # Now process the delivered shipment as if its been shipped
+                Shipment.assign_force([delivery_shipment])
+                Shipment.pack([delivery_shipment])
+                Shipment.done([delivery_shipment])
+
+                self.assertEqual(len(sale.invoices), 2)
+                self.assertEqual(sale.invoices[0].state, 'posted')
+                self.assertEqual(sale.invoices[1].state, 'posted')
+
+    def test_1140_serialize_recent_sales(self):
+        """
+        Test that sale order which are recently updated or create are on top.
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(shop=self.shop.id):
+                sale1, = self.Sale.create([{
+                    'reference': 'Test Sale 1',
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'sale_date': Date.today(),
+                    'company': self.company.id,
+                }])
+                sale2, = self.Sale.create([{
+                    'reference': 'Test Sale 2',
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'sale_date': Date.today(),
+                    'company': self.company.id,
+                }])
+
+                sale3, = self.Sale.create([{
+                    'reference': 'Test Sale 3',
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'sale_date': Date.today(),
+                    'company': self.company.id,
+                }])
+                sale4, = self.Sale.create([{
+                    'reference': 'Test Sale 4',
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'sale_date': Date.today(),
+                    'company': self.company.id,
+                }])
+
+                saleLine1, = self.SaleLine.create([{
+                    'sale': sale1,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': 20000,
+                    'description': 'Picked Item',
+                    'product': self.product1.id
+                }])
+                saleLine2, = self.SaleLine.create([{
+                    'sale': sale2,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': 20000,
+                    'description': 'Picked Item',
+                    'product': self.product1.id
+                }])
+                saleLine3, = self.SaleLine.create([{
+                    'sale': sale3,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': 20000,
+                    'description': 'Picked Item',
+                    'product': self.product1.id
+                }])
+                saleLine4, = self.SaleLine.create([{
+                    'sale': sale4,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': 20000,
+                    'description': 'Picked Item',
+                    'product': self.product1.id
+                }])
 
-            # Quote, Confirm and Process the order
-            self.Sale.quote([sale])
-            self.Sale.confirm([sale])
-            self.Sale.process([sale])
+                rv = self.Sale.get_recent_sales()
+                self.assertEqual(len(rv), 4)
 
-            self.assertEqual(len(sale.shipments), 2)
-            for shipment in sale.shipments:
-                if shipment.delivery_mode == 'pick_up':
-                    self.assertEqual(shipment.state, 'done')
-                elif shipment.delivery_mode == 'ship':
-                    self.assertEqual(shipment.state, 'waiting')
-                else:
-                    self.fail('Invalid delivery mode')
+                # Test serialized data
+                self.assertIn('id', rv[0])
+                self.assertIn('party', rv[0])
+                self.assertIn('total_amount', rv[0])
+                self.assertIn('create_date', rv[0])
 
-    def test_1040_delivery_method_2shipping_case_4(self):
+    def test_1150_recent_sales_pagination(self):
         """
-        Manual shipping should just go ahead without messing with new
-        workflow
+        Test that recent sales are distinct and can be paginated
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(shop=self.shop.id):
+                sales = self.Sale.create([{
+                    'reference': 'Test Sale %d' % index,
+                    'payment_term': self.payment_term,
+                    'currency': self.company.currency.id,
+                    'party': self.party.id,
+                    'invoice_address': self.party.addresses[0].id,
+                    'shipment_address': self.party.addresses[0].id,
+                    'sale_date': Date.today(),
+                    'company': self.company.id,
+                } for index in range(3)])
+
+                # Two lines on the first sale must not duplicate it
+                self.SaleLine.create([{
+                    'sale': sale,
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': Decimal('10'),
+                    'description': 'Picked Item',
+                    'product': product.id,
+                } for sale, product in [
+                    (sales[0], self.product1),
+                    (sales[0], self.product2),
+                    (sales[1], self.product1),
+                    (sales[2], self.product1),
+                ]])
+
+                rv = self.Sale.get_recent_sales()
+                self.assertEqual(len(rv), 3)
+                self.assertEqual(
+                    sorted(r['id'] for r in rv), sorted(map(int, sales))
+                )
+                sale_data, = [r for r in rv if r['id'] == sales[0].id]
+                self.assertEqual(sale_data['total_amount'], Decimal('40'))
+                self.assertEqual(sale_data['party']['name'], self.party.name)
+
+                first_page = self.Sale.get_recent_sales(limit=2)
+                second_page = self.Sale.get_recent_sales(limit=2, offset=2)
+                self.assertEqual(len(first_page), 2)
+                self.assertEqual(len(second_page), 1)
+                self.assertEqual(
+                    [r['id'] for r in first_page + second_page],
+                    [r['id'] for r in rv]
+                )
+
+            with Transaction().set_context(shop=self.shop1.id):
+                self.assertEqual(self.Sale.get_recent_sales(), [])
+
+    def test_1160_deferred_pick_up_fulfilment(self):
+        """
+        Ensure that the picked up shipments are left pending for the
+        fulfilment job when the shop defers it
         """
         Date = POOL.get('ir.date')
+        Shop = POOL.get('sale.shop')
+        ShipmentOut = POOL.get('stock.shipment.out')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
+            Shop.write([self.shop], {'pick_up_fulfilment': 'deferred'})
 
             sale, = self.Sale.create([{
                 'reference': 'Test Sale',
@@ -871,10 +2698,8 @@ class TestSale(unittest.TestCase):
                 'shipment_address': self.party.addresses[0].id,
                 'sale_date': Date.today(),
                 'company': self.company.id,
-
-                # keep invoicing out of the way for this test's sake
-                'invoice_method': 'manual',
-                'shipment_method': 'manual',
+                'invoice_method': 'shipment',
+                'shipment_method': 'order',
             }])
             self.SaleLine.create([{
                 'sale': sale,
@@ -883,36 +2708,47 @@ class TestSale(unittest.TestCase):
                 'delivery_mode': 'pick_up',
                 'unit': self.uom,
                 'unit_price': 20000,
-                'description': 'Picked Item',
-                'product': self.product1.id
-            }, {
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'ship',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Shipped Item',
+                'description': 'Test description',
                 'product': self.product1.id
             }])
 
-            # Quote, Confirm and Process the order
-            self.Sale.quote([sale])
-            self.Sale.confirm([sale])
-            self.Sale.process([sale])
-            self.assertEqual(len(sale.shipments), 0)
+            with Transaction().set_context({'company': self.company.id}):
+                self.Sale.quote([sale])
+                self.Sale.confirm([sale])
+                self.Sale.process([sale])
 
-    def test_1050_delivery_method_2shipping_case_5(self):
+                shipment, = sale.shipments
+                self.assertEqual(shipment.delivery_mode, 'pick_up')
+                self.assertEqual(shipment.state, 'waiting')
+                self.assertEqual(shipment.pos_fulfilment_state, 'pending')
+                self.assertEqual(len(sale.invoices), 0)
+
+                pending = ShipmentOut.search([
+                    ('pos_fulfilment_state', '=', 'pending'),
+                ])
+                self.assertEqual(pending, [shipment])
+                ShipmentOut.fulfil_pos_pick_up(pending)
+
+                sale = self.Sale(sale.id)
+                self.assertEqual(sale.shipments[0].state, 'done')
+                self.assertEqual(len(sale.invoices), 1)
+                self.assertEqual(sale.invoices[0].state, 'posted')
+
+    def test_1165_process_pos_fulfilment(self):
         """
-        Return Shipment
+        Ensure that the fulfilment job fulfils the pending shipments and
+        records the failures, marking the shipment as failed after the
+        maximum number of attempts
         """
         Date = POOL.get('ir.date')
+        Shop = POOL.get('sale.shop')
+        ShipmentOut = POOL.get('stock.shipment.out')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
+            Shop.write([self.shop], {'pick_up_fulfilment': 'deferred'})
 
-            sale, = self.Sale.create([{
-                'reference': 'Test Sale',
+            sales = self.Sale.create([{
                 'payment_term': self.payment_term,
                 'currency': self.company.currency.id,
                 'party': self.party.id,
@@ -920,113 +2756,134 @@ class TestSale(unittest.TestCase):
                 'shipment_address': self.party.addresses[0].id,
                 'sale_date': Date.today(),
                 'company': self.company.id,
-
-                # keep invoicing out of the way for this test's sake
-                'invoice_method': 'manual',
+                'invoice_method': 'shipment',
                 'shipment_method': 'order',
-            }])
-            self.SaleLine.create([{
-                'sale': sale,
-                'type': 'line',
-                'quantity': -2,
-                'delivery_mode': 'pick_up',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Picked Item',
-                'product': self.product1.id
-            }])
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': 200,
+                    'description': 'Test description',
+                    'product': self.product1.id,
+                }])],
+            } for index in range(2)])
 
-            # Quote, Confirm and Process the order
-            self.Sale.quote([sale])
-            self.Sale.confirm([sale])
-            self.Sale.process([sale])
-            self.assertEqual(len(sale.shipments), 0)
-            self.assertEqual(len(sale.shipment_returns), 1)
+            with Transaction().set_context({'company': self.company.id}):
+                self.Sale.quote(sales)
+                self.Sale.confirm(sales)
+                self.Sale.process(sales)
 
-    def test_1090_default_delivery_methods(self):
-        """
-        Defaults should be to ship products
-        """
-        with Transaction().start(DB_NAME, USER, context=CONTEXT):
-            self.setup_defaults()
+            failing, other = [
+                self.Sale(sale.id).shipments[0] for sale in sales
+            ]
+            fulfil = ShipmentOut.fulfil_pos_pick_up
+
+            def fulfil_or_fail(cls, shipments):
+                if failing in shipments:
+                    raise Exception('Fulfilment failed')
+                fulfil(shipments)
+
+            ShipmentOut.fulfil_pos_pick_up = classmethod(fulfil_or_fail)
+            try:
+                with self.run_new_cursors_in_test():
+                    with self.capture_logs('pos.fulfilment') as records:
+                        # The batch fails, then each shipment is retried
+                        ShipmentOut.process_pos_fulfilment()
+                        self.assertEqual(len(records), 2)
+                        failing = ShipmentOut(failing.id)
+                        other = ShipmentOut(other.id)
+                        self.assertEqual(other.state, 'done')
+                        self.assertEqual(other.pos_fulfilment_state, 'done')
+                        self.assertEqual(failing.pos_fulfilment_attempts, 1)
+                        self.assertIn(
+                            'Fulfilment failed', failing.pos_fulfilment_error
+                        )
+                        self.assertEqual(
+                            failing.pos_fulfilment_state, 'pending'
+                        )
 
-            ShipmentOut = POOL.get('stock.shipment.out')
-            ShipmentOutReturn = POOL.get('stock.shipment.out.return')
+                        # A batch of one shipment is not retried
+                        ShipmentOut.process_pos_fulfilment()
+                        self.assertEqual(len(records), 3)
+                        failing = ShipmentOut(failing.id)
+                        self.assertEqual(failing.pos_fulfilment_attempts, 2)
 
-            with Transaction().set_context({'company': self.company.id}):
-                shipment, = ShipmentOut.create([{
-                    'customer': self.party.id,
-                    'delivery_address': self.party.addresses[0].id,
-                }])
-                self.assertEqual(shipment.delivery_mode, 'ship')
+                        ShipmentOut.process_pos_fulfilment()
+                        failing = ShipmentOut(failing.id)
+                        self.assertEqual(failing.pos_fulfilment_attempts, 3)
+                        self.assertEqual(
+                            failing.pos_fulfilment_state, 'failed'
+                        )
+                        self.assertEqual(failing.state, 'waiting')
 
-                shipment_return, = ShipmentOutReturn.create([{
-                    'customer': self.party.id,
-                    'delivery_address': self.party.addresses[0].id,
-                }])
-                self.assertEqual(shipment_return.delivery_mode, 'ship')
+                        # The failed shipments are not tried anymore
+                        ShipmentOut.process_pos_fulfilment()
+                        self.assertEqual(len(records), 4)
+            finally:
+                del ShipmentOut.fulfil_pos_pick_up
 
-    def test_1110_shipment_invoice_case_1(self):
+    def test_1170_process_sales_chunk(self):
         """
-        Ensure that a posted invoice is created when a picked up order is
-        processed.
-
-        For the ship order, since nothing has been shipped, there should be
-        no invoices
+        Ensure that the invoices created from the shipments of the sales
+        processed together are posted together
         """
         Date = POOL.get('ir.date')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
 
-            sale, = self.Sale.create([{
-                'reference': 'Test Sale',
+            sales = self.Sale.create([{
                 'payment_term': self.payment_term,
                 'currency': self.company.currency.id,
                 'party': self.party.id,
                 'invoice_address': self.party.addresses[0].id,
                 'shipment_address': self.party.addresses[0].id,
                 'sale_date': Date.today(),
-                'company': self.company.id,
-
-                # keep invoicing out of the way for this test's sake
-                'invoice_method': 'shipment',
-                'shipment_method': 'order',
-            }])
-            sale_line, = self.SaleLine.create([{
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'ship',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Test description',
-                'product': self.product1.id
-            }])
-
-            # Quote, Confirm and Process the order
-            self.Sale.quote([sale])
-            self.Sale.confirm([sale])
-            self.Sale.process([sale])
-
-            self.assertEqual(len(sale.shipments), 1)
-            self.assertEqual(sale.shipments[0].delivery_mode, 'ship')
-            self.assertEqual(sale.shipments[0].state, 'waiting')
-
-            self.assertEqual(len(sale.invoices), 0)
+                'company': self.company.id,
+                'invoice_method': 'shipment',
+                'shipment_method': 'order',
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': 200,
+                    'description': 'Test description',
+                    'product': self.product1.id
+                }])],
+            } for index in range(3)])
 
-    def test_1120_shipment_invoice_case_2(self):
+            with Transaction().set_context({'company': self.company.id}):
+                self.Sale.quote(sales)
+                self.Sale.confirm(sales)
+
+                with Transaction().set_context(pos_defer_invoice_post=True):
+                    self.Sale.process(sales[:1])
+                invoice, = sales[0].invoices
+                self.assertEqual(invoice.state, 'draft')
+
+                invoices = self.Sale.pos_process_sales_chunk(sales)
+                self.assertEqual(len(invoices), 3)
+                for sale in self.Sale.browse(map(int, sales)):
+                    self.assertEqual(sale.state, 'processing')
+                    invoice, = sale.invoices
+                    self.assertEqual(invoice.state, 'posted')
+                    self.assertEqual(sale.shipments[0].state, 'done')
+
+    def test_1175_pos_process_sales(self):
         """
-        Ensure that a posted invoice is created when a picked up order is
-        processed
+        Ensure that the sales of a failing chunk are processed one by one and
+        that the failures are returned with their error
         """
+        from trytond.exceptions import UserError
+
         Date = POOL.get('ir.date')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
 
-            sale, = self.Sale.create([{
-                'reference': 'Test Sale',
+            sales = self.Sale.create([{
                 'payment_term': self.payment_term,
                 'currency': self.company.currency.id,
                 'party': self.party.id,
@@ -1034,50 +2891,73 @@ class TestSale(unittest.TestCase):
                 'shipment_address': self.party.addresses[0].id,
                 'sale_date': Date.today(),
                 'company': self.company.id,
-
-                # keep invoicing out of the way for this test's sake
                 'invoice_method': 'shipment',
                 'shipment_method': 'order',
-            }])
-            sale_line, = self.SaleLine.create([{
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'pick_up',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Test description',
-                'product': self.product1.id
-            }])
-
-            with Transaction().set_context({'company': self.company.id}):
-                # Quote, Confirm and Process the order
-                self.Sale.quote([sale])
-                self.Sale.confirm([sale])
-                self.Sale.process([sale])
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 2,
+                    'delivery_mode': 'pick_up',
+                    'unit': self.uom,
+                    'unit_price': 200,
+                    'description': 'Test description',
+                    'product': self.product1.id
+                }])],
+            } for index in range(5)])
+            refused, failing = sales[1], sales[3]
+            process_chunk = self.Sale.pos_process_sales_chunk
 
-                self.assertEqual(len(sale.shipments), 1)
-                self.assertEqual(sale.shipments[0].delivery_mode, 'pick_up')
-                self.assertEqual(sale.shipments[0].state, 'done')
+            def process_chunk_or_fail(cls, sales):
+                if refused in sales:
+                    raise UserError('Processing refused')
+                if failing in sales:
+                    raise Exception('Processing failed')
+                return process_chunk(sales)
 
-                self.assertEqual(len(sale.invoices), 1)
-                self.assertEqual(sale.invoices[0].state, 'posted')
+            with Transaction().set_context({'company': self.company.id}):
+                self.Sale.quote(sales)
+                self.Sale.confirm(sales)
 
-    def test_1130_delivery_method_2shipping_case_3(self):
+                chunk_size = self.Sale._pos_process_chunk_size
+                self.Sale._pos_process_chunk_size = 2
+                self.Sale.pos_process_sales_chunk = classmethod(
+                    process_chunk_or_fail
+                )
+                try:
+                    with self.run_new_cursors_in_test():
+                        with self.capture_logs('pos.sale') as records:
+                            failures = self.Sale.pos_process_sales(sales)
+                finally:
+                    del self.Sale.pos_process_sales_chunk
+                    self.Sale._pos_process_chunk_size = chunk_size
+
+                self.assertEqual(failures, [{
+                    'sale': refused.id,
+                    'error': 'Processing refused',
+                }, {
+                    'sale': failing.id,
+                    'error': 'Processing failed',
+                }])
+                self.assertEqual(len(records), 4)
+                for sale in self.Sale.browse(map(int, sales)):
+                    if sale in (refused, failing):
+                        self.assertEqual(sale.state, 'confirmed')
+                        continue
+                    self.assertEqual(sale.state, 'processing')
+                    invoice, = sale.invoices
+                    self.assertEqual(invoice.state, 'posted')
+
+    def test_1180_shipment_grouping_delivery_modes(self):
         """
-        Ensure shipment method is respected by sale order processing.
-        Ensures that there is only one invoice created and that it is posted.
-
-        Case 3: Pick up + Ship order for same item
+        Ensure that the delivery modes used to group the moves in shipments
+        are read once per create_shipment call
         """
         Date = POOL.get('ir.date')
-        Shipment = POOL.get('stock.shipment.out')
+        Move = POOL.get('stock.move')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
 
             sale, = self.Sale.create([{
-                'reference': 'Test Sale',
                 'payment_term': self.payment_term,
                 'currency': self.company.currency.id,
                 'party': self.party.id,
@@ -1085,161 +2965,307 @@ class TestSale(unittest.TestCase):
                 'shipment_address': self.party.addresses[0].id,
                 'sale_date': Date.today(),
                 'company': self.company.id,
-
-                # keep invoicing out of the way for this test's sake
-                'invoice_method': 'shipment',
+                'invoice_method': 'manual',
                 'shipment_method': 'order',
-            }])
-            self.SaleLine.create([{
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'pick_up',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Picked Item',
-                'product': self.product1.id
-            }, {
-                'sale': sale,
-                'type': 'line',
-                'quantity': 2,
-                'delivery_mode': 'ship',
-                'unit': self.uom,
-                'unit_price': 20000,
-                'description': 'Shipped Item',
-                'product': self.product1.id
+                'lines': [('create', [{
+                    'type': 'line',
+                    'quantity': 1,
+                    'delivery_mode': delivery_mode,
+                    'unit': self.uom,
+                    'unit_price': 200,
+                    'description': 'Test description',
+                    'product': self.product1.id
+                } for delivery_mode in ['ship', 'ship', 'ship']])],
             }])
 
             with Transaction().set_context({'company': self.company.id}):
-                # Quote, Confirm and Process the order
                 self.Sale.quote([sale])
                 self.Sale.confirm([sale])
-                self.Sale.process([sale])
-
-            self.assertEqual(len(sale.shipments), 2)
-            for shipment in sale.shipments:
-                if shipment.delivery_mode == 'pick_up':
-                    self.assertEqual(shipment.state, 'done')
-                elif shipment.delivery_mode == 'ship':
-                    self.assertEqual(shipment.state, 'waiting')
-                    delivery_shipment = shipment        # used later in test
-                else:
-                    self.fail('Invalid delivery mode')
 
-            self.assertEqual(len(sale.invoices), 1)
-            self.assertEqual(sale.invoices[0].state, 'posted')
-
-            with Transaction().set_context({'company': self.company.id}):
-                # Now process the delivered shipment as if its been shipped
-                Shipment.assign_force([delivery_shipment])
-                Shipment.pack([delivery_shipment])
-                Shipment.done([delivery_shipment])
+                # The cached delivery modes take precedence over the lines
+                cache = self.Sale._pos_delivery_modes_cache()
+                line = sale.lines[0]
+                moves = [Move(planned_date=Date.today())]
+                cache[sale.id] = {line.id: 'pick_up'}
+                key = dict(sale._group_shipment_key(moves, (line.id, None)))
+                self.assertEqual(key['delivery_mode'], 'pick_up')
+                del cache[sale.id]
+                key = dict(sale._group_shipment_key(moves, (line.id, None)))
+                self.assertEqual(key['delivery_mode'], 'ship')
 
-                self.assertEqual(len(sale.invoices), 2)
-                self.assertEqual(sale.invoices[0].state, 'posted')
-                self.assertEqual(sale.invoices[1].state, 'posted')
+                self.Sale.process([sale])
+                self.assertEqual(cache, {})
+                shipment, = sale.shipments
+                self.assertEqual(shipment.delivery_mode, 'ship')
+                self.assertEqual(len(shipment.outgoing_moves), 3)
 
-    def test_1140_serialize_recent_sales(self):
+    def test_1190_pos_summary(self):
         """
-        Test that sale order which are recently updated or create are on top.
+        Ensure that the processed sales are added to the summaries of their
+        shop once by the cron and that the Z-report is computed from them
+        and from the sales not summarized yet
         """
+        from trytond.exceptions import UserError
+
         Date = POOL.get('ir.date')
+        POSSummary = POOL.get('sale.shop.pos_summary')
 
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.setup_defaults()
+            today = Date.today()
+            tax, = self.product3.template.customer_taxes
 
-            with Transaction().set_context(shop=self.shop.id):
-                sale1, = self.Sale.create([{
-                    'reference': 'Test Sale 1',
-                    'payment_term': self.payment_term,
-                    'currency': self.company.currency.id,
-                    'party': self.party.id,
-                    'invoice_address': self.party.addresses[0].id,
-                    'shipment_address': self.party.addresses[0].id,
-                    'sale_date': Date.today(),
-                    'company': self.company.id,
-                }])
-                sale2, = self.Sale.create([{
-                    'reference': 'Test Sale 2',
-                    'payment_term': self.payment_term,
-                    'currency': self.company.currency.id,
-                    'party': self.party.id,
-                    'invoice_address': self.party.addresses[0].id,
-                    'shipment_address': self.party.addresses[0].id,
-                    'sale_date': Date.today(),
-                    'company': self.company.id,
-                }])
-
-                sale3, = self.Sale.create([{
-                    'reference': 'Test Sale 3',
-                    'payment_term': self.payment_term,
-                    'currency': self.company.currency.id,
-                    'party': self.party.id,
-                    'invoice_address': self.party.addresses[0].id,
-                    'shipment_address': self.party.addresses[0].id,
-                    'sale_date': Date.today(),
-                    'company': self.company.id,
-                }])
-                sale4, = self.Sale.create([{
-                    'reference': 'Test Sale 4',
-                    'payment_term': self.payment_term,
-                    'currency': self.company.currency.id,
-                    'party': self.party.id,
-                    'invoice_address': self.party.addresses[0].id,
-                    'shipment_address': self.party.addresses[0].id,
-                    'sale_date': Date.today(),
-                    'company': self.company.id,
-                }])
-
-                saleLine1, = self.SaleLine.create([{
-                    'sale': sale1,
-                    'type': 'line',
-                    'quantity': 2,
-                    'delivery_mode': 'pick_up',
-                    'unit': self.uom,
-                    'unit_price': 20000,
-                    'description': 'Picked Item',
-                    'product': self.product1.id
-                }])
-                saleLine2, = self.SaleLine.create([{
-                    'sale': sale2,
+            sales = self.Sale.create([{
+                'payment_term': self.payment_term,
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'shop': self.shop.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': today,
+                'company': self.company.id,
+                'invoice_method': 'order',
+                'shipment_method': 'order',
+                'lines': [('create', [{
                     'type': 'line',
                     'quantity': 2,
                     'delivery_mode': 'pick_up',
                     'unit': self.uom,
-                    'unit_price': 20000,
-                    'description': 'Picked Item',
-                    'product': self.product1.id
-                }])
-                saleLine3, = self.SaleLine.create([{
-                    'sale': sale3,
+                    'unit_price': 200,
+                    'description': 'Test description',
+                    'product': self.product1.id,
+                }, {
                     'type': 'line',
-                    'quantity': 2,
-                    'delivery_mode': 'pick_up',
+                    'quantity': 1,
+                    'delivery_mode': 'ship',
                     'unit': self.uom,
-                    'unit_price': 20000,
-                    'description': 'Picked Item',
-                    'product': self.product1.id
+                    'unit_price': 100,
+                    'description': 'Test description',
+                    'product': self.product3.id,
+                    'taxes': [('add', [tax.id])],
+                }, {
+                    'type': 'comment',
+                    'description': 'Thank you',
+                }])],
+            } for index in range(2)])
+
+            with Transaction().set_context({'company': self.company.id}):
+                self.Sale.quote(sales)
+                self.Sale.confirm(sales)
+                self.Sale.process(sales[:1])
+                POSSummary.add_pending_sales()
+                self.assertTrue(self.Sale(sales[0].id).pos_summarized)
+                self.Sale.process(sales)
+                self.assertFalse(self.Sale(sales[1].id).pos_summarized)
+
+                report = POSSummary.get_z_report(self.shop.id, today, today)
+                total, = report['totals']
+                sale_tax_amount = sales[0].tax_amount
+                self.assertEqual(total['sale_count'], 2)
+                self.assertEqual(total['untaxed_amount'], Decimal('1000'))
+                self.assertEqual(total['tax_amount'], 2 * sale_tax_amount)
+                self.assertEqual(
+                    total['total_amount'],
+                    Decimal('1000') + 2 * sale_tax_amount
+                )
+                day, = report['days']
+                self.assertEqual(day['date'], today)
+                self.assertEqual(day['total_amount'], total['total_amount'])
+
+                delivery_modes = dict(
+                    (values['delivery_mode'], values)
+                    for values in report['delivery_modes']
+                )
+                self.assertEqual(
+                    delivery_modes['pick_up']['untaxed_amount'],
+                    Decimal('800')
+                )
+                self.assertEqual(delivery_modes['pick_up']['tax_amount'], 0)
+                self.assertEqual(
+                    delivery_modes['ship']['untaxed_amount'], Decimal('200')
+                )
+                self.assertEqual(
+                    delivery_modes['ship']['tax_amount'], 2 * sale_tax_amount
+                )
+                tax_total, = report['taxes']
+                self.assertEqual(tax_total['tax']['id'], tax.id)
+                self.assertEqual(tax_total['untaxed_amount'], Decimal('200'))
+                payment_term, = report['payment_terms']
+                self.assertEqual(
+                    payment_term['payment_term']['id'], self.payment_term.id
+                )
+                self.assertEqual(payment_term['sale_count'], 2)
+
+                # The summaries give the same totals and adding the sales
+                # again does not count them twice
+                POSSummary.add_pending_sales()
+                POSSummary.add_pending_sales()
+                POSSummary.add_sales(self.Sale.browse(map(int, sales)))
+                self.assertTrue(self.Sale(sales[1].id).pos_summarized)
+                self.assertEqual(
+                    POSSummary.get_z_report(self.shop.id, today, today),
+                    report
+                )
+
+                # The rebuild gives the same totals
+                POSSummary.rebuild([self.shop.id], today, today)
+                self.assertEqual(
+                    POSSummary.get_z_report(self.shop.id, today, today),
+                    report
+                )
+                self.assertEqual(
+                    POSSummary.get_z_report(
+                        self.shop.id, today + relativedelta(days=1),
+                        today + relativedelta(days=1)
+                    )['totals'], []
+                )
+
+                # Only the administrators can rebuild the summaries
+                user, = self.User.create([{
+                    'name': 'Cashier',
+                    'login': 'cashier',
                 }])
-                saleLine4, = self.SaleLine.create([{
-                    'sale': sale4,
+                with Transaction().set_user(user.id):
+                    with self.assertRaises(UserError):
+                        POSSummary.rebuild([self.shop.id], today, today)
+
+    def test_1200_pos_export_sales(self):
+        """
+        Ensure that the sales of a shop are exported in chunks as NDJSON and
+        as CSV
+        """
+        Date = POOL.get('ir.date')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.setup_defaults()
+            today = Date.today()
+
+            sales = self.Sale.create([{
+                'currency': self.company.currency.id,
+                'party': self.party.id,
+                'shop': self.shop.id,
+                'invoice_address': self.party.addresses[0].id,
+                'shipment_address': self.party.addresses[0].id,
+                'sale_date': today - relativedelta(days=index),
+                'company': self.company.id,
+                'lines': [('create', [{
                     'type': 'line',
-                    'quantity': 2,
+                    'quantity': quantity,
                     'delivery_mode': 'pick_up',
                     'unit': self.uom,
-                    'unit_price': 20000,
-                    'description': 'Picked Item',
-                    'product': self.product1.id
-                }])
+                    'unit_price': 10,
+                    'description': u'Café',
+                    'product': self.product1.id,
+                } for quantity in range(1, index + 2)])],
+            } for index in range(4)])
+
+            chunk_size = self.Sale._pos_export_chunk_size
+            self.Sale._pos_export_chunk_size = 2
+            try:
+                start_date = today - relativedelta(days=2)
+                chunks = list(self.Sale.pos_export_sales(
+                    self.shop.id, start_date, today
+                ))
+                self.assertEqual(len(chunks), 2)
+                exported = [
+                    json.loads(line)
+                    for line in ''.join(chunks).splitlines()
+                ]
+                self.assertEqual(
+                    [sale['id'] for sale in exported],
+                    map(int, sales[:3])
+                )
+                serialized = sales[0].serialize('pos')
+                self.assertEqual(
+                    set(exported[0]), set(serialized)
+                )
+                self.assertEqual(
+                    exported[0]['total_amount'],
+                    str(serialized['total_amount'])
+                )
+                self.assertEqual(
+                    [line['id'] for line in exported[2]['lines']],
+                    map(int, sales[2].lines)
+                )
 
-                rv = self.Sale.get_recent_sales()
-                self.assertEqual(len(rv), 4)
+                rows = list(csv.reader(StringIO(''.join(
+                    self.Sale.pos_export_sales(
+                        self.shop.id, start_date, today, 'csv'
+                    )
+                ))))
+                header = rows.pop(0)
+                self.assertEqual(header[0], 'sale.id')
+                self.assertTrue('product.code' in header)
+                # One row per line
+                self.assertEqual(len(rows), 1 + 2 + 3)
+                self.assertEqual(
+                    rows[0][header.index('description')], 'Café'
+                )
 
-                # Test serialized data
-                self.assertIn('id', rv[0])
-                self.assertIn('party', rv[0])
-                self.assertIn('total_amount', rv[0])
-                self.assertIn('create_date', rv[0])
+                self.assertEqual(list(self.Sale.pos_export_sales(
+                    self.shop.id, today + relativedelta(days=1),
+                    today + relativedelta(days=1)
+                )), [])
+
+                # A full last chunk is not followed by an empty one
+                chunks = list(self.Sale.pos_export_sales(
+                    self.shop.id, today - relativedelta(days=1), today
+                ))
+                self.assertEqual(len(chunks), 1)
+                self.assertEqual(len(chunks[0].splitlines()), 2)
+
+                with self.assertRaises(ValueError):
+                    list(self.Sale.pos_export_sales(
+                        self.shop.id, start_date, today, 'xml'
+                    ))
+            finally:
+                self.Sale._pos_export_chunk_size = chunk_size
+
+    def test_1205_pos_export_command(self):
+        """
+        Ensure that the export command writes the export of the sales to the
+        output file
+        """
+        import tempfile
+        from trytond.config import CONFIG
+        from trytond.modules.pos import export
+
+        SaleLine = POOL.get('sale.line')
+
+        fd, config = tempfile.mkstemp(suffix='.conf')
+        os.write(fd, '[options]\n')
+        os.close(fd)
+        fd, output = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        configfile = CONFIG.configfile
+        try:
+            # The command starts its own transaction, in which there is no
+            # sale as the tests do not commit
+            export.main([
+                '-c', config, '-d', DB_NAME, '--shop', '1',
+                '--start', '2014-01-01', '--end', '2014-01-31',
+                '--format', 'csv', '--output', output,
+            ])
+            with open(output) as fp:
+                rows = list(csv.reader(fp))
+        finally:
+            CONFIG.configfile = configfile
+            os.remove(config)
+            os.remove(output)
+
+        self.assertEqual(rows, [export.csv_header(
+            [name for name in self.Sale._serializers['pos'] if name != 'lines'],
+            SaleLine._serializers['pos']
+        )])
+
+        # The paths through an empty relation are exported empty
+        self.assertEqual(export.to_csv(
+            [{'id': 1, 'party': None, 'lines': []}], ['id', 'party.name'],
+            ['id']
+        ), '1,,\r\n')
+        # The values which cannot be encoded are refused
+        with self.assertRaises(TypeError):
+            export.to_ndjson([{'id': object()}])
 
 
 def suite():
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+    user.py
+
+    :copyright: (c) 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+from trytond.pool import Pool, PoolMeta
+
+__metaclass__ = PoolMeta
+__all__ = ['User']
+
+
+class User:
+    __name__ = 'res.user'
+
+    @classmethod
+    def clear_pos_settings_cache(cls):
+        """
+        Clear the cache of the shops of the users and of their settings
+        """
+        Pool().get('sale.shop')._pos_settings_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        cls.clear_pos_settings_cache()
+        return super(User, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls.clear_pos_settings_cache()
+        return super(User, cls).write(*args)
+
+    @classmethod
+    def delete(cls, users):
+        cls.clear_pos_settings_cache()
+        return super(User, cls).delete(users)